@@ -0,0 +1,376 @@
+# %% [markdown]
+# Create the timelines of the whole caseload as a resumable batch job
+#
+# The clients (CLIENTS in user_defined_variables, [-1] for all clients) are
+# divided into SHARDS shards by a hash of their ClientID, so every machine
+# assigns each client to the same shard. Each shard can be run by a local
+# worker process (--workers) or on a separate machine that shares the job
+# folder and FOLDER (--shard).
+#
+# Each shard keeps a checkpoint log in the job folder (shard_{shard}.log), a
+# line for each client when its timeline has been created or has failed
+# (with the error), or when the client has no episodes left after cleaning
+# (so there is no timeline to create). A client whose timeline cannot be
+# created does not stop the shard. When a shard is run again, the clients
+# already in its log are skipped (the failed clients too, unless
+# --retry-failed), so a job that was stopped picks up where it stopped.
+#
+# At the end, a summary of the clients created, failed, with no episodes and
+# still to do, the time taken and the throughput of each shard is printed
+# (--summary prints it for the whole job, from the logs, without creating any
+# timelines).
+#
+# The episodes are read from ARCHIVE_FOLDER or DATABASE when set (so each
+# shard only reads its own clients), otherwise from the input file a chunk at
+# a time (STREAM_CHUNK_ROWS rows, or 100000).
+#
+# Run from the repository folder:
+#
+#     python batch_timelines.py --shards 8 --workers 2
+#
+# or, on each machine, with one or more shards each:
+#
+#     python batch_timelines.py --shards 8 --shard 0 1
+#     python batch_timelines.py --shards 8 --summary
+
+# %%
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import service_use_timelines as sut
+
+# %% [markdown]
+# ## Define function: assign_shards
+#
+# The shard of each ClientID: the CRC-32 of the ClientID (the same in every
+# process and on every machine, unlike Python's hash of a string), modulo the
+# number of shards.
+
+# %%
+def assign_shards(client_ids, SHARDS):
+    """
+    Pass a list of ClientIDs and the number of shards. Return a numpy array of
+    the shard (0 to SHARDS - 1) of each client
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if (type(SHARDS) not in [int]) or SHARDS < 1:
+        raise TypeError (f"function {function_name}: "
+                         f"SHARDS must be a positive integer")
+
+############################### Function ######################################
+
+    return np.array([zlib.crc32(str(int(ClientID)).encode()) % SHARDS
+                     for ClientID in client_ids], dtype = int)
+
+# %% [markdown]
+# ## Define function: list_clients
+#
+# The ClientIDs of the job: CLIENTS, or if CLIENTS is [-1] all the clients in
+# the archive, the database or the input file.
+
+# %%
+def list_clients(variables):
+    """
+    Pass the variables returned by user_defined_variables. Return the list
+    of ClientIDs to create timelines for
+    """
+    if variables.CLIENTS[0] != -1:
+        return list(variables.CLIENTS)
+    if variables.ARCHIVE_FOLDER is not None:
+        archive = sut.open_episode_archive(variables.ARCHIVE_FOLDER)
+        return archive['client_ids'].tolist()
+    if variables.DATABASE is not None:
+        with sqlite3.connect(variables.DATABASE) as connection:
+            return [ClientID for ClientID, in connection.execute(
+                        'SELECT DISTINCT ClientID FROM episodes '
+                        'ORDER BY ClientID')]
+    return pd.read_csv(f"{variables.FOLDER}{variables.FILENAME}.csv",
+                       usecols = ['ClientID']).ClientID.unique().tolist()
+
+# %% [markdown]
+# ## Define function: read_clients
+#
+# Return (yield) the ClientID, data and contacts of each client in clients,
+# from the archive, the database or the input file. Only the episodes of
+# these clients are prepared.
+
+# %%
+def read_clients(variables, clients):
+    """
+    Pass the variables returned by user_defined_variables and a list of
+    ClientIDs. Yield the ClientID, the prepared dataframe and the contact
+    table of each client
+    """
+    if len(clients) == 0:
+        return
+    if variables.ARCHIVE_FOLDER is not None:
+        archive = sut.open_episode_archive(variables.ARCHIVE_FOLDER)
+        for ClientID in clients:
+            yield (ClientID, *sut.get_archived_client(archive, ClientID))
+    elif variables.DATABASE is not None:
+        with sqlite3.connect(variables.DATABASE) as connection:
+            yield from sut.read_episode_store(connection, clients,
+                                              variables.COLUMNS_REQUIRED,
+                                              variables.COLUMNS_DTYPE,
+                                              variables.KEEP_MISSING_COST,
+                                              variables.ZERO_LOS_REPLACEMENT,
+                                              variables.REPLACE_NAN_COLUMNS,
+                                              variables.REPLACE_NAN_VALUES,
+                                              variables.COMPACT_DATA)
+    else:
+        chunk_rows = variables.STREAM_CHUNK_ROWS or 100000
+        yield from sut.stream_client_data(variables.FOLDER,
+                                          variables.FILENAME, clients,
+                                          variables.COLUMNS_REQUIRED,
+                                          variables.COLUMNS_DTYPE,
+                                          variables.KEEP_MISSING_COST,
+                                          variables.ZERO_LOS_REPLACEMENT,
+                                          variables.REPLACE_NAN_COLUMNS,
+                                          variables.REPLACE_NAN_VALUES,
+                                          chunk_rows,
+                                          variables.COMPACT_DATA)
+
+# %% [markdown]
+# ## Define function: read_checkpoint
+#
+# Read a shard's checkpoint log: one json line for each client, with its
+# ClientID, status ('done', 'failed' or 'empty': no episodes after cleaning),
+# error (or why the client is empty), the time taken and when it finished.
+# A line that was only partly written (when the job was stopped while writing
+# it) is ignored. A client in the log more than once (tried again with
+# --retry-failed) has the status of its last line.
+
+# %%
+def read_checkpoint(filename):
+    """
+    Return a dictionary of ClientID: the last line (a dictionary) of each
+    client in the checkpoint log filename (empty if there is no log)
+    """
+    entries = {}
+    if not os.path.exists(filename):
+        return entries
+    with open(filename, encoding = 'utf-8') as log:
+        for line in log:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            entries[entry['ClientID']] = entry
+    return entries
+
+# %% [markdown]
+# ## Define function: run_shard
+#
+# Create the timelines of the clients of one shard that are not yet in its
+# checkpoint log, adding a line to the log as each client finishes. The
+# clients with no episodes after cleaning (which are not read, or are read
+# with no episodes) are logged as empty, so they are not looked for again.
+# Return the number of clients of the shard, created, failed, empty and
+# skipped (already in the log), and the time taken.
+
+# %%
+EMPTY_CLIENT = "no episodes after cleaning"
+
+def run_shard(variables, JOB_FOLDER, SHARDS, shard, RETRY_FAILED = False):
+    """
+    Pass the variables returned by user_defined_variables, the job folder,
+    the number of shards and the shard to run. Return a dictionary of the
+    shard's results
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if (type(shard) not in [int]) or not 0 <= shard < SHARDS:
+        raise ValueError (f"function {function_name}: "
+                          f"shard must be from 0 to {SHARDS - 1}")
+
+############################### Function ######################################
+
+    start = time.perf_counter()
+
+    clients = list_clients(variables)
+    clients = [ClientID for ClientID, client_shard
+               in zip(clients, assign_shards(clients, SHARDS))
+               if client_shard == shard]
+    log_file = os.path.join(JOB_FOLDER, f"shard_{shard}.log")
+    checkpoint = read_checkpoint(log_file)
+    to_do = [ClientID for ClientID in clients
+             if ClientID not in checkpoint or
+             (RETRY_FAILED and checkpoint[ClientID]['status'] == 'failed')]
+
+    result = {'shard': shard, 'clients': len(clients), 'done': 0,
+              'failed': 0, 'empty': 0, 'skipped': len(clients) - len(to_do)}
+    with open(log_file, 'a', encoding = 'utf-8') as log:
+        # End a line left part written by a run that was stopped
+        if log.tell() > 0:
+            with open(log_file, 'rb') as partial:
+                partial.seek(-1, os.SEEK_END)
+                if partial.read(1) != b'\n':
+                    log.write('\n')
+
+        def log_client(ClientID, status, error, seconds):
+            result[status] += 1
+            log.write(json.dumps({'ClientID': int(ClientID),
+                                  'status': status, 'error': error,
+                                  'seconds': round(seconds, 4),
+                                  'finished': time.time()}) + '\n')
+            log.flush()
+
+        read = set()
+        for ClientID, df, contacts in read_clients(variables, to_do):
+            read.add(ClientID)
+            if len(df) == 0:
+                log_client(ClientID, 'empty', EMPTY_CLIENT, 0)
+                continue
+            client_start = time.perf_counter()
+            try:
+                sut.render_client_timeline(df, contacts, variables.FOLDER,
+                                           variables.ORDER_ON_COST,
+                                           variables.RENDER_ENGINE,
+                                           HEADLESS = True,
+                                           SVG_FORMAT = variables.SVG_FORMAT)
+                status, error = 'done', None
+            except Exception as exception:
+                if variables.RENDER_ENGINE == 'matplotlib':
+                    import matplotlib.pyplot as plt
+                    plt.close('all')
+                status, error = 'failed', (f"{type(exception).__name__}: "
+                                           f"{exception}")
+            log_client(ClientID, status, error,
+                       time.perf_counter() - client_start)
+
+        # The clients whose episodes were all removed by cleaning
+        for ClientID in to_do:
+            if ClientID not in read:
+                log_client(ClientID, 'empty', EMPTY_CLIENT, 0)
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+# %% [markdown]
+# ## Define function: print_job_summary
+#
+# Print, for each shard, the clients created, failed and empty in this run
+# (results, from run_shard) and its time and throughput, and for the whole
+# job (from the checkpoint logs of all the shards) the clients done, failed,
+# empty and still to do, and the first failures.
+
+# %%
+def print_job_summary(JOB_FOLDER, SHARDS, results, total_clients,
+                      seconds = None):
+    """
+    Pass the job folder, the number of shards, the list of run_shard results
+    of this run (can be empty), the number of clients of the job and the
+    wall time of this run
+    """
+    if len(results) > 0:
+        print(f"{'shard':>6}{'clients':>10}{'skipped':>10}{'done':>8}"
+              f"{'failed':>8}{'empty':>8}{'seconds':>10}{'clients/s':>11}")
+        for result in sorted(results, key = lambda result: result['shard']):
+            processed = result['done'] + result['failed']
+            print(f"{result['shard']:>6}{result['clients']:>10}"
+                  f"{result['skipped']:>10}{result['done']:>8}"
+                  f"{result['failed']:>8}{result['empty']:>8}"
+                  f"{result['seconds']:>10.1f}"
+                  f"{processed / max(result['seconds'], 1e-9):>11.1f}")
+        processed = sum(result['done'] + result['failed']
+                        for result in results)
+        if seconds is not None:
+            print(f"This run: {processed} clients in {seconds:.1f} seconds "
+                  f"({processed / max(seconds, 1e-9):.1f} clients/s)")
+
+    checkpoint = {}
+    for shard in range(SHARDS):
+        checkpoint.update(read_checkpoint(
+                            os.path.join(JOB_FOLDER, f"shard_{shard}.log")))
+    failed = [entry for entry in checkpoint.values()
+              if entry['status'] == 'failed']
+    empty = sum(entry['status'] == 'empty' for entry in checkpoint.values())
+    done = len(checkpoint) - len(failed) - empty
+    print(f"Job: {done} of {total_clients} timelines created, {len(failed)} "
+          f"failed, {empty} with no episodes after cleaning, "
+          f"{max(total_clients - len(checkpoint), 0)} to do")
+    for entry in failed[:10]:
+        print(f"  client {entry['ClientID']}: {entry['error']}")
+    if len(failed) > 10:
+        print(f"  ... and {len(failed) - 10} more (see the shard logs in "
+              f"{JOB_FOLDER})")
+
+# %% [markdown]
+# ## Main code
+
+# %%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Create the timelines of "
+                                     "the whole caseload as a resumable "
+                                     "batch job")
+    parser.add_argument('--shards', type = int,
+                        help = "number of shards (default: as when the job "
+                               "was started, or 1)")
+    parser.add_argument('--shard', type = int, nargs = '+',
+                        help = "the shards to run (default all)")
+    parser.add_argument('--workers', type = int, default = 1,
+                        help = "number of shards to run at once (default 1)")
+    parser.add_argument('--job-folder',
+                        help = "folder of the checkpoint logs (default "
+                               "FOLDER/batch_job/)")
+    parser.add_argument('--retry-failed', action = 'store_true',
+                        help = "create the timelines that failed again")
+    parser.add_argument('--summary', action = 'store_true',
+                        help = "only print the summary of the job")
+    args = parser.parse_args()
+
+    # Draw with the non-interactive backend (also in the worker processes)
+    os.environ['MPLBACKEND'] = 'Agg'
+    VARIABLES = sut.user_defined_variables()
+    JOB_FOLDER = args.job_folder or os.path.join(VARIABLES.FOLDER,
+                                                   'batch_job')
+    os.makedirs(JOB_FOLDER, exist_ok = True)
+
+    # The number of shards is kept for the job, so every run (and machine)
+    # uses the same shards
+    job_file = os.path.join(JOB_FOLDER, 'job.json')
+    if os.path.exists(job_file):
+        with open(job_file, encoding = 'utf-8') as file:
+            SHARDS = json.load(file)['shards']
+        if args.shards is not None and args.shards != SHARDS:
+            parser.error(f"the job in {JOB_FOLDER} has {SHARDS} shards; use "
+                         f"another --job-folder to change the number")
+    else:
+        SHARDS = args.shards or 1
+        with open(f"{job_file}.tmp", 'w', encoding = 'utf-8') as file:
+            json.dump({'shards': SHARDS}, file)
+        os.replace(f"{job_file}.tmp", job_file)
+
+    RESULTS = []
+    start = time.perf_counter()
+    if not args.summary:
+        SHARD_LIST = args.shard if args.shard is not None else range(SHARDS)
+        for shard in SHARD_LIST:
+            if not 0 <= shard < SHARDS:
+                parser.error(f"--shard must be from 0 to {SHARDS - 1}")
+        if args.workers == 1:
+            RESULTS = [run_shard(VARIABLES, JOB_FOLDER, SHARDS, shard,
+                                 args.retry_failed) for shard in SHARD_LIST]
+        else:
+            with ProcessPoolExecutor(max_workers = args.workers) as pool:
+                RESULTS = list(pool.map(run_shard,
+                                        [VARIABLES] * len(SHARD_LIST),
+                                        [JOB_FOLDER] * len(SHARD_LIST),
+                                        [SHARDS] * len(SHARD_LIST),
+                                        SHARD_LIST,
+                                        [args.retry_failed] * len(SHARD_LIST)))
+    print_job_summary(JOB_FOLDER, SHARDS, RESULTS,
+                      len(list_clients(VARIABLES)),
+                      time.perf_counter() - start)
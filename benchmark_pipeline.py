@@ -0,0 +1,215 @@
+# %% [markdown]
+# Benchmark how the service_use_timelines.py pipeline scales
+#
+# For each size (number of episodes), writes a synthetic input file with
+# generate_carenotes.py and runs the pipeline on it one stage at a time:
+# read, validate, clean (with date formatting and cost), calculate_mdate,
+# contact table, compact types, population occupancy, per-client split and 
+# creating the timelines (with each rendering engine, for a sample of the 
+# clients).
+# Reports the time, throughput and peak memory of each stage, and saves them 
+# as json so the results of different versions can be compared.
+#
+# Run from the repository folder:
+#
+#     python benchmark_pipeline.py --episodes 1000 100000 1000000
+#
+# The time (wall and CPU) and peak memory are recorded with record_stage of
+# service_use_timelines.py. The peak memory is the peak of the memory
+# allocated during the stage, as traced by tracemalloc. Tracing makes the
+# stages slower, so the pipeline is run twice: once to time the stages and
+# once to trace the memory. Use --no-memory to only time the stages.
+
+# %%
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import generate_carenotes
+import service_use_timelines as sut
+
+# %% [markdown]
+# ## Define function: benchmark_pipeline
+#
+# The stages call the same functions, in the same order, as prepare_data and
+# the main code of service_use_timelines.py, and are recorded with its 
+# record_stage. The throughput of a stage is the number of items (episodes, 
+# or timelines) divided by the wall time.
+
+# %%
+def benchmark_pipeline(filename, RENDER_CLIENTS, TRACE_MEMORY, variables):
+    """
+    Run each stage of the pipeline on the input file (filename). Return a
+    list of the measurements of each stage (with peak memory if TRACE_MEMORY)
+    """
+    report = sut.create_report(TRACE_MEMORY)
+
+    def stage(name, items, unit, stage_function, *args):
+        with sut.record_stage(report, name, items = items, unit = unit):
+            result = stage_function(*args)
+        # items None: the number of rows of the result
+        measurement = report['stages'][-1]
+        if items is None:
+            measurement['items'] = len(result)
+        measurement['items_per_second'] = (measurement['items'] / 
+                                           measurement['wall_seconds'])
+        return result
+
+    def read(filename):
+        return pd.read_csv(filename, low_memory = False)
+
+    def split(df, contacts):
+        # Use each client's data, as rendering does: count its rows
+        df, client_index = sut.create_client_index(df)
+        contacts, contact_index = sut.create_client_index(contacts)
+        rows = 0
+        for ClientID in client_index:
+            rows += len(sut.get_client_data(df, client_index, ClientID))
+            rows += len(sut.get_client_data(contacts, contact_index, 
+                                            ClientID))
+        return df, client_index, contacts, contact_index, rows
+
+    def render(df, client_index, contacts, contact_index, clients, engine):
+        with tempfile.TemporaryDirectory() as folder:
+            for ClientID in clients:
+                sut.render_client_timeline(
+                        sut.get_client_data(df, client_index, ClientID),
+                        sut.get_client_data(contacts, contact_index,
+                                            ClientID),
+                        folder, variables.ORDER_ON_COST, engine,
+                        HEADLESS = True)
+
+    df = stage('read', None, 'episodes', read, filename)
+    stage('validate', len(df), 'episodes', 
+          sut.check_columns_present_and_type, df, variables.COLUMNS_REQUIRED,
+          variables.COLUMNS_DTYPE)
+    df = stage('clean', len(df), 'episodes', sut.clean_data, df, 
+               variables.KEEP_MISSING_COST, variables.ZERO_LOS_REPLACEMENT,
+               variables.REPLACE_NAN_COLUMNS, variables.REPLACE_NAN_VALUES)
+    df = stage('calculate_mdate', len(df), 'episodes', sut.calculate_mdate, 
+               df, ["ReferralRequest", "ReferralDate", "ReferralDischarge",
+                    "date_of_birth"])
+    df, contacts = stage('contact_table', len(df), 'episodes',
+                         sut.create_contact_table, df)
+    df, contacts = stage('compact_data', len(df), 'episodes', 
+                         sut.compact_data, df, contacts)
+    stage('population', len(df), 'episodes', 
+          sut.calculate_population_occupancy, df, 'Service', '01/01/2015',
+          '18/02/2018')
+    df, client_index, contacts, contact_index, rows = stage(
+                        'client_split', len(df), 'episodes', split, df, 
+                        contacts)
+    report['stages'][-1]['rows'] = rows
+
+    clients = list(client_index)[:RENDER_CLIENTS]
+    for engine in ['matplotlib', 'svg']:
+        stage(f'render_{engine}', len(clients), 'timelines', render, df, 
+              client_index, contacts, contact_index, clients, engine)
+    return report['stages']
+
+# %% [markdown]
+# ## Define function: get_version
+#
+# The versions of the code and packages, saved with the results.
+
+# %%
+def get_version():
+    """
+    Return a dictionary of the git commit and the python and package versions
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                capture_output = True, text = True,
+                                cwd = os.path.dirname(
+                                            os.path.abspath(__file__))
+                                ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(),
+            'numpy': np.__version__, 'pandas': pd.__version__,
+            'matplotlib': matplotlib.__version__,
+            'machine': platform.machine(), 'cpus': os.cpu_count()}
+
+# %% [markdown]
+# ## Main code
+
+# %%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Benchmark how the "
+                                     "service_use_timelines.py pipeline "
+                                     "scales")
+    parser.add_argument('--episodes', type = int, nargs = '+',
+                        default = [1000, 100000, 1000000],
+                        help = "approximate number of episodes of each "
+                               "synthetic file (default 1000 100000 1000000)")
+    parser.add_argument('--episodes-per-client', type = int, default = 6,
+                        help = "mean number of episodes per client "
+                               "(default 6)")
+    parser.add_argument('--max-contacts', type = int, default = 4,
+                        help = "maximum number of contacts per episode "
+                               "(default 4)")
+    parser.add_argument('--render-clients', type = int, default = 10,
+                        help = "number of timelines to create for each size "
+                               "(default 10)")
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = "random seed (default 0)")
+    parser.add_argument('--no-memory', action = 'store_true',
+                        help = "do not trace the peak memory")
+    parser.add_argument('--output', default = 'benchmark_results.json',
+                        help = "json file to save the results to "
+                               "(default benchmark_results.json)")
+    args = parser.parse_args()
+
+    plt.switch_backend('Agg')
+    VARIABLES = sut.user_defined_variables()
+
+    RESULTS = []
+    with tempfile.TemporaryDirectory() as folder:
+        for episodes in args.episodes:
+            n_clients = max(1, episodes // args.episodes_per_client)
+            filename = os.path.join(folder, f"synthetic_{episodes}.csv")
+            generate_carenotes.generate_carenotes(
+                                    n_clients, args.episodes_per_client,
+                                    args.max_contacts, args.seed
+                                    ).to_csv(filename, index = False)
+
+            print(f"\n{episodes} episodes ({n_clients} clients)")
+            print(f"{'stage':<20}{'items':>10}{'seconds':>10}"
+                  f"{'cpu':>10}{'items/s':>14}{'peak MB':>10}")
+            results = benchmark_pipeline(filename, args.render_clients, 
+                                         False, VARIABLES)
+            if not args.no_memory:
+                memory = benchmark_pipeline(filename, args.render_clients, 
+                                            True, VARIABLES)
+                for result, traced in zip(results, memory):
+                    result['peak_mb'] = traced['peak_mb']
+            for result in results:
+                result = {'episodes': episodes, 'clients': n_clients,
+                          **result}
+                RESULTS.append(result)
+                peak_mb = ('' if result.get('peak_mb') is None
+                           else f"{result['peak_mb']:.1f}")
+                print(f"{result['stage']:<20}{result['items']:>10}"
+                      f"{result['wall_seconds']:>10.3f}"
+                      f"{result['cpu_seconds']:>10.3f}"
+                      f"{result['items_per_second']:>14.1f}{peak_mb:>10}")
+
+    with open(args.output, 'w', encoding = 'utf-8') as file:
+        json.dump({'version': get_version(),
+                   'settings': {'episodes_per_client':
+                                    args.episodes_per_client,
+                                'max_contacts': args.max_contacts,
+                                'render_clients': args.render_clients,
+                                'seed': args.seed,
+                                'trace_memory': not args.no_memory},
+                   'results': RESULTS}, file, indent = 1)
+    print(f"\nResults saved to {args.output}")
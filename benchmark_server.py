@@ -0,0 +1,143 @@
+# %% [markdown]
+# Load test a local instance of timeline_server.py
+#
+# Starts the service (with a temporary on-disk cache), and asks it for the
+# timelines of the clients in the input file:
+#
+# - cold: each client once, so each timeline is created for the request
+# - memory: many requests at once (--threads) for the same clients, answered
+#   from the in-memory cache
+# - disk: each client once from a new instance of the service, with the same
+#   cache folder, so each timeline is read from the on-disk cache
+#
+# and reports the response times (median and 95th percentile) and the number
+# of requests answered per second.
+#
+# Run from the repository folder:
+#
+#     python benchmark_server.py --clients 50 --requests 1000 --threads 8
+
+# %%
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+import numpy as np
+import pandas as pd
+
+import service_use_timelines as sut
+
+# %% [markdown]
+# ## Define function: start_timeline_server
+#
+# Start timeline_server.py on a free port, and wait until it has prepared the
+# data. Return the process, its address and the time it took to start.
+
+# %%
+def start_timeline_server(RENDER_ENGINE, cache_folder):
+    """
+    Return the server process, its url and the start up time (seconds)
+    """
+    with socket.socket() as free_socket:
+        free_socket.bind(('127.0.0.1', 0))
+        port = free_socket.getsockname()[1]
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, 'timeline_server.py',
+                                '--port', str(port), '--engine',
+                                RENDER_ENGINE, '--cache-folder', cache_folder],
+                               cwd = os.path.dirname(
+                                            os.path.abspath(__file__)),
+                               stdout = subprocess.PIPE,
+                               stderr = subprocess.DEVNULL, text = True)
+    line = process.stdout.readline()
+    if 'Serving' not in line:
+        process.kill()
+        raise RuntimeError("timeline_server.py did not start")
+    return process, f"http://127.0.0.1:{port}", time.perf_counter() - start
+
+# %% [markdown]
+# ## Define function: request_timelines
+#
+# Ask for the timeline of each client in clients, from N_THREADS threads at
+# once. Return the response time (seconds) of each request, the total time
+# and where each timeline was found (the X-Cache header).
+
+# %%
+def request_timelines(url, clients, N_THREADS):
+    """
+    Return a numpy array of response times, the total time (seconds) and a
+    list of the X-Cache header of each response
+    """
+    def request(ClientID):
+        start = time.perf_counter()
+        with urlopen(f"{url}/timeline/{ClientID}") as response:
+            response.read()
+            found = response.headers['X-Cache']
+        return time.perf_counter() - start, found
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(N_THREADS) as executor:
+        results = list(executor.map(request, clients))
+    total = time.perf_counter() - start
+    return (np.array([seconds for seconds, _ in results]), total,
+            [found for _, found in results])
+
+# %% [markdown]
+# ## Main code
+
+# %%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Load test a local "
+                                     "instance of timeline_server.py")
+    parser.add_argument('--clients', type = int, default = 50,
+                        help = "number of clients (default 50)")
+    parser.add_argument('--requests', type = int, default = 1000,
+                        help = "number of requests from the in-memory cache "
+                               "(default 1000)")
+    parser.add_argument('--threads', type = int, default = 8,
+                        help = "number of requests at once (default 8)")
+    parser.add_argument('--engine', choices = ['matplotlib', 'svg'],
+                        default = 'matplotlib',
+                        help = "rendering engine (default matplotlib)")
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = "random seed (default 0)")
+    args = parser.parse_args()
+
+    VARIABLES = sut.user_defined_variables()
+    CLIENTS = pd.read_csv(f"{VARIABLES.FOLDER}{VARIABLES.FILENAME}.csv",
+                          usecols = ['ClientID']
+                          ).ClientID.unique()[:args.clients].tolist()
+    RANDOM_CLIENTS = np.random.default_rng(args.seed).choice(
+                                        CLIENTS, size = args.requests).tolist()
+
+    print(f"{'phase':<10}{'requests':>10}{'median ms':>12}{'p95 ms':>10}"
+          f"{'requests/s':>12}  cache")
+    with tempfile.TemporaryDirectory() as CACHE_FOLDER:
+        for phase, clients, n_threads in [
+                                    ('cold', CLIENTS, 1),
+                                    ('memory', RANDOM_CLIENTS, args.threads),
+                                    ('disk', CLIENTS, 1)]:
+            if phase != 'memory':
+                # A new instance (the disk phase uses the cache of the first)
+                if phase == 'disk':
+                    PROCESS.terminate()
+                    PROCESS.wait()
+                PROCESS, URL, STARTUP = start_timeline_server(args.engine,
+                                                              CACHE_FOLDER)
+                print(f"{'start':<10}{'':>10}{STARTUP * 1000:>12.0f}")
+            seconds, total, found = request_timelines(URL, clients, n_threads)
+            print(f"{phase:<10}{len(clients):>10}"
+                  f"{np.median(seconds) * 1000:>12.2f}"
+                  f"{np.percentile(seconds, 95) * 1000:>10.2f}"
+                  f"{len(clients) / total:>12.1f}  "
+                  f"{', '.join(sorted(set(found)))}")
+        PROCESS.terminate()
+        PROCESS.wait()
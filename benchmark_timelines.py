@@ -0,0 +1,84 @@
+# %% [markdown]
+# Benchmark the rendering engines of service_use_timelines.py
+#
+# Creates the Service Use Timeline for the clients in the input file with each
+# rendering engine ('matplotlib' and 'svg'), and reports the throughput 
+# (timelines per second) and the average size of the svg files.
+#
+# Run from the repository folder:
+#
+#     python benchmark_timelines.py --clients 50 --repeat 3
+#
+# The timelines are written to a temporary folder, which is deleted afterwards.
+
+# %%
+import argparse
+import os
+import tempfile
+import time
+
+import matplotlib.pyplot as plt
+
+import service_use_timelines as sut
+
+# %% [markdown]
+# ## Define function: benchmark_render_engine
+
+# %%
+def benchmark_render_engine(df, client_index, contacts, contact_index, 
+                            CLIENTS, ORDER_ON_COST, RENDER_ENGINE, repeat):
+    """
+    Create the timeline for each client in CLIENTS, repeat times, with 
+    RENDER_ENGINE. Return the best time (seconds) and the mean file size 
+    (bytes)
+    """
+    best_time = float('inf')
+    with tempfile.TemporaryDirectory() as folder:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for ThisClientID in CLIENTS:
+                client_data = sut.get_client_data(df, client_index, 
+                                                  ThisClientID)
+                client_contacts = sut.get_client_data(contacts, contact_index,
+                                                      ThisClientID)
+                sut.render_client_timeline(client_data, client_contacts, 
+                                           folder, ORDER_ON_COST, 
+                                           RENDER_ENGINE, HEADLESS = True)
+            best_time = min(best_time, time.perf_counter() - start)
+        sizes = [os.path.getsize(os.path.join(folder, name)) 
+                 for name in os.listdir(folder)]
+    return best_time, sum(sizes) / len(sizes)
+
+# %% [markdown]
+# ## Main code
+
+# %%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Benchmark the rendering "
+                                     "engines of service_use_timelines.py")
+    parser.add_argument('--clients', type = int, default = 20,
+                        help = "number of clients to render (default 20)")
+    parser.add_argument('--repeat', type = int, default = 3,
+                        help = "number of repeats, best is kept (default 3)")
+    args = parser.parse_args()
+
+    plt.switch_backend('Agg')
+
+    VARIABLES = sut.user_defined_variables()
+
+    DATA, CONTACTS = sut.load_data(VARIABLES)
+    DATA, CLIENT_INDEX = sut.create_client_index(DATA)
+    CONTACTS, CONTACT_INDEX = sut.create_client_index(CONTACTS)
+    CLIENTS = list(CLIENT_INDEX)[:args.clients]
+
+    print(f"{len(CLIENTS)} clients, {args.repeat} repeats")
+    print(f"{'engine':<12}{'seconds':>10}{'timelines/s':>14}{'mean KB':>10}")
+    for engine in ['matplotlib', 'svg']:
+        seconds, size = benchmark_render_engine(DATA, CLIENT_INDEX, CONTACTS,
+                                                CONTACT_INDEX, CLIENTS, 
+                                                VARIABLES.ORDER_ON_COST,
+                                                engine, 
+                                                args.repeat)
+        print(f"{engine:<12}{seconds:>10.3f}{len(CLIENTS) / seconds:>14.1f}"
+              f"{size / 1024:>10.1f}")
@@ -0,0 +1,244 @@
+# %% [markdown]
+# Cost and pathway analytics of the whole caseload
+#
+# Reads and prepares the input file set in user_defined_variables (with
+# load_data of service_use_timelines.py) and calculates, for every client at
+# once:
+# - a table with a row for each client (summarise_clients): the number of
+#   episodes, the total cost, the days in each Setting and in out of area
+#   beds, the number of contacts and the share of them that were
+#   face-to-face
+# - the number of episodes from each ReferralSource to each WardTeam
+#   (count_referral_pathways), as a matrix
+#
+# Both are calculated with a single pass over the episodes and the contact
+# table (no loop over the clients), so a million prepared episodes take 
+# under a second. The file type of each output is chosen from its name: .csv,
+# .pkl or .parquet (see save_table of export_data.py).
+#
+# The client table can also be used to choose the clients whose timeline is
+# worth looking at: --select keeps the clients that match a query on its
+# columns, --top the clients with the highest total cost (or --by another
+# column). The ClientIDs chosen are printed, to set as CLIENTS in
+# user_defined_variables, and --render creates their timelines in FOLDER.
+#
+# Run from the repository folder:
+#
+#     python client_analytics.py data/client_summary.csv \
+#         --pathways data/referral_pathways.csv
+#
+#     python client_analytics.py --select "ooa_bed_days > 0" --render
+
+# %%
+import argparse
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+import service_use_timelines as sut
+from export_data import save_table
+
+# %% [markdown]
+# ## Define function: count_referral_pathways
+#
+# The number of episodes referred from each ReferralSource (the rows) to each
+# WardTeam (the columns), for the episodes in df. The episodes with either
+# value missing are not counted. The columns may be text or categoricals (see
+# compact_data).
+
+# %%
+def count_referral_pathways(df):
+    """
+    Pass the prepared episodes. Return a pandas dataframe of the number of
+    episodes from each ReferralSource (index) to each WardTeam (columns)
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    for column in ['ReferralSource', 'WardTeam']:
+        if column not in df.columns:
+            raise ValueError (f"function {function_name}: "
+                              f"Dataframe must contain column {column}")
+
+############################### Function ######################################
+
+    source, sources = pd.factorize(df['ReferralSource'].to_numpy(),
+                                   sort = True)
+    team, teams = pd.factorize(df['WardTeam'].to_numpy(), sort = True)
+    known = (source >= 0) & (team >= 0)
+    counts = np.bincount(source[known] * len(teams) + team[known],
+                         minlength = len(sources) * len(teams))
+    return pd.DataFrame(counts.reshape(len(sources), len(teams)),
+                        index = pd.Index(sources, name = 'ReferralSource'),
+                        columns = pd.Index(teams, name = 'WardTeam'))
+
+# %% [markdown]
+# ## Define function: summarise_clients
+#
+# A row for each client in df (the prepared episodes, from prepare_data,
+# optionally compact_data) with:
+# - episodes: the number of episodes
+# - total_cost: the sum of Episode_cost (a missing cost counts as 0)
+# - total_days: the sum of the days of the episodes, from the referral date
+#   to the discharge date (overlapping episodes each count)
+# - days_{Setting}: the days of the episodes in each Setting
+# - ooa_bed_days: the days of the episodes in the OOA setting (out of area
+#   beds), 0 when the data has no OOA episodes
+# - contacts and face_to_face_contacts: the number of contacts in the contact
+#   table, and of those with contact_type 0 (face-to-face)
+# - face_to_face_ratio: face_to_face_contacts divided by the contacts with a
+#   known contact type (NaN for a client with none)
+#
+# Each client is given a row number (np.unique of the ClientIDs), and every
+# total is a weighted count of the episodes (or contacts) by row number
+# (np.bincount), as in calculate_population_occupancy.
+
+# %%
+OOA_SETTING = 'OOA'
+FACE_TO_FACE = 0
+
+def summarise_clients(df, contacts):
+    """
+    Pass the prepared episodes and contact table. Return a pandas dataframe
+    with a row of totals for each ClientID
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(contacts, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"contacts must be a pandas dataframe")
+
+    for column in ['ClientID', 'Setting', 'Episode_cost',
+                   'ReferralDate_mdate', 'ReferralDischarge_mdate']:
+        if column not in df.columns:
+            raise ValueError (f"function {function_name}: "
+                              f"Dataframe must contain column {column}")
+
+############################### Function ######################################
+
+    clients, client = np.unique(df['ClientID'].to_numpy(),
+                                return_inverse = True)
+    n_clients = len(clients)
+
+    def total(row, weights = None):
+        return np.bincount(row, weights, minlength = n_clients)
+
+    days = (df['ReferralDischarge_mdate'].to_numpy(dtype = float) -
+            df['ReferralDate_mdate'].to_numpy(dtype = float))
+    cost = (df['Episode_cost'].replace('Not available', 0)
+            .to_numpy(dtype = float))
+    summary = {'episodes': total(client),
+               'total_cost': total(client, cost).round().astype(np.int64),
+               'total_days': total(client, days)}
+
+    # Days in each setting: a column of the (client, setting) totals for each
+    # setting
+    setting, settings = pd.factorize(df['Setting'].to_numpy(), sort = True)
+    known = setting >= 0
+    setting_days = np.bincount(client[known] * len(settings) + setting[known],
+                               days[known],
+                               minlength = n_clients * len(settings)
+                               ).reshape(n_clients, len(settings))
+    for k, name in enumerate(settings):
+        summary[f"days_{name}"] = setting_days[:, k]
+    is_ooa = df['Setting'].to_numpy() == OOA_SETTING
+    summary['ooa_bed_days'] = total(client, np.where(is_ooa, days, 0))
+
+    # Contacts, of the clients in df only
+    contact_client = contacts['ClientID'].to_numpy()
+    in_df = np.isin(contact_client, clients)
+    row = np.searchsorted(clients, contact_client[in_df])
+    contact_type = contacts['contact_type'].to_numpy(dtype = float)[in_df]
+    summary['contacts'] = total(row)
+    summary['face_to_face_contacts'] = total(row, contact_type == FACE_TO_FACE
+                                             ).astype(np.int64)
+    known_type = total(row, contact_type >= 0)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        summary['face_to_face_ratio'] = np.where(
+                            known_type > 0,
+                            summary['face_to_face_contacts'] / known_type,
+                            np.nan)
+
+    # Whole days: the dates are day numbers
+    for name, values in summary.items():
+        if name.endswith('days') or name.startswith('days_'):
+            summary[name] = values.round().astype(np.int64)
+    return pd.DataFrame(summary, index = pd.Index(clients, name = 'ClientID'))
+
+# %% [markdown]
+# ## Main code
+
+# %%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Cost and pathway "
+                                     "analytics of the whole caseload")
+    parser.add_argument('filename', nargs = '?',
+                        help = "file to write the client table to (.csv, "
+                               ".pkl or .parquet, default none)")
+    parser.add_argument('--pathways', help = "file to write the ReferralSource"
+                                             " to WardTeam matrix to (default "
+                                             "none)")
+    parser.add_argument('--select', help = "query on the columns of the "
+                                           "client table, to choose clients "
+                                           "(for example \"ooa_bed_days > "
+                                           "0\")")
+    parser.add_argument('--top', type = int, help = "choose the clients with "
+                                                    "the highest total cost "
+                                                    "(or --by)")
+    parser.add_argument('--by', default = 'total_cost',
+                        help = "column of the client table to choose the top "
+                               "clients by (default total_cost)")
+    parser.add_argument('--render', action = 'store_true',
+                        help = "create the timelines of the clients chosen")
+    args = parser.parse_args()
+    if args.render and args.select is None and args.top is None:
+        parser.error("--render needs --select or --top")
+
+    start = time.perf_counter()
+    VARIABLES = sut.user_defined_variables()
+    DATA, CONTACTS = sut.load_data(VARIABLES)
+    prepared = time.perf_counter()
+
+    SUMMARY = summarise_clients(DATA, CONTACTS)
+    PATHWAYS = count_referral_pathways(DATA)
+    print(f"{len(SUMMARY)} clients ({len(DATA)} episodes) prepared in "
+          f"{prepared - start:.2f} seconds and summarised in "
+          f"{time.perf_counter() - prepared:.2f} seconds")
+
+    if args.filename is not None:
+        save_table(SUMMARY, args.filename)
+    if args.pathways is not None:
+        save_table(PATHWAYS, args.pathways)
+
+    if args.select is not None or args.top is not None:
+        CHOSEN = SUMMARY
+        if args.select is not None:
+            CHOSEN = CHOSEN.query(args.select)
+        if args.top is not None:
+            CHOSEN = CHOSEN.nlargest(args.top, args.by)
+        print(f"CLIENTS = {CHOSEN.index.tolist()}")
+
+        if args.render:
+            DATA, CLIENT_INDEX = sut.create_client_index(DATA)
+            CONTACTS, CONTACT_INDEX = sut.create_client_index(CONTACTS)
+            for ClientID in CHOSEN.index:
+                sut.render_client_timeline(
+                        sut.get_client_data(DATA, CLIENT_INDEX, ClientID),
+                        sut.get_client_data(CONTACTS, CONTACT_INDEX,
+                                            ClientID),
+                        VARIABLES.FOLDER, VARIABLES.ORDER_ON_COST,
+                        VARIABLES.RENDER_ENGINE, HEADLESS = True,
+                        SVG_FORMAT = VARIABLES.SVG_FORMAT)
+            print(f"{len(CHOSEN)} timelines created in {VARIABLES.FOLDER}")
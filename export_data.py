@@ -0,0 +1,97 @@
+# %% [markdown]
+# Export the prepared data of service_use_timelines.py, without drawing
+#
+# Reads the input file set in user_defined_variables, checks and prepares it
+# (prepare_data: replaces the missing values, formats the dates and calculates
+# the length of stay, cost and matplotlib dates of each episode) and writes
+# the prepared episodes, and the contact table, to files. The file type is
+# chosen from the file name: .csv, .pkl (pickle, which keeps the column
+# types) or .parquet (needs pyarrow).
+#
+# With --archive, the prepared data is also written to a folder of numpy
+# arrays (see create_episode_archive), from which the episodes of a single
+# client can be read without reading the rest (set ARCHIVE_FOLDER in
+# user_defined_variables to create the timelines from it).
+#
+# No plotting code is imported (matplotlib is only imported by the functions
+# of service_use_timelines.py that draw the charts), so this starts in a
+# fraction of the time of creating the timelines.
+#
+# Run from the repository folder:
+#
+#     python export_data.py data/prepared_carenotes.csv \
+#         --contacts data/prepared_contacts.csv
+#
+#     python export_data.py --archive data/archive/
+
+# %%
+import argparse
+import os
+import sys
+import time
+
+import service_use_timelines as sut
+
+# %% [markdown]
+# ## Define function: save_table
+#
+# Write a dataframe to filename, in the format of its extension. The file is
+# written to a temporary name first, so an export that stops part way
+# through does not leave an incomplete file.
+
+# %%
+def save_table(df, filename):
+    """
+    Pass a pandas dataframe and the file name (.csv, .pkl or .parquet) to
+    save it to
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in ['.csv', '.pkl', '.parquet']:
+        raise ValueError (f"function {function_name}: "
+                          f"filename must end in .csv, .pkl or .parquet")
+
+############################### Function ######################################
+
+    if extension == '.csv':
+        df.to_csv(f"{filename}.tmp")
+    elif extension == '.pkl':
+        df.to_pickle(f"{filename}.tmp", compression = None)
+    else:
+        df.to_parquet(f"{filename}.tmp")
+    os.replace(f"{filename}.tmp", filename)
+
+# %% [markdown]
+# ## Main code
+
+# %%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Export the prepared data "
+                                     "of service_use_timelines.py")
+    parser.add_argument('filename', nargs = '?', 
+                        help = "file to write the prepared episodes to (.csv, "
+                               ".pkl or .parquet)")
+    parser.add_argument('--contacts', help = "file to write the contact table "
+                                             "to (default none)")
+    parser.add_argument('--archive', help = "folder to write the archive of "
+                                            "the prepared data to (default "
+                                            "none)")
+    args = parser.parse_args()
+    if args.filename is None and args.archive is None:
+        parser.error("give a filename, --archive, or both")
+
+    start = time.perf_counter()
+    VARIABLES = sut.user_defined_variables()
+    DATA, CONTACTS = sut.load_data(VARIABLES)
+
+    if args.filename is not None:
+        save_table(DATA, args.filename)
+    if args.contacts is not None:
+        save_table(CONTACTS, args.contacts)
+    if args.archive is not None:
+        sut.create_episode_archive(DATA, CONTACTS, args.archive)
+    print(f"{len(DATA)} episodes ({len(CONTACTS)} contacts) prepared and "
+          f"exported in {time.perf_counter() - start:.2f} seconds")
@@ -0,0 +1,189 @@
+# %% [markdown]
+# Generate a synthetic Carenotes extract
+#
+# Writes a csv file with the columns and types of data/mock_carenotes.csv
+# (COLUMNS_REQUIRED and COLUMNS_DTYPE in service_use_timelines.py), for any
+# number of clients, episodes per client and contacts per episode. The values
+# are random, drawn with a fixed seed so the same file is generated each time.
+#
+# Used by benchmark_pipeline.py to measure how the pipeline scales. Can also be
+# run from the repository folder:
+#
+#     python generate_carenotes.py data/synthetic_carenotes.csv --clients 1000
+
+# %%
+import argparse
+import sys
+
+import numpy as np
+import pandas as pd
+
+# %% [markdown]
+# ## Categories
+#
+# The categories of the text columns, as in data/mock_carenotes.csv.
+
+# %%
+SETTINGS = ['Community', 'Inpatient', 'OOA', 'Other local beds']
+SETTING_PROBABILITY = [0.7, 0.15, 0.05, 0.1]
+DAILY_COST = {'Community': 50, 'Inpatient': 400, 'OOA': 600,
+              'Other local beds': 250}
+
+LOCALITIES = ['Locality 1', 'Locality 2', 'Locality 3', 'Whole County']
+
+GEN_SPECIALTIES = ['ADULT MENTAL ILLNESS', 'PSYCHOTHERAPY',
+                   'LIAISON PSYCHIATRY', 'FORENSIC PSYCHIATRY',
+                   'LEARNING DISABILITY', 'PERINATAL', 'OLD AGE PSYCHIATRY']
+
+DIAGNOSES = [('F600', 'Paranoid personality disorder'),
+             ('F601', 'Schizoid personality disorder'),
+             ('F602', 'Dissocial personality disorder'),
+             ('F603', 'Emotionally unstable personality disorder'),
+             ('F606', 'Anxious [avoidant] personality disorder'),
+             ('F607', 'Dependent personality disorder'),
+             ('F609', 'Personality disorder, unspecified')]
+
+# %% [markdown]
+# ## Define function: format_days
+#
+# Convert an array of day numbers (days since 01/01/1970, nan if missing) to
+# dd/mm/yyyy strings, the date format of the input file.
+
+# %%
+def format_days(days):
+    """
+    Pass a numpy array of day numbers. Return a numpy array of date strings
+    (nan where the day number is nan)
+    """
+    # There are far fewer distinct days than episodes, so only format each
+    # distinct day once
+    unique_days, inverse = np.unique(days, return_inverse = True)
+    is_day = ~np.isnan(unique_days)
+    dates = np.full(len(unique_days), np.nan, dtype = object)
+    dates[is_day] = pd.to_datetime(unique_days[is_day], 
+                                   unit = 'D').strftime('%d/%m/%Y')
+    return dates[inverse]
+
+# %% [markdown]
+# ## Define function: generate_carenotes
+#
+# Each client has between 1 and (2 * EPISODES_PER_CLIENT - 1) episodes, so
+# the mean is EPISODES_PER_CLIENT, and each episode has between 0 and
+# MAX_CONTACTS contacts. The referrals start between 01/01/2010 and
+# 18/02/2018. An episode with a discharge date after 18/02/2018 is still open
+# (the discharge date is missing).
+
+# %%
+def generate_carenotes(N_CLIENTS, EPISODES_PER_CLIENT, MAX_CONTACTS, SEED):
+    """
+    Return a pandas dataframe with the synthetic episodes of N_CLIENTS
+    clients, in the format of the input file
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    for name, value, minimum in [('N_CLIENTS', N_CLIENTS, 1),
+                                 ('EPISODES_PER_CLIENT', EPISODES_PER_CLIENT,
+                                  1),
+                                 ('MAX_CONTACTS', MAX_CONTACTS, 0)]:
+        if (type(value) not in [int]) or value < minimum:
+            raise TypeError (f"function {function_name}: "
+                             f"{name} must be an integer of at least "
+                             f"{minimum}")
+
+############################### Function ######################################
+
+    rng = np.random.default_rng(SEED)
+    first_day = (pd.Timestamp('2010-01-01') - pd.Timestamp(0)).days
+    last_day = (pd.Timestamp('2018-02-18') - pd.Timestamp(0)).days
+
+    # Clients: number of episodes and date of birth
+    episodes = rng.integers(1, 2 * EPISODES_PER_CLIENT, size = N_CLIENTS)
+    client_id = np.repeat(np.arange(1, N_CLIENTS + 1), episodes)
+    birth_day = np.repeat(rng.integers(first_day - 80 * 365,
+                                       first_day - 18 * 365,
+                                       size = N_CLIENTS), episodes)
+    n = len(client_id)
+
+    # Episode dates
+    referral_day = rng.integers(first_day, last_day, size = n).astype(float)
+    request_day = referral_day - rng.integers(0, 60, size = n)
+    discharge_day = referral_day + np.floor(rng.exponential(120, size = n))
+    discharge_day[discharge_day > last_day] = np.nan
+
+    # Episode details
+    setting = rng.choice(SETTINGS, size = n, p = SETTING_PROBABILITY)
+    locality = rng.choice(LOCALITIES, size = n).astype(object)
+    locality[setting == 'OOA'] = 'Out-of-Area'
+    bedtype = np.where((setting == 'OOA') & (rng.random(n) < 0.3),
+                       'PICU', None)
+    diagnosis = rng.integers(-1, len(DIAGNOSES), size = n)
+    icd10 = np.array([code for code, _ in DIAGNOSES] + [np.nan],
+                     dtype = object)[diagnosis]
+    desc = np.array([desc for _, desc in DIAGNOSES] + [np.nan],
+                    dtype = object)[diagnosis]
+    source = np.array([f"ReferralSource{i}" for i in range(36)] + [np.nan],
+                      dtype = object)[rng.integers(0, 37, size = n)]
+    daily_cost = pd.Series(setting).map(DAILY_COST).to_numpy()
+    daily_cost = (daily_cost * rng.uniform(0.8, 1.2, size = n)).astype(int)
+
+    df = pd.DataFrame({
+        'ClientID': client_id,
+        'ReferralDate': format_days(referral_day),
+        'ReferralDischarge': format_days(discharge_day),
+        'ReferralSource': source,
+        'WardTeam': np.char.add('Team ',
+                                rng.integers(1, 40, size = n).astype(str)),
+        'GenSpecialty': rng.choice(GEN_SPECIALTIES, size = n),
+        'ICD10': icd10,
+        'Desc': desc,
+        'Cluster': rng.choice([7.0, 8.0, np.nan], size = n),
+        'Setting': setting,
+        'Locality': locality,
+        'GenSpecialty_Age': 'Adult',
+        'date_of_birth': format_days(birth_day),
+        'ReferralRequest': format_days(request_day),
+        'daily_cost': daily_cost,
+        'number_contacts': rng.integers(0, MAX_CONTACTS + 1, size = n)})
+
+    # Contacts: between the referral and the discharge (or 18/02/2018)
+    end_day = np.fmin(discharge_day, last_day)
+    for j in range(MAX_CONTACTS):
+        has_contact = df['number_contacts'].to_numpy() > j
+        contact_day = np.floor(referral_day + rng.random(n) *
+                               (end_day - referral_day + 1))
+        contact_day[~has_contact] = np.nan
+        contact_type = rng.integers(0, 2, size = n).astype(float)
+        contact_type[~has_contact] = np.nan
+        df[f"contact_date_{j+1}"] = format_days(contact_day)
+        df[f"contact_type_{j+1}"] = contact_type
+
+    df['OOABedType'] = bedtype
+    return df
+
+# %% [markdown]
+# ## Main code
+
+# %%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Generate a synthetic "
+                                     "Carenotes extract")
+    parser.add_argument('filename', help = "csv file to write")
+    parser.add_argument('--clients', type = int, default = 1000,
+                        help = "number of clients (default 1000)")
+    parser.add_argument('--episodes-per-client', type = int, default = 6,
+                        help = "mean number of episodes per client "
+                               "(default 6)")
+    parser.add_argument('--max-contacts', type = int, default = 4,
+                        help = "maximum number of contacts per episode "
+                               "(default 4)")
+    parser.add_argument('--seed', type = int, default = 0,
+                        help = "random seed (default 0)")
+    args = parser.parse_args()
+
+    DATA = generate_carenotes(args.clients, args.episodes_per_client,
+                              args.max_contacts, args.seed)
+    DATA.to_csv(args.filename, index = False)
+    print(f"{len(DATA)} episodes for {args.clients} clients written to "
+          f"{args.filename}")
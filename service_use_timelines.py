@@ -32,15 +32,33 @@
 # We will also use the libraries: numpy, pandas and datetime to manipulate our data to be in the right format for matplotlib.
 # 
 # Let's import our libraries
+#
+# matplotlib is imported by the functions that draw the charts, when they are 
+# first used, rather than here. Importing matplotlib (and choosing a backend to
+# show the charts with) takes longer than reading and preparing a small input 
+# file, and is not needed to prepare or export the data (see export_data.py).
 
 # %%
 import numpy as np
 import pandas as pd
 import datetime as dt
-import matplotlib.pyplot as plt
-import matplotlib.dates
-from matplotlib.dates import MONTHLY, DateFormatter, rrulewrapper, RRuleLocator
+from collections import namedtuple
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor, 
+                                ThreadPoolExecutor, wait)
+from xml.sax.saxutils import escape
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import sqlite3
 import sys
+import threading
+import time
+import tracemalloc
 
 # %% [markdown]
 ## Definitions of terms
@@ -75,6 +93,10 @@ import sys
 #*contact_type_3*: Type of third individual contact with service (0 = face-to-face, 1 = not face-to-face)<br>
 #*contact_date_4*: Date of fourth individual contact with service<br>
 #*contact_type_4*: Type of fourth individual contact with service (0 = face-to-face, 1 = not face-to-face)
+#
+#The file can contain any number of contact_date_N and contact_type_N columns. 
+#The contacts are moved into a separate, long, table with one row per contact 
+#(see create_contact_table).
 # %%
 
 # %% [markdown]
@@ -106,42 +128,103 @@ def add_string_counter_column(df):
 
     return df
 
+# %% [markdown]
+# ## Colour lookup tables
+# 
+# The colours used for the bars, the y axis labels and the contacts. Each 
+# table maps a category to a colour, and can be edited to add categories or 
+# change the colours. The *_PICU tables replace the colour of a category for 
+# the episodes with a PICU bed type (or PICU general specialty for the bars).
+# SERVICE_COLOURS are the colours of the service groups of the population 
+# timeline.
+# A category that is not in a table is shown in FALLBACK_COLOUR.
+
+# %%
+BAR_COLOURS = {'OOA': 'red', 
+               'Community': 'green', 
+               'Inpatient': 'orange', 
+               'Other local beds': 'lightgreen'}
+BAR_COLOURS_PICU = {'OOA': 'maroon'}
+SERVICE_COLOURS = {**BAR_COLOURS, 'PICU': 'maroon'}
+
+YTICK_COLOURS = {'Out-of-Area': 'red', 
+                 'Locality 1': 'indigo',
+                 'Locality 2': 'dodgerblue', 
+                 'Locality 3': 'navy', 
+                 'Whole County': 'mediumpurple'}
+YTICK_COLOURS_PICU = {'Out-of-Area': 'maroon'}
+
+CONTACT_TYPE_COLOURS = {0: 'black',      # direct (face-to-face / telephone)
+                        1: 'lightgray'}  # indirect (letter / email)
+
+FALLBACK_COLOUR = 'gray'
+
+# %% [markdown]
+# ## Define function: map_categories_to_colours
+# 
+# Convert the values to categorical codes (the position of the value in the 
+# lookup table, or -1 if it is not in the table) and use the codes to index an
+# array of the colours, with FALLBACK_COLOUR as the last element.
+
+# %%
+def map_categories_to_colours(values, colours):
+    """
+    Pass a pandas series or array of categories (values) and a dictionary of 
+    category: colour (colours). Return a numpy array with the colour of each 
+    value
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(colours, dict):
+        raise TypeError (f"function {function_name}: "
+                         f"colours must be a dictionary")
+
+############################### Function ######################################
+
+    codes = pd.Categorical(np.asarray(values), 
+                           categories = list(colours)).codes
+    lookup = np.array(list(colours.values()) + [FALLBACK_COLOUR], 
+                      dtype = object)
+    return lookup[codes]
+
 # %% [markdown]
 # ## Define function: assign_colour_to_bar
 
 # %%
 def assign_colour_to_bar(setting, bedtype, genspecialty):
     """
-    Based on the value of the three passed in strings, return a colour
+    Pass three pandas series: setting, bedtype and genspecialty. Return a numpy
+    array with the bar colour of each episode, based on setting (and PICU)
     """   
 ############################# Argument checking ###############################
     function_name = sys._getframe(  ).f_code.co_name
 
-    if not isinstance(setting, str):#(pd.core.series.Series)):
+    if not isinstance(setting, (pd.core.series.Series)):
         raise TypeError (f"function {function_name}: "
-                         f"setting must be a string")
+                         f"setting must be a pandas series")
 
-    if not isinstance(bedtype, (str, float)):# (pd.core.series.Series)):
+    if not isinstance(bedtype, (pd.core.series.Series)):
+        raise TypeError (f"function {function_name}: "
+                         f"bedtype must be a pandas series")
+
+    if not isinstance(genspecialty, (pd.core.series.Series)):
         raise TypeError (f"function {function_name}: "
-                         f"bedtype must be a string, or nan")
+                         f"genspecialty must be a pandas series")
 
-    if not isinstance(genspecialty, (str, float)):# (pd.core.series.Series)):
+    if not setting.shape == bedtype.shape == genspecialty.shape:
         raise TypeError (f"function {function_name}: "
-                         f"genspecialty must be a string, or nan")
+                         f"setting, bedtype and genspecialty must be the "
+                         f"same shape")
 
 ############################### Function ######################################
-    if setting == 'OOA':
-        if bedtype == 'PICU' or genspecialty == 'PICU':
-            colour = 'maroon'
-        else:
-            colour = 'red'
-    elif setting == 'Community':
-        colour='green'
-    elif setting == 'Inpatient':
-        colour='orange'
-    elif setting == 'Other local beds':
-        colour='lightgreen'
-    return colour
+    is_picu = ((bedtype.to_numpy() == 'PICU') | 
+               (genspecialty.to_numpy() == 'PICU'))
+    return np.where(is_picu, 
+                    map_categories_to_colours(setting, 
+                                              {**BAR_COLOURS, 
+                                               **BAR_COLOURS_PICU}),
+                    map_categories_to_colours(setting, BAR_COLOURS))
 
 # %% [markdown]
 # ## Define function: assign_colour_to_contact_type
@@ -149,25 +232,51 @@ def assign_colour_to_bar(setting, bedtype, genspecialty):
 # 
 
 # %%
-def assign_colour_to_contact_type(category):
+def assign_colour_to_contact_type(contact_type):
     """
-    Based on the value of category, return a colour
+    Pass an array of contact types. Return a numpy array with the colour of 
+    each contact
     """
 ############################# Argument checking ###############################
     function_name = sys._getframe(  ).f_code.co_name
 
-    if (type(category) not in [int, np.int64, np.float64]):
+    if not isinstance(contact_type, (np.ndarray, pd.core.series.Series)):
         raise TypeError (f"function {function_name}: "
-                         f"category must be a non-negative integer")
+                         f"contact_type must be a numpy array or pandas "
+                         f"series")
 
 ############################### Function ######################################
     
-    if category == 0:
-        colour='black'#direct (face-to-face / telephone)
-    elif category == 1:
-        colour = 'lightgray'#indirect (letter / email)
+    return map_categories_to_colours(contact_type, CONTACT_TYPE_COLOURS)
+
+# %% [markdown]
+# ## Define function: assign_service_group
+# 
+# The service group of each episode, for the population timeline: the setting,
+# or 'PICU' for the episodes in a PICU bed (or PICU general specialty).
 
-    return colour
+# %%
+def assign_service_group(setting, bedtype, genspecialty):
+    """
+    Pass three pandas series: setting, bedtype and genspecialty. Return a numpy
+    array with the service group of each episode
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(setting, (pd.core.series.Series)):
+        raise TypeError (f"function {function_name}: "
+                         f"setting must be a pandas series")
+
+    if not setting.shape == bedtype.shape == genspecialty.shape:
+        raise TypeError (f"function {function_name}: "
+                         f"setting, bedtype and genspecialty must be the "
+                         f"same shape")
+
+############################### Function ######################################
+    is_picu = ((bedtype.to_numpy() == 'PICU') | 
+               (genspecialty.to_numpy() == 'PICU'))
+    return np.where(is_picu, 'PICU', setting.to_numpy(dtype = object))
 
 # %% [markdown]
 # ## Define function: assign_colour_to_ytick
@@ -177,8 +286,8 @@ def assign_colour_to_contact_type(category):
 def assign_colour_to_ytick(locality, bedtype):
     """
     Pass two pandas series: locality and bedtype. Both contain categorical
-    values, and the values of each determine the colour to be appended to a 
-    list (an element for each element).
+    values, and the values of each determine the colour of each y axis label.
+    Return a numpy array of the colours
     """
 ############################# Argument checking ###############################
     function_name = sys._getframe(  ).f_code.co_name
@@ -196,24 +305,59 @@ def assign_colour_to_ytick(locality, bedtype):
                          f"bedtype and locality must be the same shape")
 
 ############################### Function ######################################
-    ytickcolour = []
-    for i in range(len(locality)):
-        if locality.iloc[i] == 'Out-of-Area':
-            if bedtype.iloc[i] == 'PICU':
-                ytickcolour.append('maroon')
-            else:
-                ytickcolour.append('red')
+    is_picu = bedtype.to_numpy() == 'PICU'
+    return np.where(is_picu, 
+                    map_categories_to_colours(locality, 
+                                              {**YTICK_COLOURS, 
+                                               **YTICK_COLOURS_PICU}),
+                    map_categories_to_colours(locality, YTICK_COLOURS))
+
+
+# %% [markdown]
+# ## Define function: calculate_episode_cost
+# 
+# Calculate the length of stay of each episode (los_days) and remove the 
+# episodes with a negative length of stay. The cost of the episode is the 
+# length of stay multiplied by the daily cost, with ZERO_LOS_REPLACEMENT used
+# as the length of stay for episodes that start and end on the same day.
+
+# %%
+def calculate_episode_cost(df, KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT):
+    """
+    Calculate the length of stay and service use cost of each episode
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if (type(ZERO_LOS_REPLACEMENT) not in [int, float]):
+        raise TypeError (f"function {function_name}: "
+                         f"ZERO_LOS_REPLACEMENT must be a number")
+
+############################### Function ######################################
+
+    # Calculate length of stay
+    df['los_days']=df.ReferralDischarge_format-df.ReferralDate_format
+    df.los_days=(df.ReferralDischarge_format-
+                 df.ReferralDate_format).astype('timedelta64[D]')
+    # Remove episodes with negative LoS (a copy, as the caller still holds 
+    # the full dataframe)
+    df = df[df.los_days >= 0].copy()
 
-        elif locality.iloc[i] == 'Locality 1':
-            ytickcolour.append('indigo')#slateblue')
-        elif locality.iloc[i] == 'Locality 2':
-            ytickcolour.append('dodgerblue')
-        elif locality.iloc[i] == 'Locality 3':
-            ytickcolour.append('navy')#'rebeccapurple')
-        elif locality.iloc[i] == 'Whole County':
-            ytickcolour.append('mediumpurple')
-    return ytickcolour
+    # Calculate service use cost
+    los_days = df.los_days.values
+    daily_cost = np.array(df.daily_cost.values,dtype=float)
+    mask = df.los_days == 0
+    los_days[mask] = ZERO_LOS_REPLACEMENT
+    df['Episode_cost'] = los_days * daily_cost
+    df.Episode_cost = df.Episode_cost.astype(int)
+    # Depending on user defined boolean, remove admissions with no cost
+    df = edit_cost_data(df, KEEP_MISSING_COST)
 
+    return df
 
 # %% [markdown]
 # ## Define function: calculate_mdate
@@ -224,8 +368,9 @@ def assign_colour_to_ytick(locality, bedtype):
 #
 # If the new column name already exists then it will not be recalculated.
 #
-# This is the most computationally intensive part of the code. 
-# If working with a large file, better to create and store this column.
+# The whole column is converted in one pass (see 
+# convert_dates_to_matplotlibDates), reusing the datetime column created by 
+# format_date_variables when it exists.
 
 
 # %%
@@ -249,13 +394,114 @@ def calculate_mdate(df, column_name):
     
     for i in range(len(column_name)):
         if not df.columns.str.contains(f"{column_name[i]}_mdate").any():
-            mdate = df[f"{column_name[i]}"].copy(deep = True)
-            for j in range(mdate.shape[0]):
-                mdate.iloc[j] = (convert_date_to_matplotlibDate(mdate.iloc[j]))
-            df[f"{column_name[i]}_mdate"] = mdate
+            # Reuse the datetime column from format_date_variables if present
+            if f"{column_name[i]}_format" in df.columns:
+                dates = df[f"{column_name[i]}_format"]
+            else:
+                dates = df[f"{column_name[i]}"]
+            df[f"{column_name[i]}_mdate"] = (
+                                    convert_dates_to_matplotlibDates(dates))
             
     return df
        
+# %% [markdown]
+# ## Define function: calculate_population_occupancy
+# 
+# For the whole population in df, the number of clients in each service 
+# (occupancy) and the spend on each service on each day from start_date up to
+# (not including) end_date (dd/mm/yyyy), the date the data was extracted. 
+# POPULATION_GROUP is the column the services are grouped by: 'Setting', 
+# 'Locality' or 'Service' (the setting, with the PICU episodes as their own 
+# 'PICU' group, see assign_service_group).
+#
+# An episode is in its service from its referral date up to (not including) 
+# its discharge date. An episode that starts and ends on the same day counts 
+# on that day.
+#
+# Each episode adds one to the count on its first day and takes one away on 
+# the day after its last day (a difference array), and a cumulative sum over 
+# the days gives the count on each day. This needs a single pass over the 
+# episodes, whatever their length. The spend is calculated in the same way, 
+# with the daily cost in place of one. Before counting the clients, the 
+# overlapping episodes of a client in the same group are merged, so a client 
+# is only counted once on each day.
+
+# %%
+def calculate_population_occupancy(df, POPULATION_GROUP, start_date, 
+                                   end_date):
+    """
+    Return two pandas dataframes, with a row for each day from start_date up 
+    to end_date and a column for each group: the number of clients, and the 
+    spend (sum of the daily costs) of the open episodes
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if POPULATION_GROUP not in ['Service', 'Setting', 'Locality']:
+        raise ValueError (f"function {function_name}: "
+                          f"POPULATION_GROUP must be 'Service', 'Setting' or "
+                          f"'Locality'")
+
+############################### Function ######################################
+
+    first_day = convert_date_to_matplotlibDate(start_date)
+    n_days = int(convert_date_to_matplotlibDate(end_date) - first_day)
+
+    if POPULATION_GROUP == 'Service':
+        group = assign_service_group(df['Setting'], df['OOABedType'], 
+                                     df['GenSpecialty'])
+    else:
+        group = df[POPULATION_GROUP].to_numpy()
+    codes, groups = pd.factorize(group, sort = True)
+
+    # The days in the window (0 to n_days) of the start of each episode, and 
+    # of the day after its last day. Episodes outside the window are empty
+    start = df['ReferralDate_mdate'].to_numpy(dtype = float) - first_day
+    end = np.maximum(df['ReferralDischarge_mdate'].to_numpy(dtype = float) - 
+                     first_day, start + 1)
+    keep = (codes >= 0) & ~np.isnan(start) & ~np.isnan(end)
+    start = np.clip(start[keep], 0, n_days).astype(np.int64)
+    end = np.clip(end[keep], 0, n_days).astype(np.int64)
+    codes = codes[keep]
+    daily_cost = df['daily_cost'].to_numpy(dtype = float)[keep]
+    client = df['ClientID'].to_numpy()[keep]
+
+    def count_per_day(codes, start, end, weight):
+        # Difference array (one row per group) summed along the days
+        size = len(groups) * (n_days + 1)
+        change = (np.bincount(codes * (n_days + 1) + start, weight, size) - 
+                  np.bincount(codes * (n_days + 1) + end, weight, size))
+        return np.cumsum(change.reshape(len(groups), n_days + 1), 
+                         axis = 1)[:, :n_days]
+
+    spend = count_per_day(codes, start, end, daily_cost)
+
+    # Merge the overlapping episodes of each client in each group: sorted by
+    # client, group and start, an episode starts a new stay unless it starts
+    # before the latest end of the earlier episodes of the stay
+    order = np.lexsort((start, codes, client))
+    client, codes, start, end = (client[order], codes[order], start[order], 
+                                 end[order])
+    same = (client[1:] == client[:-1]) & (codes[1:] == codes[:-1])
+    latest_end = pd.Series(end).groupby(
+                np.cumsum(np.r_[True, ~same][:len(end)])).cummax().to_numpy()
+    new_stay = np.r_[True, ~same | (start[1:] > latest_end[:-1])][:len(end)]
+    stay_start = np.flatnonzero(new_stay)
+    stay_end = (np.maximum.reduceat(end, stay_start) if len(start) > 0 
+                else end)
+    occupancy = count_per_day(codes[stay_start], start[stay_start], stay_end,
+                              np.ones(len(stay_start)))
+
+    days = pd.date_range(pd.to_datetime(start_date, format = "%d/%m/%Y"), 
+                         periods = n_days, freq = 'D', name = 'date')
+    return (pd.DataFrame(occupancy.T.round().astype(np.int64), index = days,
+                         columns = groups),
+            pd.DataFrame(spend.T, index = days, columns = groups))
+
 # %% [markdown]
 # ## Define function: check_variables_all_present
 
@@ -298,16 +544,204 @@ def check_columns_present_and_type(df, COLUMNS_REQUIRED, COLUMNS_DTYPE):
     
     return
 
+# %% [markdown]
+# ## Define function: clean_data
+# 
+# Clean the data read from the input file and calculate the length of stay 
+# and service use cost of each episode, with the same result as the separate 
+# steps (replace_nan_values, remove_nan_values, format_date_variables, 
+# calculate_episode_cost and edit_cost_data), but in one pass over the 
+# columns:
+# - the missing values of REPLACE_NAN_COLUMNS are replaced and the dates 
+#   (CLEAN_DATE_COLUMNS) converted to datetimes (*_format), one column at a 
+#   time
+# - the length of stay (los_days) and cost (Episode_cost) are calculated from
+#   these columns
+# - a single mask selects the episodes kept: those with a ReferralDate (not 
+#   missing or "None"), a length of stay that is not negative and, unless 
+#   KEEP_MISSING_COST, a cost
+# - the kept rows of each column are copied once into the new DataFrame
+#
+# The DataFrame passed in is not changed. As in calculate_episode_cost, 
+# los_days holds the length of stay used for the cost (ZERO_LOS_REPLACEMENT 
+# for the episodes that start and end on the same day).
+
+# %%
+CLEAN_DATE_COLUMNS = ["ReferralRequest", "ReferralDate", 
+                      "ReferralDischarge", "date_of_birth"]
+
+def clean_data(df, KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT, 
+               REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES):
+    """
+    Return a cleaned copy of the dataframe, with the datetimes, length of stay
+    and service use cost of each episode
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if (type(KEEP_MISSING_COST) not in [bool]):
+        raise TypeError (f"function {function_name}: "
+                         f"KEEP_MISSING_COST must be a boolean")
+
+    if (type(ZERO_LOS_REPLACEMENT) not in [int, float]):
+        raise TypeError (f"function {function_name}: "
+                         f"ZERO_LOS_REPLACEMENT must be a number")
+
+    if not isinstance(REPLACE_NAN_COLUMNS, list):
+        raise TypeError (f"function {function_name}: "
+                         f"REPLACE_NAN_COLUMNS must be a list")
+
+    if not isinstance(REPLACE_NAN_VALUES, list):
+        raise TypeError (f"function {function_name}: "
+                         f"REPLACE_NAN_VALUES must be a list")
+
+############################### Function ######################################
+
+    # Replace missing values (np.nan) with appropriate values
+    replaced = {column: df[column].fillna(value) 
+                for column, value in zip(REPLACE_NAN_COLUMNS, 
+                                         REPLACE_NAN_VALUES)}
+
+    # Episodes with a ReferralDate
+    referral_date = replaced.get("ReferralDate", df["ReferralDate"])
+    keep = (referral_date.notna() & (referral_date != "None")).to_numpy()
+
+    # Format date variables (of the episodes with a ReferralDate only, as an 
+    # episode removed may have a date that cannot be read)
+    dates = {}
+    for column in CLEAN_DATE_COLUMNS:
+        values = replaced.get(column, df[column])
+        if not keep.all():
+            values = values.where(keep)
+        dates[f"{column}_format"] = pd.to_datetime(values, format="%d/%m/%Y")
+
+    # Calculate length of stay, and remove episodes with a negative (or 
+    # missing) length of stay
+    los_days = ((dates["ReferralDischarge_format"] - 
+                 dates["ReferralDate_format"]).to_numpy() / 
+                np.timedelta64(1, 'D'))
+    with np.errstate(invalid = 'ignore'):
+        rows = np.flatnonzero(keep & (los_days >= 0))
+    los_days = los_days[rows]
+
+    # Calculate service use cost
+    los_days[los_days == 0] = ZERO_LOS_REPLACEMENT
+    episode_cost = (los_days * 
+                    df["daily_cost"].to_numpy(dtype = float)[rows]
+                    ).astype(int)
+
+    # Depending on user defined boolean, remove admissions with no cost
+    if KEEP_MISSING_COST:
+        no_cost = episode_cost == 0
+        if no_cost.any():
+            episode_cost = episode_cost.astype(object)
+            episode_cost[no_cost] = 'Not available'
+    else:
+        has_cost = episode_cost > 0
+        rows = rows[has_cost]
+        los_days = los_days[has_cost]
+        episode_cost = episode_cost[has_cost]
+
+    # Copy the rows kept, the only copy of the whole table
+    cleaned = df.take(rows)
+    for column, values in {**replaced, **dates}.items():
+        cleaned[column] = values.array.take(rows)
+    cleaned['los_days'] = los_days
+    cleaned['Episode_cost'] = episode_cost
+    return cleaned
+
+# %% [markdown]
+# ## Define function: compact_data
+# 
+# Reduce the memory used by the prepared data (see COMPACT_DATA), so that a 
+# large input file fits in memory:
+# - the text columns with few distinct values (COMPACT_CATEGORY_COLUMNS) are 
+#   stored as categoricals: one small integer code per episode instead of a 
+#   Python string
+# - each date is only kept as its matplotlib date (the day number, 
+#   *_mdate): the text and datetime columns of the dates are removed
+# - the numbers are stored in smaller types (for example the contact type as 
+#   int8, with -1 for a missing type), unless a value does not fit in the 
+#   smaller type (a large ClientID, or the cost of a long episode), when the
+#   column is kept as int64
+#
+# The y axis labels are built from these columns when the timeline is created
+# (render_client_timeline), so no per-episode text is stored.
+
+# %%
+COMPACT_CATEGORY_COLUMNS = ["WardTeam", "Setting", "Locality", "GenSpecialty",
+                            "ReferralSource", "OOABedType", "ICD10", "Desc",
+                            "GenSpecialty_Age"]
+
+def compact_data(df, contacts):
+    """
+    Pass the episodes and contact table returned by prepare_data. Return them 
+    stored in compact types
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(contacts, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"contacts must be a pandas dataframe")
+
+############################### Function ######################################
+
+    dates = ["ReferralRequest", "ReferralDate", "ReferralDischarge", 
+             "date_of_birth"]
+    df = df.drop(columns = [column for date in dates 
+                            for column in [date, f"{date}_format"] 
+                            if column in df.columns])
+    columns = {column: df[column].astype('category') 
+               for column in COMPACT_CATEGORY_COLUMNS if column in df.columns}
+    def downcast(values, dtype):
+        # The smaller integer type, or int64 if a value does not fit in it
+        limits = np.iinfo(dtype)
+        if len(values) > 0 and (values.min() < limits.min or 
+                                values.max() > limits.max):
+            dtype = np.int64
+        return values.astype(dtype)
+
+    columns.update({
+        'ClientID': downcast(df['ClientID'], np.int32),
+        'daily_cost': downcast(df['daily_cost'], np.int32),
+        'number_contacts': downcast(df['number_contacts'], np.int16),
+        'los_days': df['los_days'].astype(np.float32),
+        # A missing cost ("Not available") is stored as 0
+        'Episode_cost': downcast(df['Episode_cost'].replace('Not available', 
+                                                            0)
+                                 .astype(np.int64), np.int32)})
+    df = df.assign(**columns)
+
+    contacts = contacts.assign(
+        ClientID = downcast(contacts['ClientID'], np.int32),
+        episode = downcast(contacts['episode'], np.int32),
+        contact_type = downcast(contacts['contact_type'].fillna(-1), 
+                                np.int8))
+    return df, contacts
+
 # %% [markdown]
 # ## Define function: convert_datetime_to_matplotlib_date
 # 
 # Pass a date in dd/mm/yyyy format, return a date in matplotlib date format
 #     
-# date2num() convert datetime objects to a matplotlib date.   
-# 
-# A Matplotlib date is an integer representing the count of days from 01/01/0001 (using the Gregorian calendar).  For example 18/02/2018 has an mdate of 736743, so that's the number of days since 01/01/0001.
+# A Matplotlib date is a number representing the count of days from 
+# 01/01/1970 (matplotlib's default epoch, see matplotlib.dates.get_epoch; 
+# using the Gregorian calendar).  For example 18/02/2018 has an mdate of 
+# 17580, so that's the number of days since 01/01/1970. This is the number 
+# matplotlib.dates.date2num() returns, calculated without importing matplotlib.
 
 # %%
+MATPLOTLIB_EPOCH = np.datetime64('1970-01-01T00:00:00', 's')
+
 def convert_date_to_matplotlibDate(datetxt):
     """
     Creates the date in matplotlib date format
@@ -325,28 +759,96 @@ def convert_date_to_matplotlibDate(datetxt):
 ############################### Function ######################################
    
     day,month,year = datetxt.split('/')
-    date = dt.datetime(int(year), int(month), int(day))
-    mdate = matplotlib.dates.date2num(date) 
+    date = np.datetime64(dt.datetime(int(year), int(month), int(day)), 's')
+    mdate = (date - MATPLOTLIB_EPOCH) / np.timedelta64(1, 'D')
     return mdate
 
 # %% [markdown]
-# ## Define function: create_timeline
+# ## Define function: convert_dates_to_matplotlibDates
 # 
-# This function creates a service use timeline using data for a single client 
-# (df) and the matplotlib library. 
-# It extends the code as provided here: 
-#https://sukhbinder.wordpress.com/2016/05/10/quick-gantt-chart-with-matplotlib/
+# The vectorised version of convert_date_to_matplotlibDate. Pass a whole 
+# column of dates (either datetime, or strings in dd/mm/yyyy format), return 
+# an array of dates in matplotlib date format.
+#
+# Missing dates (np.nan or NaT) are returned as np.nan.
+
+# %%
+def convert_dates_to_matplotlibDates(dates):
+    """
+    Creates the dates in matplotlib date format
+    Pass a pandas series of datetimes, or of dates in dd/mm/yyyy format, 
+    return a float64 numpy array of dates in numerical format
+    """
+
+############################# Argument checking ###############################
+
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(dates, (pd.core.series.Series)):
+        raise TypeError (f"function {function_name}: "
+                         f"dates must be a pandas series")
+
+############################### Function ######################################
+
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates, format="%d/%m/%Y")
+    # Missing dates (NaT) give np.nan
+    mdate = ((dates.to_numpy(dtype="datetime64[ns]") - MATPLOTLIB_EPOCH) / 
+             np.timedelta64(1, 'D'))
+    return np.asarray(mdate, dtype=np.float64)
+
+# %% [markdown]
+# ## Define function: create_client_index
 # 
-# The matplotlib graphic is saved in a svg format
+# Rather than search the whole DataFrame for the episodes of each client, the 
+# DataFrame is sorted on ClientID once, and the position of the first and last 
+# episode of each client is stored. The episodes for a client are then a slice
+# of the sorted DataFrame (see get_client_data).
+#
+# The sort keeps the episodes of a client in the order they are in the file.
 
 # %%
-def create_service_use_timeline(df, FOLDER):
+def create_client_index(df):
     """
-    Pass pandas dataframe containing the data for a single chart (df)
-    Format the plot
-    The matplotlib graphic is saved in a svg format
+    Sort the dataframe on ClientID. Return the sorted dataframe, and a 
+    dictionary of ClientID: (start, stop) row positions of the client's 
+    episodes
     """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
 
+############################### Function ######################################
+
+    df = df.sort_values(['ClientID'], kind = 'mergesort')
+    client_ids, start, count = np.unique(df.ClientID.to_numpy(), 
+                                         return_index = True, 
+                                         return_counts = True)
+    client_index = dict(zip(client_ids.tolist(), 
+                            zip(start.tolist(), (start + count).tolist())))
+    return df, client_index
+
+# %% [markdown]
+# ## Define function: create_client_overview
+# 
+# Draw a client's timeline at reduced detail on one of the axes of a page of
+# small multiples (see render_timelines_to_pdf): the service use and waiting
+# bars, and the contacts as small dots, with the client ID as the title and
+# the years on the x axis. There are no y axis labels, age axis or footnotes,
+# so many clients can be compared on a page.
+#
+# df is the client's data sorted by sort_data.
+
+# %%
+def create_client_overview(ax, df, contacts):
+    """
+    Pass a matplotlib axes, pandas dataframe containing the sorted data for a
+    single client (df), and the contact table for the same client (contacts).
+    Draw the timeline on the axes
+    """
 ############################# Argument checking ###############################
     function_name = sys._getframe(  ).f_code.co_name
 
@@ -354,111 +856,681 @@ def create_service_use_timeline(df, FOLDER):
         raise TypeError (f"function {function_name}: "
                          f"df must be a pandas dataframe")
 
-    if not isinstance(FOLDER, str):#(pd.core.series.Series)):
+############################### Function ######################################
+    from matplotlib.collections import PolyCollection
+    from matplotlib.dates import DateFormatter, YearLocator
+
+    ilen = len(df)
+    pos = np.arange(0.5, ilen * 0.5 + 0.5, 0.5)
+    req_date = df['ReferralRequest_mdate'].to_numpy(dtype = float)
+    start_date = df['ReferralDate_mdate'].to_numpy(dtype = float)
+    end_date = df['ReferralDischarge_mdate'].to_numpy(dtype = float)
+
+    colour = assign_colour_to_bar(df['Setting'], df['OOABedType'], 
+                                  df['GenSpecialty'])
+    ax.add_collection(PolyCollection(
+                            create_bar_vertices(pos, start_date, end_date, 
+                                                0.3),
+                            facecolors = colour, edgecolors = colour, 
+                            linewidths = 0.5, alpha = 0.8))
+    ax.add_collection(PolyCollection(
+                            create_bar_vertices(pos, req_date, start_date, 
+                                                0.3),
+                            facecolors = 'lightgray', edgecolors = 'lightgray',
+                            linewidths = 0.5))
+
+    contact_mdate, contact_pos, contact_type = get_contact_points(df, contacts,
+                                                                  pos)
+    ax.scatter(contact_mdate, contact_pos, s = 1, 
+               c = assign_colour_to_contact_type(contact_type), marker = '.', 
+               linewidths = 0, zorder = 2)
+
+    ax.xaxis_date()
+    ax.xaxis.set_major_locator(YearLocator())
+    ax.xaxis.set_major_formatter(DateFormatter("%Y"))
+    ax.set_xlim(xmin = convert_date_to_matplotlibDate('01/01/2015'), 
+                xmax = convert_date_to_matplotlibDate('18/02/2018'))
+    ax.set_ylim(ymin = -0.1, ymax = ilen * 0.5 + 0.5)
+    ax.invert_yaxis()
+    ax.set_yticks([])
+    ax.tick_params(labelsize = 6)
+    ax.set_title(f'Client ID {str(df.ClientID.iloc[0])} '
+                 f'({ilen} episodes, ICD10: {str(df.ICD10.iloc[0])})',
+                 fontsize = 7)
+    ax.grid(color = 'g', linestyle = ':', linewidth = 0.5)
+    ax.set_axisbelow(True)
+    return
+
+# %% [markdown]
+# ## Define function: create_bar_vertices
+# 
+# Return the corners of a horizontal bar for each episode, to draw all the bars 
+# of a timeline as a single matplotlib collection (rather than one bar at a 
+# time). The bar is centred on pos, and spans from left to right.
+
+# %%
+def create_bar_vertices(pos, left, right, height):
+    """
+    Pass numpy arrays of the y position, start and end of each bar.
+    Return an array of shape (number of bars, 4, 2) of the bar corners
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not (len(pos) == len(left) == len(right)):
         raise TypeError (f"function {function_name}: "
-                         f"FOLDER must be a string")
+                         f"pos, left and right must be the same length")
+
 ############################### Function ######################################
-#1. set up the variables for the timeline chart
-    ylabels = df['ylabel']
-    setting = df['Setting']
-    locality = df['Locality']
-    bedtype = df['OOABedType']
-    genspecialty = df['GenSpecialty']
-    customDates = []
 
-#3. Go through each episode and store the three dates to create the bar
-    for i in range(len(df.ReferralDischarge)):
-        customDates.append([df['ReferralRequest_mdate'].iloc[i],
-                            df['ReferralDate_mdate'].iloc[i],
-                            df['ReferralDischarge_mdate'].iloc[i]])
+    pos = np.asarray(pos, dtype = float)
+    bottom = pos - height / 2
+    top = pos + height / 2
+    vertices = np.empty((len(pos), 4, 2))
+    vertices[:, :, 0] = np.column_stack([left, left, right, right])
+    vertices[:, :, 1] = np.column_stack([bottom, top, top, bottom])
+    return vertices
 
-#4. Main code for the timeline
-    ilen = len(ylabels)
-    pos = np.arange(0.5, ilen * 0.5 + 0.5, 0.5)
-    task_dates = {}
+# %% [markdown]
+# ## Define function: create_contact_table
+# 
+# The contacts are stored in the input file as pairs of columns 
+# (contact_date_N, contact_type_N), with number_contacts giving how many of 
+# them are used by each episode. Any number of pairs of columns is accepted.
+#
+# This function moves the contacts into a long table with one row per contact:
+# ClientID, episode (the index of the episode in df), contact_mdate (the date 
+# in matplotlib date format) and contact_type. All of the contact dates are 
+# converted in one pass. The contact columns are removed from df.
 
-    for i, task in enumerate(ylabels):
-    #For each episode, assign the dates
-        task_dates[task] = customDates[i]
+# %%
+def create_contact_table(df):
+    """
+    Pass a pandas dataframe with contact_date_N and contact_type_N columns.
+    Return the dataframe without the contact columns, and the contact table
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
 
-    #Set size of graphic (Width is constant, height is based on ilen)
-    fig = plt.figure(figsize=(20, 0.4 * ilen))
-    ax1 = fig.add_subplot(111)
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
 
-    #For each episode of service use
-    for i in range(len(ylabels)):
-        #Get the dates
-        req_date, start_date, end_date = task_dates[ylabels.iloc[i]]
-        #Allocate bar colour based on setting
-        colour = assign_colour_to_bar(setting.iloc[i], bedtype.iloc[i], 
-                                      genspecialty.iloc[i])
-        #Create the service use bar
-        ax1.barh((i * 0.5) + 0.5, end_date - start_date, left = start_date, 
-                    height = 0.3, align = 'center', edgecolor = colour, 
-                    color = colour, alpha = 0.8)
-        #Create the waiting bar (always grey)
-        ax1.barh((i * 0.5) + 0.5, 
-                 start_date - req_date, left = req_date, 
-                 height = 0.3, align = 'center', edgecolor = 'lightgray', 
-                 linewidth = 1, color = 'lightgray')#, linestyle='--')
-
-        #Add individual contacts
-        marker_size = 5
-        marker_shape = '.'
-        #For each contact for the service use
-        for j in range (df["number_contacts"].iloc[i]):
-            #Allocate point colour based on contact type
-            contact_colour = assign_colour_to_contact_type(
-                                            df[f"contact_type_{j+1}"].iloc[i])
-            #Convert date to mdate
-            mdate = convert_date_to_matplotlibDate(
-                                            df[f"contact_date_{j+1}"].iloc[i])
-            #Add the point to the timeline
-            ax1.plot(mdate,(i * 0.5) + 0.5, 
-                     color = contact_colour, 
-                     marker = marker_shape, 
-                     markersize = marker_size)
+    numbers = sorted(int(column.rsplit('_', 1)[1]) for column in df.columns 
+                     if re.fullmatch(r'contact_date_\d+', column))
+    date_columns = [f"contact_date_{number}" for number in numbers]
+    type_columns = [f"contact_type_{number}" for number in numbers]
 
-    # FORMAT BOTTOM X AXIS
-    # Bottom x axis: date           
-    # Format ticks and labels to be monthly
-    ax1.xaxis_date()
-    rule = rrulewrapper(MONTHLY, interval=1)
-    loc = RRuleLocator(rule)
-    formatter = DateFormatter("%b-%y")
-    ax1.xaxis.set_major_locator(loc)
-    ax1.xaxis.set_major_formatter(formatter)
-    labelsx = ax1.get_xticklabels()
-    plt.setp(labelsx, rotation=30, fontsize=12)
+    for column in type_columns:
+        if column not in df.columns:
+            raise ValueError (f"function {function_name}: "
+                              f"Dataframe must contain column {column}")
+        if not pd.api.types.is_numeric_dtype(df[column]):
+            raise TypeError (f"function {function_name}: "
+                             f"column {column} must be a number")
 
-    #Set x axis range to full dataset range
-    ax1.set_xlim(xmin = convert_date_to_matplotlibDate('01/01/2015'), 
-                xmax = convert_date_to_matplotlibDate('18/02/2018'))
+############################### Function ######################################
 
-    # FORMAT TOP X AXIS
-    # Add a second x axis (top): client's age
-    # Currently, this does not take into account leap years
-    ax2 = ax1.twiny()
-    ax2.set_xlabel("Client age (Years)")
-    startDate = pd.to_datetime('01/01/2015',format = "%d/%m/%Y")
-    endDate = pd.to_datetime('18/02/2018',format = "%d/%m/%Y")
-    minAge = (startDate - df.date_of_birth_format.iloc[0])
-    maxAge = (endDate - df.date_of_birth_format.iloc[0])
-    
-    # Convert timedelta to a float as want to extract the number of years
-    minAge_Yrs = ((minAge.total_seconds() / 
-                   dt.timedelta (days=1).total_seconds())/365)
-    maxAge_Yrs = ((maxAge.total_seconds() / 
-                   dt.timedelta (days=1).total_seconds())/365)
-    ax2.set_xlim(xmin = minAge_Yrs, xmax = maxAge_Yrs)
-    
-    # FORMAT Y AXIS
-    # Allocate y axis text colour based on locality
-    ytickcolour = assign_colour_to_ytick(locality, bedtype)
-    # Place text for y labels in specified position        
-    locsy, labelsy = plt.yticks(pos, ylabels)
-    
-    for ytick, color in zip(ax1.get_yticklabels(), ytickcolour):
+    # Each episode uses the first number_contacts pairs of columns. Take the
+    # (episode, contact) pairs in use, in episode order
+    has_contact = (np.array(numbers)[np.newaxis, :] <= 
+                   df['number_contacts'].to_numpy()[:, np.newaxis])
+    row, column = np.nonzero(has_contact)
+
+    contact_date = df[date_columns].to_numpy(dtype = object)[row, column]
+    contacts = pd.DataFrame({
+        'ClientID': df['ClientID'].to_numpy()[row],
+        'episode': df.index.to_numpy()[row],
+        'contact_mdate': convert_dates_to_matplotlibDates(
+                                    pd.Series(contact_date, dtype = object)),
+        'contact_type': df[type_columns].to_numpy(dtype = float)[row, column]})
+
+    df = df.drop(columns = date_columns + type_columns)
+    return df, contacts
+
+# %% [markdown]
+# ## Define function: create_episode_archive
+# 
+# Write the prepared data (episodes and contact table from prepare_data) to 
+# ARCHIVE_FOLDER as fixed width numpy arrays (.npy files), one file per 
+# column, so the episodes of any one client can be read without reading the
+# rest (see open_episode_archive and get_archived_client). The data is first 
+# stored in compact types (compact_data): the dates as day numbers, the costs 
+# and counts as small integers, and the text columns as integer codes, with 
+# the text of each code (the dictionary of the column) in archive.json. 
+#
+# The episodes and contacts are sorted on ClientID (keeping the order of each 
+# client's episodes). client_ids holds the sorted ClientIDs and, in the same 
+# order, episode_start and episode_count the first row and the number of rows
+# of each client's episodes (contact_start and contact_count likewise for the
+# contacts). A client is found with a binary search of client_ids, so the 
+# size of the archive depends on the number of clients, not on how large 
+# their ClientIDs are.
+#
+# The archive is written to a temporary folder first, and then replaces 
+# ARCHIVE_FOLDER. Increase ARCHIVE_VERSION when the layout of the archive 
+# changes.
+
+# %%
+ARCHIVE_VERSION = 2
+
+def create_episode_archive(df, contacts, ARCHIVE_FOLDER):
+    """
+    Pass the episodes and contact table returned by prepare_data, and the 
+    folder to write the archive to
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(contacts, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"contacts must be a pandas dataframe")
+
+    if not isinstance(ARCHIVE_FOLDER, str):
+        raise TypeError (f"function {function_name}: "
+                         f"ARCHIVE_FOLDER must be a string")
+
+############################### Function ######################################
+
+    df, contacts = compact_data(df, contacts)
+    df, _ = create_client_index(df)
+    contacts, _ = create_client_index(contacts)
+
+    folder = os.path.normpath(ARCHIVE_FOLDER)
+    if os.path.exists(f"{folder}.tmp"):
+        shutil.rmtree(f"{folder}.tmp")
+    os.makedirs(f"{folder}.tmp")
+
+    # Each column as an array: the numbers as they are, the categoricals and
+    # text as integer codes (-1 for a missing value) and their dictionary
+    columns = {}
+    for column in df.columns:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, categories = values.cat.codes, values.cat.categories
+            columns[column] = {'kind': 'category', 
+                               'categories': categories.tolist()}
+            values = codes
+        elif values.dtype == object:
+            codes, categories = pd.factorize(values)
+            columns[column] = {'kind': 'text', 
+                               'categories': pd.Index(categories).tolist()}
+            values = codes.astype(np.int32)
+        elif pd.api.types.is_numeric_dtype(values):
+            columns[column] = {'kind': 'number'}
+        else:
+            raise TypeError (f"function {function_name}: "
+                             f"column {column} cannot be archived")
+        np.save(os.path.join(f"{folder}.tmp", f"episode_{column}.npy"), 
+                np.asarray(values))
+    np.save(os.path.join(f"{folder}.tmp", "episode_index.npy"), 
+            df.index.to_numpy(dtype = np.int64))
+    for column in contacts.columns:
+        np.save(os.path.join(f"{folder}.tmp", f"contact_{column}.npy"), 
+                contacts[column].to_numpy())
+
+    # The sorted ClientIDs, and the first row and number of rows of each 
+    # client's episodes and contacts
+    client_ids = np.unique(df['ClientID'].to_numpy())
+    np.save(os.path.join(f"{folder}.tmp", "client_ids.npy"), client_ids)
+    for name, table in [('episode', df), ('contact', contacts)]:
+        ids = table['ClientID'].to_numpy()
+        start = np.searchsorted(ids, client_ids, side = 'left')
+        count = np.searchsorted(ids, client_ids, side = 'right') - start
+        np.save(os.path.join(f"{folder}.tmp", f"{name}_start.npy"), start)
+        np.save(os.path.join(f"{folder}.tmp", f"{name}_count.npy"), count)
+
+    with open(os.path.join(f"{folder}.tmp", "archive.json"), 'w', 
+              encoding = 'utf-8') as file:
+        json.dump({'version': ARCHIVE_VERSION, 
+                   'prepared_data_version': PREPARED_DATA_VERSION,
+                   'clients': len(client_ids), 'episodes': len(df), 
+                   'contacts': len(contacts),
+                   'episode_columns': columns, 
+                   'contact_columns': list(contacts.columns)}, 
+                  file, indent = 1)
+
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(f"{folder}.tmp", folder)
+    return
+
+# %% [markdown]
+# ## Define function: create_episode_store
+# 
+# Load the input file (FOLDER/FILENAME.csv) into a SQLite database (DATABASE),
+# so the episodes of a few clients can be read without reading the whole file
+# (see read_episode_store). The file is read CHUNK_ROWS rows at a time, and 
+# each chunk is checked (check_columns_present_and_type) as it is read. Two 
+# tables are created:
+#
+# - episodes: the columns of the input file other than the contacts, with 
+#   row_id, the row of the episode in the input file
+# - contacts: one row per contact (row_id of the episode, ClientID, number, 
+#   contact_date and contact_type), for the first number_contacts contacts of 
+#   each episode
+#
+# Both tables are indexed on ClientID. The values are stored as they are in the
+# input file (the missing values as NULL): the data is cleaned as it is read, 
+# so the store does not need to be created again when the variables change. 
+# The database is written to a temporary name first, and renamed when 
+# complete.
+
+# %%
+def create_episode_store(FOLDER, FILENAME, DATABASE, COLUMNS_REQUIRED, 
+                         COLUMNS_DTYPE, CHUNK_ROWS = 100000):
+    """
+    Load FOLDER/FILENAME.csv into the episodes and contacts tables of the 
+    SQLite database DATABASE
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(DATABASE, str):
+        raise TypeError (f"function {function_name}: "
+                         f"DATABASE must be a string")
+
+    if (type(CHUNK_ROWS) not in [int]) or CHUNK_ROWS < 1:
+        raise TypeError (f"function {function_name}: "
+                         f"CHUNK_ROWS must be a positive integer")
+
+############################### Function ######################################
+
+    filename = f"{FOLDER}{FILENAME}.csv"
+    column_types = _input_column_types(filename, COLUMNS_REQUIRED, 
+                                       COLUMNS_DTYPE)
+    numbers = sorted(int(column.rsplit('_', 1)[1]) for column in column_types
+                     if re.fullmatch(r'contact_date_\d+', column))
+    date_columns = [f"contact_date_{number}" for number in numbers]
+    type_columns = [f"contact_type_{number}" for number in numbers]
+
+    if os.path.exists(f"{DATABASE}.tmp"):
+        os.remove(f"{DATABASE}.tmp")
+    connection = sqlite3.connect(f"{DATABASE}.tmp")
+    try:
+        # A new file, renamed when complete, does not need a journal
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        episode_columns = None
+        for chunk in pd.read_csv(filename, dtype = column_types, 
+                                 chunksize = CHUNK_ROWS):
+            check_columns_present_and_type(chunk, COLUMNS_REQUIRED, 
+                                           COLUMNS_DTYPE)
+            if episode_columns is None:
+                episode_columns = [column for column in chunk.columns 
+                                   if column not in date_columns + 
+                                   type_columns]
+                column_sql = []
+                for column in episode_columns:
+                    if pd.api.types.is_integer_dtype(chunk[column]):
+                        column_sql.append(f'"{column}" INTEGER')
+                    elif pd.api.types.is_float_dtype(chunk[column]):
+                        column_sql.append(f'"{column}" REAL')
+                    else:
+                        column_sql.append(f'"{column}" TEXT')
+                connection.execute(f'CREATE TABLE episodes (row_id INTEGER '
+                                   f'PRIMARY KEY, {", ".join(column_sql)})')
+                connection.execute('CREATE TABLE contacts (row_id INTEGER, '
+                                   'ClientID INTEGER, number INTEGER, '
+                                   'contact_date TEXT, contact_type REAL)')
+                insert_episode = (f'INSERT INTO episodes VALUES (?' + 
+                                  ', ?' * len(episode_columns) + ')')
+
+            # The row of each episode is its index in the file. A missing 
+            # value (NaN) is stored as NULL
+            connection.executemany(insert_episode, 
+                                   chunk[episode_columns].astype(object)
+                                   .itertuples(name = None))
+
+            # The first number_contacts contacts of each episode, in episode 
+            # order (as create_contact_table)
+            has_contact = (np.array(numbers)[np.newaxis, :] <= 
+                           chunk['number_contacts'].to_numpy()[:, np.newaxis])
+            row, column = np.nonzero(has_contact)
+            connection.executemany(
+                    'INSERT INTO contacts VALUES (?, ?, ?, ?, ?)', 
+                    zip(chunk.index.to_numpy()[row].tolist(),
+                        chunk['ClientID'].to_numpy()[row].tolist(),
+                        np.array(numbers, dtype = int)[column].tolist(),
+                        chunk[date_columns].to_numpy(dtype = object)
+                                                        [row, column].tolist(),
+                        chunk[type_columns].to_numpy(dtype = float)
+                                                    [row, column].tolist()))
+
+        connection.execute('CREATE INDEX episodes_client ON episodes '
+                           '(ClientID, row_id)')
+        connection.execute('CREATE INDEX contacts_client ON contacts '
+                           '(ClientID, row_id, number)')
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(f"{DATABASE}.tmp", DATABASE)
+    return
+
+# %% [markdown]
+# ## Define function: create_interval_index
+#
+# Rather than search the whole DataFrame for the episodes open on a date (or
+# during a range of dates), the episodes are indexed on their dates once, and
+# each search then only looks at the part of the index that can match (see
+# query_episodes and query_clients).
+#
+# An episode is open from START_COLUMN ('ReferralDate', or 'ReferralRequest'
+# to include the wait from the referral request) up to (not including) its
+# discharge date, as in calculate_population_occupancy. An episode that starts
+# and ends on the same day is open on that day.
+#
+# The episodes are sorted on their start, so the episodes that start before the
+# end of a search are the first part of the sorted episodes (found by a binary
+# search). Of these, the ones still open at the start of the search are found
+# with a tree of the latest end in each block of BLOCK_SIZE sorted episodes:
+# each level of the tree holds the latest end of two nodes of the level below,
+# and a search only goes down the nodes whose latest end is after the start of
+# the search. A search takes a time proportional to the log of the number of
+# episodes, plus the number of episodes found.
+#
+# The index stores the positions of the episodes in df, so it must be used
+# with df as it was when the index was created (not re-sorted or filtered).
+
+# %%
+BLOCK_SIZE = 64
+
+def create_interval_index(df, START_COLUMN = 'ReferralDate'):
+    """
+    Pass a prepared dataframe (with the _mdate date columns). Return a
+    dictionary of the episode positions, starts and ends sorted on start, and
+    the tree of the latest end in each block
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if START_COLUMN not in ['ReferralDate', 'ReferralRequest']:
+        raise ValueError (f"function {function_name}: "
+                          f"START_COLUMN must be 'ReferralDate' or "
+                          f"'ReferralRequest'")
+
+############################### Function ######################################
+
+    # An episode with a missing discharge date is still open
+    start = df[f"{START_COLUMN}_mdate"].to_numpy(dtype = float)
+    end = np.maximum(np.nan_to_num(
+                        df['ReferralDischarge_mdate'].to_numpy(dtype = float),
+                        nan = np.inf), start + 1)
+    rows = np.flatnonzero(~np.isnan(start))
+    rows = rows[np.argsort(start[rows], kind = 'mergesort')]
+    start, end = start[rows], end[rows]
+
+    # Latest end of each block, then of each pair of nodes up to a single root
+    max_end = [np.maximum.reduceat(end, np.arange(0, len(end), BLOCK_SIZE))
+               if len(end) > 0 else np.full(1, -np.inf)]
+    while len(max_end[-1]) > 1:
+        level = max_end[-1]
+        if len(level) % 2 == 1:
+            level = np.r_[level, -np.inf]
+        max_end.append(np.maximum(level[0::2], level[1::2]))
+
+    return {'rows': rows, 'start': start, 'end': end, 'max_end': max_end}
+
+# %% [markdown]
+# ## Define function: create_population_timeline
+# 
+# Create a stacked timeline of the population: the number of clients in each 
+# group of services on each day (top), and the daily spend on each group 
+# (bottom), as calculated by calculate_population_occupancy. The groups use 
+# the same colours as the service use timelines (the bar colours for settings
+# and services, the y axis label colours for localities).
+#
+# The matplotlib graphic is saved in a svg format, as 
+# population_timeline_{POPULATION_GROUP}.svg, with the daily values in 
+# population_{POPULATION_GROUP}.csv. It is then shown, unless HEADLESS.
+
+# %%
+def create_population_timeline(occupancy, spend, POPULATION_GROUP, FOLDER, 
+                               HEADLESS = False):
+    """
+    Pass the occupancy and spend dataframes returned by 
+    calculate_population_occupancy. Create the stacked timeline
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(occupancy, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"occupancy must be a pandas dataframe")
+
+    if not isinstance(spend, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"spend must be a pandas dataframe")
+
+    if not isinstance(FOLDER, str):
+        raise TypeError (f"function {function_name}: "
+                         f"FOLDER must be a string")
+
+############################### Function ######################################
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib.dates import (MONTHLY, DateFormatter, rrulewrapper, 
+                                  RRuleLocator)
+
+    if POPULATION_GROUP == 'Locality':
+        colours = YTICK_COLOURS
+    elif POPULATION_GROUP == 'Service':
+        colours = SERVICE_COLOURS
+    else:
+        colours = BAR_COLOURS
+    colour = map_categories_to_colours(occupancy.columns, colours)
+    mdate = convert_dates_to_matplotlibDates(occupancy.index.to_series())
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, sharex = True, figsize = (20, 10))
+    ax1.stackplot(mdate, occupancy.to_numpy().T, labels = occupancy.columns,
+                  colors = colour, alpha = 0.8)
+    ax1.set_ylabel("Clients")
+    ax1.legend(loc = 'upper left', bbox_to_anchor = (1.01, 1), fontsize = 12)
+    ax2.stackplot(mdate, spend.to_numpy().T, colors = colour, alpha = 0.8)
+    ax2.set_ylabel("Daily spend (£)")
+
+    # FORMAT X AXIS: monthly dates, as the service use timelines
+    ax2.xaxis_date()
+    ax2.xaxis.set_major_locator(RRuleLocator(rrulewrapper(MONTHLY, 
+                                                          interval = 1)))
+    ax2.xaxis.set_major_formatter(DateFormatter("%b-%y"))
+    plt.setp(ax2.get_xticklabels(), rotation = 30, fontsize = 12)
+    ax2.set_xlim(xmin = mdate[0], xmax = mdate[-1])
+
+    for ax in [ax1, ax2]:
+        ax.grid(color = 'g', linestyle = ':')
+        ax.set_axisbelow(True)
+    ax1.set_title(f'Population service use by {POPULATION_GROUP.lower()}')
+    fig.autofmt_xdate()
+
+    # SAVE GRAPHIC AS SVG FILE, AND THE DAILY VALUES AS CSV
+    # (with fixed ids and no date, as in create_service_use_timeline)
+    with matplotlib.rc_context({'svg.hashsalt': SVG_HASH_SALT}):
+        plt.savefig(f'{FOLDER}/population_timeline_{POPULATION_GROUP}.svg', 
+                    bbox_inches = 'tight', metadata = {'Date': None})
+    pd.concat({'clients': occupancy, 'spend': spend}, axis = 1).to_csv(
+                        f'{FOLDER}/population_{POPULATION_GROUP}.csv')
+    
+    # SHOW GRAPHIC
+    if not HEADLESS:
+        plt.show()
+
+    # CLOSE THE CURRENT MATPLOTLIB WINDOW
+    plt.close('all') 
+
+# %% [markdown]
+# ## Define function: create_report
+# 
+# The report records how long each stage of the run took (see record_stage),
+# so that a slow run can be traced to the stage, or to the client, that caused 
+# it. It is a dictionary holding a list of the stages, saved as json by 
+# save_report. When the report is not wanted it is None, and record_stage does
+# nothing.
+#
+# TRACE_MEMORY also records the peak memory allocated in each stage (with 
+# tracemalloc, which makes the run slower).
+
+# %%
+def create_report(TRACE_MEMORY):
+    """
+    Return an empty report
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if (type(TRACE_MEMORY) not in [bool]):
+        raise TypeError (f"function {function_name}: "
+                         f"TRACE_MEMORY must be a boolean")
+
+############################### Function ######################################
+
+    return {'started': dt.datetime.now().isoformat(timespec = 'seconds'),
+            'trace_memory': TRACE_MEMORY, 'stages': [], '_peaks': []}
+
+# %% [markdown]
+# ## Define function: create_timeline
+# 
+# This function creates a service use timeline using data for a single client 
+# (df) and the matplotlib library. 
+# It extends the code as provided here: 
+#https://sukhbinder.wordpress.com/2016/05/10/quick-gantt-chart-with-matplotlib/
+# 
+# The matplotlib graphic is saved in a svg format, or as the next page of the
+# pdf file pdf (a matplotlib PdfPages, see render_timelines_to_pdf). The svg 
+# graphic is then shown, unless HEADLESS. The svg file is written by write_svg
+# (in the background, if writer is not None).
+#
+# When SVG_FORMAT is 'compact' (or 'svgz', compact and gzip compressed) the 
+# text is written as svg text rather than as the outline of each letter, and
+# the coordinates are rounded to 1/100 of a point (see round_svg_numbers).
+#
+# The ids of the clip paths and markers in the svg file are made from 
+# SVG_HASH_SALT rather than at random, and no date is written to it, so the 
+# same timeline always gives the same file (in any process, or run).
+
+# %%
+SVG_HASH_SALT = 'service_use_timelines'
+
+def create_service_use_timeline(df, contacts, FOLDER, pdf = None, 
+                                HEADLESS = False, writer = None, 
+                                SVG_FORMAT = 'svg'):
+    """
+    Pass pandas dataframe containing the data for a single chart (df), and the
+    contact table for the same client (contacts)
+    Format the plot
+    The matplotlib graphic is saved in a svg format (or added to pdf)
+    """
+
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(FOLDER, str):#(pd.core.series.Series)):
+        raise TypeError (f"function {function_name}: "
+                         f"FOLDER must be a string")
+############################### Function ######################################
+    import matplotlib
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import PolyCollection
+    from matplotlib.dates import (MONTHLY, DateFormatter, rrulewrapper, 
+                                  RRuleLocator)
+
+#1. set up the variables for the timeline chart
+    ylabels = df['ylabel']
+    setting = df['Setting']
+    locality = df['Locality']
+    bedtype = df['OOABedType']
+    genspecialty = df['GenSpecialty']
+
+#2. Store the three dates of each episode to create the bars
+    req_date = df['ReferralRequest_mdate'].to_numpy(dtype = float)
+    start_date = df['ReferralDate_mdate'].to_numpy(dtype = float)
+    end_date = df['ReferralDischarge_mdate'].to_numpy(dtype = float)
+
+#3. Main code for the timeline
+    ilen = len(ylabels)
+    pos = np.arange(0.5, ilen * 0.5 + 0.5, 0.5)
+
+    #Set size of graphic (Width is constant, height is based on ilen)
+    fig = plt.figure(figsize=(20, 0.4 * ilen))
+    ax1 = fig.add_subplot(111)
+
+    #Allocate bar colour based on setting
+    colour = assign_colour_to_bar(setting, bedtype, genspecialty)
+    #Create the service use bars (one collection for all episodes)
+    ax1.add_collection(PolyCollection(
+                            create_bar_vertices(pos, start_date, end_date, 
+                                                0.3),
+                            facecolors = colour, edgecolors = colour, 
+                            linewidths = 1, alpha = 0.8))
+    #Create the waiting bars (always grey)
+    ax1.add_collection(PolyCollection(
+                            create_bar_vertices(pos, req_date, start_date, 
+                                                0.3),
+                            facecolors = 'lightgray', edgecolors = 'lightgray',
+                            linewidths = 1))
+
+    #Add individual contacts
+    marker_size = 5
+    marker_shape = '.'
+    contact_mdate, contact_pos, contact_type = get_contact_points(df, contacts,
+                                                                  pos)
+    #Add the points to the timeline, one set of points per contact type. 
+    #Where contacts overlap, the direct (face-to-face) contacts are on top
+    #Allocate point colour based on contact type
+    contact_colour = assign_colour_to_contact_type(contact_type)
+    for is_category in group_contact_types(contact_type):
+        ax1.scatter(contact_mdate[is_category], contact_pos[is_category], 
+                    s = marker_size ** 2, c = contact_colour[is_category][0], 
+                    marker = marker_shape, linewidths = 1, zorder = 2)
+
+    # FORMAT BOTTOM X AXIS
+    # Bottom x axis: date           
+    # Format ticks and labels to be monthly
+    ax1.xaxis_date()
+    rule = rrulewrapper(MONTHLY, interval=1)
+    loc = RRuleLocator(rule)
+    formatter = DateFormatter("%b-%y")
+    ax1.xaxis.set_major_locator(loc)
+    ax1.xaxis.set_major_formatter(formatter)
+    labelsx = ax1.get_xticklabels()
+    plt.setp(labelsx, rotation=30, fontsize=12)
+
+    #Set x axis range to full dataset range
+    ax1.set_xlim(xmin = convert_date_to_matplotlibDate('01/01/2015'), 
+                xmax = convert_date_to_matplotlibDate('18/02/2018'))
+
+    # FORMAT TOP X AXIS
+    # Add a second x axis (top): client's age
+    # Currently, this does not take into account leap years
+    ax2 = ax1.twiny()
+    ax2.set_xlabel("Client age (Years)")
+    # The ages in days (matplotlib dates are in days) converted to years
+    date_of_birth = df.date_of_birth_mdate.iloc[0]
+    minAge_Yrs = ((convert_date_to_matplotlibDate('01/01/2015') - 
+                   date_of_birth) / 365)
+    maxAge_Yrs = ((convert_date_to_matplotlibDate('18/02/2018') - 
+                   date_of_birth) / 365)
+    ax2.set_xlim(xmin = minAge_Yrs, xmax = maxAge_Yrs)
+    
+    # FORMAT Y AXIS
+    # Allocate y axis text colour based on locality
+    ytickcolour = assign_colour_to_ytick(locality, bedtype)
+    # Place text for y labels in specified position        
+    locsy, labelsy = plt.yticks(pos, ylabels)
+    
+    for ytick, color in zip(ax1.get_yticklabels(), ytickcolour):
         ytick.set_color(color)
     
     plt.setp(labelsy, fontsize = 14)
@@ -495,108 +1567,1510 @@ def create_service_use_timeline(df, FOLDER):
     ax1.grid(color = 'g', linestyle = ':')
     ax1.set_axisbelow(True)#so grid is behind the other graph elements
 
-    # SAVE GRAPHIC AS SVG FILE
-    plt.savefig(f'{FOLDER}/timeline_{str(df.ClientID.iloc[0])}.svg', 
-                bbox_inches = 'tight')
+    # SAVE GRAPHIC AS SVG FILE (or as a page of the pdf file)
+    if pdf is None:
+        svg = io.BytesIO()
+        rc = {'svg.hashsalt': SVG_HASH_SALT}
+        if SVG_FORMAT != 'svg':
+            rc['svg.fonttype'] = 'none'
+        with matplotlib.rc_context(rc):
+            plt.savefig(svg, format = 'svg', bbox_inches = 'tight', 
+                        metadata = {'Date': None})
+        svg = svg.getvalue()
+        if SVG_FORMAT != 'svg':
+            svg = round_svg_numbers(svg)
+        extension = 'svgz' if SVG_FORMAT == 'svgz' else 'svg'
+        write_svg(writer, 
+                  f'{FOLDER}/timeline_{str(df.ClientID.iloc[0])}.{extension}',
+                  svg)
     
-    # SHOW GRAPHIC
-    plt.show()
+        # SHOW GRAPHIC
+        if not HEADLESS:
+            plt.show()
+    else:
+        pdf.savefig(fig, bbox_inches = 'tight')
 
     # CLOSE THE CURRENT MATPLOTLIB WINDOW
     plt.close('all') 
 # %% [markdown]
-# ## Define function: edit_cost_data
+# ## Define function: create_service_use_timeline_svg
+# 
+# This function creates the same service use timeline as 
+# create_service_use_timeline, but writes the svg text directly rather than 
+# building a matplotlib figure. It is much faster, so is useful when creating 
+# the timelines for many clients.
+#
+# The layout is measured in points (1/72 inch), as in the matplotlib svg files.
+# The width of the text is estimated from the number of characters. The svg 
+# file is written by write_svg (in the background, if writer is not None).
+#
+# When SVG_FORMAT is 'compact' (or 'svgz', compact and gzip compressed) each 
+# style (of the grid lines, ticks and bars) is defined once, as a class, each
+# contact marker is defined once and placed with <use>, and the coordinates 
+# are rounded to 1/10 of a point (1/720 inch).
+
+# %%
+def create_service_use_timeline_svg(df, contacts, FOLDER, writer = None, 
+                                    SVG_FORMAT = 'svg'):
+    """
+    Pass pandas dataframe containing the data for a single chart (df), and the
+    contact table for the same client (contacts)
+    Write the timeline as a svg file, without using matplotlib
+    """
+
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(FOLDER, str):
+        raise TypeError (f"function {function_name}: "
+                         f"FOLDER must be a string")
+############################### Function ######################################
+#1. set up the variables for the timeline chart
+    ylabels = df['ylabel']
+    setting = df['Setting']
+    locality = df['Locality']
+    bedtype = df['OOABedType']
+    genspecialty = df['GenSpecialty']
+    ilen = len(ylabels)
+    pos = np.arange(0.5, ilen * 0.5 + 0.5, 0.5)
+
+    req_date = df['ReferralRequest_mdate'].to_numpy(dtype = float)
+    start_date = df['ReferralDate_mdate'].to_numpy(dtype = float)
+    end_date = df['ReferralDischarge_mdate'].to_numpy(dtype = float)
+
+#2. Set up the layout (in points) and the conversion from data to points
+    char_width = 0.55 # average character width, relative to the font size
+    xmin = convert_date_to_matplotlibDate('01/01/2015')
+    xmax = convert_date_to_matplotlibDate('18/02/2018')
+    ymin = -0.1
+    ymax = ilen * 0.5 + 0.5
+    plot_left = max(len(label) for label in ylabels) * 10 * char_width + 20
+    plot_top = 80
+    plot_width = 1116
+    plot_height = 22.2 * ilen
+    plot_bottom = plot_top + plot_height
+    width = plot_left + plot_width + 30
+    height = plot_bottom + 110
+
+    def x_to_points(x):
+        return plot_left + (x - xmin) / (xmax - xmin) * plot_width
+
+    def y_to_points(y):
+        return plot_top + (y - ymin) / (ymax - ymin) * plot_height
+
+    # The number of decimals of the coordinates, and the grid line and tick 
+    # styles
+    compact = SVG_FORMAT != 'svg'
+    d = 1 if compact else 2
+    grid_style = ('class="g"' if compact else 
+                  'stroke="green" stroke-dasharray="1,1.65" '
+                  'stroke-width="0.8"')
+    tick_style = ('class="k"' if compact else 
+                  'stroke="black" stroke-width="0.8"')
+    svg = []
+
+#3. Bottom x axis: date, with monthly ticks and grid lines
+    months = np.arange('2015-01', '2018-03', dtype = 'datetime64[M]')
+    month_mdate = convert_dates_to_matplotlibDates(
+                                pd.Series(months.astype('datetime64[ns]')))
+    for month, mdate in zip(months.astype(dt.datetime), month_mdate):
+        x = x_to_points(mdate)
+        svg.append(f'<line x1="{x:.{d}f}" y1="{plot_top:.1f}" x2="{x:.{d}f}" '
+                   f'y2="{plot_bottom:.1f}" {grid_style}/>\n'
+                   f'<line x1="{x:.{d}f}" y1="{plot_bottom:.1f}" '
+                   f'x2="{x:.{d}f}" '
+                   f'y2="{plot_bottom + 3.5:.1f}" {tick_style}/>\n'
+                   f'<text transform="translate({x:.{d}f} '
+                   f'{plot_bottom + 10:.1f}) rotate(-30)" font-size="12" '
+                   f'text-anchor="end" dominant-baseline="hanging">'
+                   f'{month.strftime("%b-%y")}</text>\n')
+
+#4. Top x axis: client's age in years (as create_service_use_timeline, this 
+#   does not take into account leap years)
+    date_of_birth = df.date_of_birth_mdate.iloc[0]
+    minAge_Yrs = ((convert_date_to_matplotlibDate('01/01/2015') - 
+                   date_of_birth) / 365)
+    maxAge_Yrs = ((convert_date_to_matplotlibDate('18/02/2018') - 
+                   date_of_birth) / 365)
+    # Choose a tick spacing of 1, 2, 2.5 or 5 (times a power of ten) that gives
+    # no more than 8 ticks
+    magnitude = 10 ** np.floor(np.log10((maxAge_Yrs - minAge_Yrs) / 8))
+    for step in [1, 2, 2.5, 5, 10]:
+        if (maxAge_Yrs - minAge_Yrs) / (step * magnitude) <= 8:
+            break
+    step = step * magnitude
+    decimals = len(f"{step:g}".partition('.')[2])
+    for age in np.arange(np.ceil(minAge_Yrs / step) * step, maxAge_Yrs, step):
+        x = plot_left + ((age - minAge_Yrs) / (maxAge_Yrs - minAge_Yrs) * 
+                         plot_width)
+        svg.append(f'<line x1="{x:.{d}f}" y1="{plot_top:.1f}" x2="{x:.{d}f}" '
+                   f'y2="{plot_top - 3.5:.1f}" {tick_style}/>\n'
+                   f'<text transform="translate({x:.{d}f} {plot_top - 7:.1f}) '
+                   f'rotate(-30)" font-size="10" text-anchor="start">'
+                   f'{age:.{decimals}f}</text>\n')
+    svg.append(f'<text x="{plot_left + plot_width / 2:.1f}" '
+               f'y="{plot_top - 30:.1f}" font-size="10" '
+               f'text-anchor="middle">Client age (Years)</text>\n')
+
+#5. Y axis: one label per episode, coloured by locality, and grid lines
+    ytickcolour = assign_colour_to_ytick(locality, bedtype)
+    for y, label, colour in zip(pos, ylabels, ytickcolour):
+        y = y_to_points(y)
+        svg.append(f'<line x1="{plot_left:.1f}" y1="{y:.{d}f}" '
+                   f'x2="{plot_left + plot_width:.1f}" y2="{y:.{d}f}" '
+                   f'{grid_style}/>\n'
+                   f'<text x="{plot_left - 7:.1f}" y="{y:.{d}f}" '
+                   f'font-size="10" fill="{colour}" text-anchor="end" '
+                   f'dominant-baseline="central">{escape(label)}</text>\n')
+
+#6. Service use bars, waiting bars (always grey) and individual contacts
+    svg.append('<g clip-path="url(#plot_area)">\n')
+    bar_height = 0.3 / (ymax - ymin) * plot_height
+    colour = assign_colour_to_bar(setting, bedtype, genspecialty)
+    # Compact: the class of each bar style (fill and opacity)
+    bar_styles = {}
+    for i in range(ilen):
+        y = y_to_points(pos[i]) - bar_height / 2
+        for left, right, fill, opacity in [
+                        (start_date[i], end_date[i], colour[i], 0.8), 
+                        (req_date[i], start_date[i], 'lightgray', 1)]:
+            if np.isnan(left) or np.isnan(right):
+                continue
+            x1 = x_to_points(min(left, right))
+            x2 = x_to_points(max(left, right))
+            if compact:
+                style = bar_styles.setdefault((fill, opacity), 
+                                              f'class="b{len(bar_styles)}"')
+            else:
+                style = (f'fill="{fill}" stroke="{fill}" '
+                         f'opacity="{opacity}"')
+            svg.append(f'<rect x="{x1:.{d}f}" y="{y:.{d}f}" '
+                       f'width="{x2 - x1:.{d}f}" '
+                       f'height="{bar_height:.{d}f}" {style}/>\n')
+
+    # Where contacts overlap, the direct (face-to-face) contacts are on top
+    contact_mdate, contact_pos, contact_type = get_contact_points(df, contacts,
+                                                                  pos)
+    contact_colour = assign_colour_to_contact_type(contact_type)
+    # Compact: the id of the marker of each contact colour
+    markers = {}
+    for is_category in group_contact_types(contact_type):
+        for mdate, y, fill in zip(contact_mdate[is_category], 
+                                  contact_pos[is_category],
+                                  contact_colour[is_category]):
+            if compact:
+                marker = markers.setdefault(fill, f'c{len(markers)}')
+                svg.append(f'<use xlink:href="#{marker}" '
+                           f'x="{x_to_points(mdate):.1f}" '
+                           f'y="{y_to_points(y):.1f}"/>\n')
+            else:
+                svg.append(f'<circle cx="{x_to_points(mdate):.2f}" '
+                           f'cy="{y_to_points(y):.2f}" r="1.75" '
+                           f'fill="{fill}"/>\n')
+    svg.append('</g>\n')
+
+#7. Plot area border
+    svg.append(f'<rect x="{plot_left:.1f}" y="{plot_top:.1f}" '
+               f'width="{plot_width:.1f}" height="{plot_height:.1f}" '
+               f'fill="none" stroke="black" stroke-width="0.8"/>\n')
+
+#8. Title: contains client details (id, icd10 and cluster)
+    figure_title = (f'Client ID {str(df.ClientID.iloc[0])},   '
+                    f'ICD10: {str(df.ICD10.iloc[0])},   '
+                    f'Cluster: {str(df.Cluster.iloc[0])}')
+    svg.append(f'<text x="{plot_left + plot_width / 2:.1f}" '
+               f'y="{plot_top - 58:.1f}" font-size="12" text-anchor="middle" '
+               f'xml:space="preserve">{escape(figure_title)}</text>\n')
+
+#9. Footnote: contains additional information (icd10 code key)
+    footnote_text = [(f'ICD10: {str(df.ICD10.iloc[0])} = '
+                      f'{str(df.Desc.iloc[0])}'),
+                     (f'Assumption: If discharge date is not recorded, it is '
+                      f'assumed to be date of data extraction'),
+                     (f'This timeline contains anonymised data')]
+    for offset, text in zip([60, 75, 90], footnote_text):
+        svg.append(f'<text x="{plot_left:.1f}" y="{plot_bottom + offset:.1f}"'
+                   f' font-size="10" dominant-baseline="hanging">'
+                   f'{escape(text)}</text>\n')
+    svg.append('</g>\n</svg>\n')
+
+#10. Header: size, clip path of the plot area and (compact) the styles and 
+#    markers used above
+    defs = (f'<clipPath id="plot_area"><rect x="{plot_left:.1f}" '
+            f'y="{plot_top:.1f}" width="{plot_width:.1f}" '
+            f'height="{plot_height:.1f}"/></clipPath>')
+    if compact:
+        defs += (''.join(f'<circle id="{marker}" r="1.75" fill="{fill}"/>' 
+                         for fill, marker in markers.items()) +
+                 '<style>.g{stroke:green;stroke-dasharray:1,1.65;'
+                 'stroke-width:0.8}.k{stroke:black;stroke-width:0.8}' +
+                 ''.join(f'.{style[7:-1]}{{fill:{fill};stroke:{fill};'
+                         f'opacity:{opacity}}}' 
+                         for (fill, opacity), style in bar_styles.items()) +
+                 '</style>')
+    xlink = ' xmlns:xlink="http://www.w3.org/1999/xlink"' if compact else ''
+    svg.insert(0, f'<?xml version="1.0" encoding="utf-8" standalone="no"?>\n'
+                  f'<svg xmlns="http://www.w3.org/2000/svg"{xlink} '
+                  f'width="{width:.1f}pt" height="{height:.1f}pt" '
+                  f'viewBox="0 0 {width:.1f} {height:.1f}" version="1.1">\n'
+                  f'<defs>{defs}</defs>\n'
+                  f'<g font-family="DejaVu Sans, Bitstream Vera Sans, '
+                  f'sans-serif">\n'
+                  f'<rect width="100%" height="100%" fill="white"/>\n')
+
+    # SAVE GRAPHIC AS SVG FILE
+    extension = 'svgz' if SVG_FORMAT == 'svgz' else 'svg'
+    write_svg(writer, 
+              f'{FOLDER}/timeline_{str(df.ClientID.iloc[0])}.{extension}', 
+              ''.join(svg).encode('utf-8'))
+
+# %% [markdown]
+# ## Define function: create_svg_writer
+# 
+# On slow storage (such as a network share) writing a timeline's svg file can 
+# take as long as drawing it, and the next timeline is not started until the 
+# file is written. The svg writer is a pool of N_WRITERS threads that write 
+# the files in the background (see write_svg), while the next timelines are 
+# drawn.
+#
+# At most QUEUE_DEPTH files wait to be written: when the queue is full, 
+# write_svg waits for a file to be written before adding another, so the 
+# memory used does not grow when drawing is faster than writing. Call 
+# close_svg_writer once all the timelines are drawn, to wait for the last 
+# files to be written.
+
+# %%
+def create_svg_writer(N_WRITERS, QUEUE_DEPTH):
+    """
+    Return a dictionary of the pool of writer threads, the free places in the
+    queue and the errors of the files that could not be written
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if (type(N_WRITERS) not in [int]) or N_WRITERS < 1:
+        raise TypeError (f"function {function_name}: "
+                         f"N_WRITERS must be a positive integer")
+
+    if (type(QUEUE_DEPTH) not in [int]) or QUEUE_DEPTH < 1:
+        raise TypeError (f"function {function_name}: "
+                         f"QUEUE_DEPTH must be a positive integer")
+
+############################### Function ######################################
+
+    return {'pool': ThreadPoolExecutor(max_workers = N_WRITERS, 
+                                       thread_name_prefix = 'svg_writer'),
+            'queue': threading.Semaphore(QUEUE_DEPTH), 'errors': []}
+
+# %% [markdown]
+# ## Define function: close_svg_writer
+# 
+# Wait for the files queued in the svg writer to be written, and stop its 
+# threads. If any file could not be written, the error of the first is raised.
+
+# %%
+def close_svg_writer(writer):
+    """
+    Pass the dictionary returned by create_svg_writer (or None)
+    """
+    if writer is None:
+        return
+    writer['pool'].shutdown(wait = True)
+    if writer['errors']:
+        raise writer['errors'][0]
+    return
+
+# %% [markdown]
+# ## Define function: edit_cost_data
+# 
+# Based on the user defined variable (KEEP_MISSING_COST), the data is edited ready for the visualisation.
+# The episodes without a cost value are either removed, or replaced with a "Not available" string.
+
+# %%
+def edit_cost_data(df, KEEP_MISSING_COST):
+    """
+    The episodes without a cost value are either removed, or replaced with a 
+    "Not available" string. Based on the user defined boolean variable 
+    KEEP_MISSING_COST
+    """
+############################# Argument checking ###############################
+    
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+    
+    if (type(KEEP_MISSING_COST) not in [bool]):
+        raise TypeError (f"function {function_name}: "
+                         f"KEEP_MISSING_COST must be a boolean")
+
+############################### Function ######################################
+    
+    if KEEP_MISSING_COST:
+        df.Episode_cost.replace(0, 'Not available', inplace = True)
+    else:
+        df = df[df.Episode_cost > 0]
+    return df
+
+
+# %% [markdown]
+# ## Define function: format_date_variables
+# 
+# Use one lists to set up the necessary changes. 
+# column_name: list the columns to check.
+# Convert the format into datetime, and store in new column.
+# %%
+def format_date_variables(df, column_name):
+    """
+    Convert the columns passed in column_name to datetime format.
+    Store new format in new column
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+    
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(column_name, list):
+        raise TypeError (f"function {function_name}: "
+                         f"column_name must be a list")
+
+############################### Function ######################################
+
+    for i in range(len(column_name)):
+        df[f"{column_name[i]}_format"] = (
+                                    pd.to_datetime(df[f"{column_name[i]}"], 
+                                    format="%d/%m/%Y"))
+    return df
+
+# %% [markdown]
+# ## Define function: get_archived_client
+# 
+# Return the episodes and the contact table of a single client from an archive
+# opened by open_episode_archive, as compact_data would return them. Only the
+# client's rows of each column are read (and copied) from the files.
+
+# %%
+def get_archived_client(archive, ClientID):
+    """
+    Pass the dictionary returned by open_episode_archive. Return the episodes
+    and contact table for ClientID (empty if the client has no episodes)
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(archive, dict):
+        raise TypeError (f"function {function_name}: "
+                         f"archive must be a dictionary")
+
+############################### Function ######################################
+
+    # The position of ClientID in the sorted ClientIDs (a ClientID that is 
+    # not in the archive has no episodes)
+    client_ids = archive['client_ids']
+    position = int(np.searchsorted(client_ids, ClientID))
+    found = (position < len(client_ids) and 
+             client_ids[position] == ClientID)
+
+    def rows(name):
+        if not found:
+            return 0, 0
+        start = int(archive[f"{name}_start"][position])
+        return start, start + int(archive[f"{name}_count"][position])
+
+    start, stop = rows('episode')
+    columns = {}
+    for column, codes in archive['episodes'].items():
+        values = np.array(codes[start:stop])
+        if column in archive['categories']:
+            categories = archive['categories'][column]
+            if isinstance(categories, pd.CategoricalDtype):
+                values = pd.Categorical.from_codes(values, 
+                                                   dtype = categories)
+            else:
+                # The last entry (code -1) is a missing value
+                values = categories[values]
+        columns[column] = values
+    df = pd.DataFrame(columns, index = pd.Index(
+                            np.array(archive['episode_index'][start:stop])))
+
+    start, stop = rows('contact')
+    contacts = pd.DataFrame({column: np.array(values[start:stop]) 
+                             for column, values 
+                             in archive['contacts'].items()})
+    return df, contacts
+
+# %% [markdown]
+# ## Define function: get_client_data
+# 
+# Return the episodes of a single client, as a slice of the DataFrame indexed 
+# by create_client_index. The slice is not copied: functions that change the
+# client's data (sort_data onwards) work on their own sorted copy.
+
+# %%
+def get_client_data(df, client_index, ClientID):
+    """
+    Pass the dataframe and dictionary returned by create_client_index.
+    Return the episodes for ClientID (empty if the client has no episodes)
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(client_index, dict):
+        raise TypeError (f"function {function_name}: "
+                         f"client_index must be a dictionary")
+
+############################### Function ######################################
+
+    start, stop = client_index.get(ClientID, (0, 0))
+    return df.iloc[start:stop]
+
+# %% [markdown]
+# ## Define function: get_contact_points
+# 
+# Return the individual contacts of all the episodes of a single client, as 
+# three arrays: the contact date (in matplotlib date format), the position of 
+# the episode on the y axis (pos) and the contact type.
+#
+# The contacts are matched to their episode using the episode column of the 
+# contact table, which holds the index of the episode in df.
+
+# %%
+def get_contact_points(df, contacts, pos):
+    """
+    Pass pandas dataframe containing the data for a single chart (df), the 
+    contact table for the same client (contacts), and the y axis position of 
+    each episode. Return numpy arrays of the mdate, y axis position and type of
+    each contact
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(contacts, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"contacts must be a pandas dataframe")
+
+    if len(pos) != len(df):
+        raise TypeError (f"function {function_name}: "
+                         f"pos must have one element per episode")
+
+############################### Function ######################################
+
+    # Position of each contact's episode in df (-1 if the episode is not in df,
+    # for example if it was removed when the data was cleaned)
+    episode = df.index.get_indexer(contacts['episode'])
+    in_df = episode >= 0
+    return (contacts['contact_mdate'].to_numpy(dtype = float)[in_df], 
+            np.asarray(pos, dtype = float)[episode[in_df]],
+            contacts['contact_type'].to_numpy()[in_df])
+
+# %% [markdown]
+# ## Define function: group_contact_types
+# 
+# Split the contacts of a timeline into one group per contact type, in the 
+# order they are drawn: the contacts with a missing type (NaN, or -1 in 
+# compact data, drawn in FALLBACK_COLOUR) first, then the types from the 
+# highest to the lowest, so that where contacts overlap the direct 
+# (face-to-face, 0) contacts are on top.
+
+# %%
+def group_contact_types(contact_type):
+    """
+    Pass an array of contact types. Return a list of boolean arrays, one for
+    each contact type present, in drawing order
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(contact_type, (np.ndarray, pd.core.series.Series)):
+        raise TypeError (f"function {function_name}: "
+                         f"contact_type must be a numpy array or pandas "
+                         f"series")
+
+############################### Function ######################################
+
+    # A missing type (NaN, or -1 after compact_data) has the code -1
+    contact_type = np.asarray(contact_type, dtype = float)
+    codes, types = pd.factorize(np.where(contact_type >= 0, contact_type, 
+                                         np.nan), sort = True)
+    groups = [codes == code for code in [-1, *range(len(types))[::-1]]]
+    return [is_type for is_type in groups if is_type.any()]
+
+# %% [markdown]
+# ## Define function: load_data
+#
+# Read, check and prepare the input file set in user_defined_variables (or 
+# load the prepared data from CACHE_FOLDER, see load_prepared_data), and store
+# it in compact types if COMPACT_DATA is set (see compact_data). Only the 
+# episodes of CLIENTS are returned (None or [-1] for all clients); when the 
+# input file is read, only their episodes are prepared.
+#
+# The main code and the other scripts (export_data.py, timeline_server.py, 
+# client_analytics.py and benchmark_timelines.py) all load the data with this
+# function. Each stage is recorded in the report (if not None).
+
+# %%
+def load_data(variables, CLIENTS = None, report = None):
+    """
+    Pass the variables returned by user_defined_variables. Return the prepared
+    episodes and contact table of CLIENTS (None for all clients)
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(variables, UserVariables):
+        raise TypeError (f"function {function_name}: "
+                         f"variables must be returned by "
+                         f"user_defined_variables")
+
+############################### Function ######################################
+
+    ALL_CLIENTS = CLIENTS is None or CLIENTS[0] == -1
+    if variables.CACHE_FOLDER is None:
+        with record_stage(report, 'read'):
+            df = pd.read_csv(f"{variables.FOLDER}{variables.FILENAME}.csv",
+                             low_memory=False)
+        #Check the required columns are present and of the expected type
+        with record_stage(report, 'validate', episodes = len(df)):
+            check_columns_present_and_type(df, variables.COLUMNS_REQUIRED,
+                                           variables.COLUMNS_DTYPE)
+        # Only prepare the data of CLIENTS
+        if not ALL_CLIENTS:
+            df = df.loc[df['ClientID'].isin(CLIENTS)]
+        with record_stage(report, 'prepare_data', episodes = len(df)):
+            df, contacts = prepare_data(df, variables.KEEP_MISSING_COST,
+                                        variables.ZERO_LOS_REPLACEMENT,
+                                        variables.REPLACE_NAN_COLUMNS,
+                                        variables.REPLACE_NAN_VALUES, report)
+    else:
+        # Load the prepared data for all clients from the cache (prepared
+        # and stored if the input file or variables have changed)
+        with record_stage(report, 'load_prepared_data'):
+            df, contacts = load_prepared_data(variables.FOLDER,
+                                              variables.FILENAME,
+                                              variables.COLUMNS_REQUIRED,
+                                              variables.COLUMNS_DTYPE,
+                                              variables.KEEP_MISSING_COST,
+                                              variables.ZERO_LOS_REPLACEMENT,
+                                              variables.REPLACE_NAN_COLUMNS,
+                                              variables.REPLACE_NAN_VALUES,
+                                              variables.CACHE_FOLDER)
+        if not ALL_CLIENTS:
+            df = df.loc[df['ClientID'].isin(CLIENTS)]
+            contacts = contacts.loc[contacts['ClientID'].isin(CLIENTS)]
+
+    if variables.COMPACT_DATA:
+        with record_stage(report, 'compact_data', episodes = len(df)):
+            df, contacts = compact_data(df, contacts)
+    return df, contacts
+
+# %% [markdown]
+# ## Define function: load_prepared_data
+# 
+# Reading and preparing the input file (prepare_data) is repeated on every 
+# run, even when the file has not changed. This function stores the prepared 
+# data in CACHE_FOLDER (as a numpy .npz file, see save_prepared_data, which 
+# keeps the column types, including the datetime columns and the mixed text 
+# and number cost column).
+#
+# The cache file is named after the input file, a hash of the variables used 
+# to prepare it and a hash of its content (and of the code and pandas 
+# versions): {FILENAME}_{variables}_{content}.npz. If either changes, the data
+# is prepared again. The old cache file of the same input file and variables 
+# is then deleted (and those named as by earlier versions, 
+# {FILENAME}_{hash}.pkl or .npz); the cache files of other input files, or of 
+# other variables, are kept.
+#
+# Increase PREPARED_DATA_VERSION when the steps in prepare_data change, so 
+# that data prepared by the old code is not used.
+
+# %%
+PREPARED_DATA_VERSION = 3
+
+def load_prepared_data(FOLDER, FILENAME, COLUMNS_REQUIRED, COLUMNS_DTYPE,
+                       KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT, 
+                       REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES, CACHE_FOLDER):
+    """
+    Return the prepared data (episodes and contact table) for all clients in
+    the input file. Read from 
+    the cache if it was prepared from the same file with the same variables, 
+    otherwise read the input file, prepare the data and store it in the cache
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(CACHE_FOLDER, str):
+        raise TypeError (f"function {function_name}: "
+                         f"CACHE_FOLDER must be a string")
+
+############################### Function ######################################
+
+    # Cache key: the variables, and the content of the input file
+    variables_key = hashlib.sha256(repr((
+                        KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT, 
+                        REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES)).encode()
+                        ).hexdigest()[:16]
+    key = hashlib.sha256()
+    with open(f"{FOLDER}{FILENAME}.csv", 'rb') as input_file:
+        for block in iter(lambda: input_file.read(1 << 20), b''):
+            key.update(block)
+    key.update(repr((PREPARED_DATA_VERSION, pd.__version__)).encode())
+    cache_file = os.path.join(CACHE_FOLDER, f"{FILENAME}_{variables_key}_"
+                                            f"{key.hexdigest()[:16]}.npz")
+
+    if os.path.exists(cache_file):
+        return read_prepared_data(cache_file)
+
+    df = pd.read_csv(f"{FOLDER}{FILENAME}.csv", low_memory=False)
+    #Check the required columns are present and are of the expected type
+    check_columns_present_and_type(df, COLUMNS_REQUIRED, COLUMNS_DTYPE)
+    df, contacts = prepare_data(df, KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT, 
+                                REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES)
+
+    # Remove the out of date cache files for this input file and variables 
+    # (and those named as by earlier versions), and store the new one 
+    # (written to a temporary file first, so a run that stops part way 
+    # through does not leave an incomplete cache file)
+    stale = re.compile(rf"{re.escape(FILENAME)}_({variables_key}_)?"
+                       rf"[0-9a-f]{{16}}\.(npz|pkl)")
+    os.makedirs(CACHE_FOLDER, exist_ok = True)
+    for name in os.listdir(CACHE_FOLDER):
+        if stale.fullmatch(name):
+            os.remove(os.path.join(CACHE_FOLDER, name))
+    save_prepared_data(df, contacts, f"{cache_file}.tmp")
+    os.replace(f"{cache_file}.tmp", cache_file)
+    return df, contacts
+
+# %% [markdown]
+# ## Define function: load_timeline_manifest
+# 
+# The manifest is stored in FOLDER (timelines_manifest.json). For each client 
+# it holds a hash of the client's data and of the variables used to create the
+# timeline, as it was when the timeline was last created (see 
+# select_changed_clients).
+#
+# Increase TIMELINE_VERSION when the way the timelines are drawn changes, so 
+# that all of the timelines are created again.
+
+# %%
+TIMELINE_VERSION = 1
+
+def load_timeline_manifest(FOLDER):
+    """
+    Return the manifest (a dictionary of ClientID: hash) stored in FOLDER. 
+    Return an empty dictionary if there is no manifest
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(FOLDER, str):
+        raise TypeError (f"function {function_name}: "
+                         f"FOLDER must be a string")
+
+############################### Function ######################################
+
+    manifest_file = os.path.join(FOLDER, 'timelines_manifest.json')
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, encoding = 'utf-8') as file:
+        manifest = json.load(file)
+    # A manifest from a different version of the timelines is out of date
+    if manifest.get('version') != TIMELINE_VERSION:
+        return {}
+    return manifest['clients']
+
+# %% [markdown]
+# ## Define function: open_episode_archive
+# 
+# Open the archive written by create_episode_archive. Each column is opened as
+# a memory map (np.load with mmap_mode), so nothing is read until a client's 
+# rows are used (get_archived_client), and processes that open the same 
+# archive share one copy of it in the operating system's file cache.
+
+# %%
+def open_episode_archive(ARCHIVE_FOLDER):
+    """
+    Return a dictionary of the memory mapped columns of the archive in 
+    ARCHIVE_FOLDER, and the dictionaries of its text columns
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(ARCHIVE_FOLDER, str):
+        raise TypeError (f"function {function_name}: "
+                         f"ARCHIVE_FOLDER must be a string")
+
+############################### Function ######################################
+
+    with open(os.path.join(ARCHIVE_FOLDER, "archive.json"), 
+              encoding = 'utf-8') as file:
+        description = json.load(file)
+    if (description['version'] != ARCHIVE_VERSION or 
+            description['prepared_data_version'] != PREPARED_DATA_VERSION):
+        raise ValueError (f"function {function_name}: "
+                          f"the archive in {ARCHIVE_FOLDER} was written by a "
+                          f"different version, export it again")
+
+    def open_column(name, rows):
+        filename = os.path.join(ARCHIVE_FOLDER, f"{name}.npy")
+        # An empty file cannot be memory mapped
+        return np.load(filename, mmap_mode = 'r' if rows > 0 else None)
+
+    archive = {'folder': ARCHIVE_FOLDER, 'episodes': {}, 'categories': {}}
+    for column, details in description['episode_columns'].items():
+        archive['episodes'][column] = open_column(f"episode_{column}", 
+                                                  description['episodes'])
+        if details['kind'] == 'category':
+            archive['categories'][column] = pd.CategoricalDtype(
+                                                    details['categories'])
+        elif details['kind'] == 'text':
+            archive['categories'][column] = np.array(
+                            details['categories'] + [np.nan], dtype = object)
+    archive['episode_index'] = open_column("episode_index", 
+                                           description['episodes'])
+    archive['contacts'] = {column: open_column(f"contact_{column}", 
+                                               description['contacts'])
+                           for column in description['contact_columns']}
+    for name in ['client_ids', 'episode_start', 'episode_count', 
+                 'contact_start', 'contact_count']:
+        archive[name] = open_column(name, description['clients'])
+    return archive
+
+# %% [markdown]
+# ## Define function: prepare_data
+# 
+# Clean the data read from the input file (replace or remove missing values and
+# format the dates), and calculate the new variables used by the timelines: 
+# length of stay, service use cost and the dates in matplotlib date format.
+# The cleaning, length of stay and cost are done in one pass (clean_data), 
+# which copies the rows kept once.
+#
+# The contacts are moved into a separate contact table (create_contact_table),
+# which is returned with the episodes.
+
+# %%
+def prepare_data(df, KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT, 
+                 REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES, report = None):
+    """
+    Clean the dataframe and calculate the length of stay, service use cost 
+    and matplotlib dates for each episode. Return the episodes and the contact
+    table. Each step is recorded in the report (if not None)
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if (type(KEEP_MISSING_COST) not in [bool]):
+        raise TypeError (f"function {function_name}: "
+                         f"KEEP_MISSING_COST must be a boolean")
+
+    if (type(ZERO_LOS_REPLACEMENT) not in [int, float]):
+        raise TypeError (f"function {function_name}: "
+                         f"ZERO_LOS_REPLACEMENT must be a number")
+
+############################### Function ######################################
+
+    # CLEAN DATA
+    # Replace and remove missing values, format the dates and calculate the 
+    # length of stay and service use cost
+    with record_stage(report, 'clean', episodes = len(df)):
+        df = clean_data(df, KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT, 
+                        REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES)
+
+    # Calculate mdate
+    with record_stage(report, 'calculate_mdate', episodes = len(df)):
+        column_name = ["ReferralRequest", "ReferralDate", 
+                       "ReferralDischarge", "date_of_birth"]
+        df = calculate_mdate(df, column_name)
+
+    # Move the contacts into the contact table
+    with record_stage(report, 'contact_table', episodes = len(df)):
+        df, contacts = create_contact_table(df)
+
+    return df, contacts
+
+# %% [markdown]
+# ## Define function: query_episodes
+#
+# Return the episodes open on any day from start_date to end_date (dd/mm/yyyy,
+# both included), found with the index from create_interval_index. When
+# end_date is None, the episodes open on start_date. For example, the OOA
+# episodes that overlap a quarter:
+#
+#     query_episodes(df, interval_index, '01/04/2016', '30/06/2016',
+#                    Setting = 'OOA')
+#
+# Each keyword argument keeps only the episodes with that value (or one of a
+# list of values) in that column, for example WardTeam = 'Team 3'. The episodes
+# are returned in the order they are in df.
+
+# %%
+def query_episodes(df, interval_index, start_date, end_date = None,
+                   **column_values):
+    """
+    Pass the dataframe and dictionary used by create_interval_index. Return
+    the episodes open between start_date and end_date with the column values
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(interval_index, dict):
+        raise TypeError (f"function {function_name}: "
+                         f"interval_index must be a dictionary")
+
+    for column in column_values:
+        if column not in df.columns:
+            raise ValueError (f"function {function_name}: "
+                              f"Dataframe must contain column {column}")
+
+############################### Function ######################################
+
+    first_day = convert_date_to_matplotlibDate(start_date)
+    last_day = convert_date_to_matplotlibDate(end_date or start_date)
+    start, end = interval_index['start'], interval_index['end']
+    max_end = interval_index['max_end']
+
+    # The episodes that start by last_day are the first n_start sorted
+    # episodes, in the first n_blocks blocks
+    n_start = np.searchsorted(start, last_day, side = 'right')
+    n_blocks = -(-n_start // BLOCK_SIZE)
+
+    # Go down the tree to the blocks with an episode open after first_day
+    blocks = []
+    nodes = [(len(max_end) - 1, 0)]
+    while nodes:
+        level, node = nodes.pop()
+        if (node << level) >= n_blocks or max_end[level][node] <= first_day:
+            continue
+        if level == 0:
+            blocks.append(node)
+        else:
+            nodes += [(level - 1, 2 * node + 1), (level - 1, 2 * node)]
+
+    if blocks:
+        positions = (np.array(blocks)[:, np.newaxis] * BLOCK_SIZE +
+                     np.arange(BLOCK_SIZE)).ravel()
+        positions = positions[positions < n_start]
+        positions = positions[end[positions] > first_day]
+    else:
+        positions = np.array([], dtype = np.int64)
+
+    rows = interval_index['rows'][positions]
+    for column, value in column_values.items():
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        rows = rows[df[column].iloc[rows].isin(values).to_numpy()]
+    return df.iloc[np.sort(rows)]
+
+# %% [markdown]
+# ## Define function: query_clients
+#
+# The clients with an episode returned by query_episodes (with the same
+# arguments), for example the clients open to a ward team on a date:
+#
+#     CLIENTS = query_clients(df, interval_index, '01/06/2016',
+#                             WardTeam = 'Team 3')
+#
+# The list can be used as CLIENTS, to create the timelines of these clients.
+
+# %%
+def query_clients(df, interval_index, start_date, end_date = None,
+                  **column_values):
+    """
+    Pass the dataframe and dictionary used by create_interval_index. Return
+    a sorted list of the ClientIDs with an episode open between start_date
+    and end_date with the column values
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+############################### Function ######################################
+
+    episodes = query_episodes(df, interval_index, start_date, end_date,
+                              **column_values)
+    return np.unique(episodes['ClientID'].to_numpy()).tolist()
+
+# %% [markdown]
+# ## Define function: read_prepared_data
+# 
+# Read the prepared data (episodes and contact table) from a file written by 
+# save_prepared_data. The file is read with allow_pickle = False, so reading a 
+# cache file cannot run any code.
+
+# %%
+def read_prepared_data(filename):
+    """
+    Pass the name of the .npz file. Return the episodes and the contact table
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(filename, str):
+        raise TypeError (f"function {function_name}: "
+                         f"filename must be a string")
+
+############################### Function ######################################
+
+    with np.load(filename, allow_pickle = False) as arrays:
+        description = json.loads(arrays['description'].tobytes())
+        tables = []
+        for table, columns in description['tables'].items():
+            data = {}
+            for column, details in columns.items():
+                values = arrays[f"{table}/{column}"]
+                if details['kind'] == 'category':
+                    values = pd.Categorical.from_codes(
+                                values, dtype = pd.CategoricalDtype(
+                                                    details['categories']))
+                elif details['kind'] == 'text':
+                    # The last entry (code -1) is a missing value
+                    values = np.array(details['categories'] + [np.nan], 
+                                      dtype = object)[values]
+                data[column] = values
+            tables.append(pd.DataFrame(data, columns = list(columns), 
+                                       index = pd.Index(
+                                            arrays[f"{table}/index"])))
+    return tuple(tables)
+
+# %% [markdown]
+# ## Define function: read_episode_store
+# 
+# Read the episodes of the clients in CLIENTS ([-1] for all clients) from the 
+# SQLite database created by create_episode_store, through connection (an open
+# sqlite3 connection, which can be used for many reads). Rather than reading 
+# all of the episodes and then keeping the ones needed, the database is asked
+# for only:
+#
+# - the episodes of the clients in CLIENTS (found with the index on ClientID)
+# - the columns that are used (COLUMNS_REQUIRED and Desc)
+# - with the missing values of REPLACE_NAN_COLUMNS replaced 
+#   (REPLACE_NAN_VALUES), and without the episodes with no ReferralDate, as 
+#   prepare_data does
+#
+# The episodes are read PAGE_ROWS rows at a time, in ClientID order, and each
+# page is checked and prepared (prepare_data) like a chunk of 
+# stream_client_data. The ClientID, data and contacts of each client are 
+# returned (yielded) as soon as all of their episodes have been read.
+
+# %%
+PAGE_ROWS = 10000
+
+def read_episode_store(connection, CLIENTS, COLUMNS_REQUIRED, COLUMNS_DTYPE, 
+                       KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT, 
+                       REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES, COMPACT_DATA,
+                       report = None):
+    """
+    Yield the ClientID, the prepared dataframe and the contact table of each 
+    client in CLIENTS, read from the SQLite database open in connection
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(connection, sqlite3.Connection):
+        raise TypeError (f"function {function_name}: "
+                         f"connection must be a sqlite3 connection")
+
+    if not isinstance(CLIENTS, list):
+        raise TypeError (f"function {function_name}: "
+                         f"CLIENTS must be a list")
+
+    for column in ['ClientID', 'ReferralDate']:
+        if column not in COLUMNS_REQUIRED:
+            raise ValueError (f"function {function_name}: "
+                              f"COLUMNS_REQUIRED must contain {column}")
+
+############################### Function ######################################
+
+    # The columns used, with the missing values replaced
+    columns = list(dict.fromkeys(COLUMNS_REQUIRED + ['Desc']))
+    replacement = dict(zip(REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES))
+    expression = {column: f'"{column}"' for column in columns}
+    parameters = []
+    for column in columns:
+        if column in replacement:
+            expression[column] = f'COALESCE("{column}", ?)'
+            parameters.append(replacement[column])
+    select = [f'{expression[column]} AS "{column}"' for column in columns]
+    # The episodes with no ReferralDate are removed (after replacing)
+    where = f'{expression["ReferralDate"]} IS NOT NULL'
+    if 'ReferralDate' in replacement:
+        parameters.append(replacement['ReferralDate'])
+
+    # The clients are held in a temporary table, so any number of clients can
+    # be asked for
+    client_filter = ''
+    if CLIENTS[0] != -1:
+        connection.execute('CREATE TEMP TABLE IF NOT EXISTS selected_clients '
+                           '(ClientID INTEGER PRIMARY KEY)')
+        connection.execute('DELETE FROM selected_clients')
+        connection.executemany('INSERT OR IGNORE INTO selected_clients '
+                               'VALUES (?)', 
+                               [(int(ClientID),) for ClientID in CLIENTS])
+        client_filter = (' AND ClientID IN (SELECT ClientID FROM '
+                         'selected_clients)')
+    cursor = connection.execute(f'SELECT row_id, {", ".join(select)} '
+                                f'FROM episodes WHERE {where}'
+                                f'{client_filter} ORDER BY ClientID, row_id',
+                                parameters)
+    client_position = columns.index('ClientID') + 1
+
+    held = []
+    while True:
+        page = cursor.fetchmany(PAGE_ROWS)
+        rows = held + page
+        # The last client of the page can have more episodes in the next page
+        split = len(rows)
+        if len(page) > 0:
+            while (split > 0 and rows[split - 1][client_position] == 
+                   page[-1][client_position]):
+                split -= 1
+        rows, held = rows[:split], rows[split:]
+
+        if len(rows) > 0:
+            df = pd.DataFrame.from_records(rows, columns = ['row_id'] + 
+                                           columns, index = 'row_id')
+            df.index.name = None
+            # The types of the columns, as read from the input file and 
+            # replaced (a missing text is NaN, not None)
+            for column, dtype in zip(COLUMNS_REQUIRED + ['Desc'], 
+                                     COLUMNS_DTYPE + [['O']]):
+                if 'O' in dtype or column in replacement:
+                    df[column] = df[column].astype(object)
+                    df[column] = df[column].where(df[column].notna(), np.nan)
+                elif float in dtype:
+                    df[column] = df[column].astype(float)
+            # (the columns already replaced are checked when the store is 
+            # created)
+            checked = [(column, dtype) for column, dtype 
+                       in zip(COLUMNS_REQUIRED, COLUMNS_DTYPE) 
+                       if column not in replacement]
+            check_columns_present_and_type(df, 
+                                           [column for column, _ in checked],
+                                           [dtype for _, dtype in checked])
+
+            # The contacts of the clients of the page
+            contact_rows = connection.execute(
+                            'SELECT row_id, ClientID, contact_date, '
+                            'contact_type FROM contacts WHERE ClientID '
+                            f'BETWEEN ? AND ?{client_filter} '
+                            'ORDER BY ClientID, row_id, number', 
+                            (int(rows[0][client_position]), 
+                             int(rows[-1][client_position]))).fetchall()
+
+            df, _ = prepare_data(df, KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT,
+                                 REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES, 
+                                 report)
+            contacts = pd.DataFrame.from_records(contact_rows, columns = [
+                        'episode', 'ClientID', 'contact_date', 'contact_type'])
+            contact_date = contacts.contact_date.astype(object)
+            contacts = pd.DataFrame({
+                'ClientID': contacts.ClientID.astype(int),
+                'episode': contacts.episode.astype(int),
+                'contact_mdate': convert_dates_to_matplotlibDates(
+                        contact_date.where(contact_date.notna(), np.nan)),
+                'contact_type': contacts.contact_type.astype(float)})
+            # Only the contacts of the episodes kept by prepare_data
+            contacts = contacts.loc[contacts.episode.isin(df.index)
+                                    ].reset_index(drop = True)
+            if COMPACT_DATA:
+                df, contacts = compact_data(df, contacts)
+
+            client_contacts = dict(tuple(contacts.groupby('ClientID', 
+                                                          sort = False)))
+            for ClientID, client_data in df.groupby('ClientID', sort = False):
+                yield (ClientID, client_data, 
+                       client_contacts.get(ClientID, contacts.iloc[:0]))
+
+        if len(page) == 0:
+            return
+
+# %% [markdown]
+# ## Define function: record_stage
+# 
+# Used as a with statement around a stage of the run:
+#
+#     with record_stage(report, 'read', episodes = 600):
+#
+# Adds the stage's wall time, CPU time (of this process) and, if the report 
+# traces memory, the peak memory allocated during the stage to the report, 
+# with the details passed (such as the number of episodes). Stages can be 
+# inside other stages: the peak memory of a stage includes the peaks of the 
+# stages inside it.
+#
+# When the report is None nothing is timed or recorded.
+
+# %%
+def record_stage(report, stage, **details):
+    """
+    Return a context manager that records the time and memory of the stage in
+    the report. Return a context manager that does nothing if report is None
+    """
+    if report is None:
+        return contextlib.nullcontext()
+    return _record_stage(report, stage, details)
+
+
+@contextlib.contextmanager
+def _record_stage(report, stage, details):
+    """
+    Time the stage (and trace its peak memory), and add it to the report
+    """
+    peaks = report['_peaks']
+    if report['trace_memory']:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        # The peak so far belongs to the stage this stage is inside
+        if len(peaks) > 0:
+            peaks[-1] = max(peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        peaks.append(0)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    try:
+        yield
+    finally:
+        record = {'stage': stage, **details, 
+                  'wall_seconds': time.perf_counter() - start_wall, 
+                  'cpu_seconds': time.process_time() - start_cpu}
+        if report['trace_memory']:
+            peak = max(tracemalloc.get_traced_memory()[1], peaks.pop())
+            record['peak_mb'] = (peak - start_memory) / 2 ** 20
+            if len(peaks) > 0:
+                peaks[-1] = max(peaks[-1], peak)
+            else:
+                tracemalloc.stop()
+        report['stages'].append(record)
+
+# %% [markdown]
+# ## Define function: missing_values
+# 
+# Replace the missing values (np.nan) with appropriate values.
+
+# %%
+def remove_nan_values(df, column_name):
+    """
+    Remove any episode with a NA value in the columns passed in column_name
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+    
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(column_name, list):
+        raise TypeError (f"function {function_name}: "
+                         f"column_name must be a list")
+
+############################### Function ######################################
+
+    for i in range(len(column_name)):
+        df[column_name[i]].replace(np.nan, "None", inplace=True)
+        df = df[df[column_name[i]] != "None"]
+  
+    return df
+# %% [markdown]
+# ## Define function: render_client_timeline
 # 
-# Based on the user defined variable (KEEP_MISSING_COST), the data is edited ready for the visualisation.
-# The episodes without a cost value are either removed, or replaced with a "Not available" string.
+# Sort the DataFrame containing the service use for a single client, construct
+# the y axis labels and pass the sorted DataFrame to the function to create the 
+# timeline. RENDER_ENGINE selects the function: 'matplotlib' 
+# (create_service_use_timeline) or 'svg' (create_service_use_timeline_svg).
+#
+# The time taken is recorded in the report (if not None), with the number of 
+# episodes and contacts of the client.
+#
+# When pdf (a matplotlib PdfPages) is not None, the timeline is drawn with
+# matplotlib as the next page of the pdf file, rather than saved as a svg file.
+# When HEADLESS, the matplotlib timeline is not shown (plt.show). When writer 
+# is not None, the svg file is written in the background (see 
+# create_svg_writer). SVG_FORMAT is 'svg', 'compact' or 'svgz' (compact and
+# gzip compressed, saved as timeline_{ClientID}.svgz).
 
 # %%
-def edit_cost_data(df, KEEP_MISSING_COST):
+def render_client_timeline(df, contacts, FOLDER, ORDER_ON_COST, RENDER_ENGINE,
+                           report = None, pdf = None, HEADLESS = False, 
+                           writer = None, SVG_FORMAT = 'svg'):
     """
-    The episodes without a cost value are either removed, or replaced with a 
-    "Not available" string. Based on the user defined boolean variable 
-    KEEP_MISSING_COST
+    Pass pandas dataframe containing the data for a single client (df), and 
+    the contact table for the same client (contacts).
+    Sort the episodes, add the y axis labels and create the timeline
     """
 ############################# Argument checking ###############################
-    
     function_name = sys._getframe(  ).f_code.co_name
 
     if not isinstance(df, (pd.DataFrame)):
         raise TypeError (f"function {function_name}: "
                          f"df must be a pandas dataframe")
-    
-    if (type(KEEP_MISSING_COST) not in [bool]):
+
+    if not isinstance(FOLDER, str):
         raise TypeError (f"function {function_name}: "
-                         f"KEEP_MISSING_COST must be a boolean")
+                         f"FOLDER must be a string")
+
+    if (type(ORDER_ON_COST) not in [bool]):
+        raise TypeError (f"function {function_name}: "
+                         f"ORDER_ON_COST must be a boolean")
+
+    if RENDER_ENGINE not in ['matplotlib', 'svg']:
+        raise ValueError (f"function {function_name}: "
+                          f"RENDER_ENGINE must be 'matplotlib' or 'svg'")
+
+    if SVG_FORMAT not in ['svg', 'compact', 'svgz']:
+        raise ValueError (f"function {function_name}: "
+                          f"SVG_FORMAT must be 'svg', 'compact' or 'svgz'")
 
 ############################### Function ######################################
-    
-    if KEEP_MISSING_COST:
-        df.Episode_cost.replace(0, 'Not available', inplace = True)
-    else:
-        df = df[df.Episode_cost > 0]
-    return df
 
+    with record_stage(report, 'render_client', 
+                      ClientID = int(df.ClientID.iloc[0]), 
+                      episodes = len(df), contacts = len(contacts)):
+        df = sort_data(df, ORDER_ON_COST)
+        df = add_string_counter_column(df)
+        # Construct the string for the y axis label
+        # (a missing cost, "Not available", is shown as £0)
+        cost_str = (df.Episode_cost.replace('Not available', 0)
+                    .astype(int).astype(str))
+        df['ylabel'] = (df.counter_str + ". " + df.WardTeam.astype(object) + 
+                        ". (Referral Source: " + 
+                        df.ReferralSource.astype(object) + ")" + 
+                        ". Cost = £" + cost_str)
+        if RENDER_ENGINE == 'svg' and pdf is None:
+            create_service_use_timeline_svg(df, contacts, FOLDER, writer, 
+                                            SVG_FORMAT)
+        else:
+            create_service_use_timeline(df, contacts, FOLDER, pdf, HEADLESS, 
+                                        writer, SVG_FORMAT)
+    return
 
 # %% [markdown]
-# ## Define function: format_date_variables
+# ## Define function: render_timelines_in_parallel
 # 
-# Use one lists to set up the necessary changes. 
-# column_name: list the columns to check.
-# Convert the format into datetime, and store in new column.
+# Render the timelines for many clients at once, using a pool of worker 
+# processes (N_WORKERS). client_groups provides the ClientID, the data and the
+# contacts of each client (for example from get_client_data or 
+# stream_client_data). The clients are sent to the workers in batches of 
+# CHUNK_SIZE clients, with no more than two batches per worker waiting, so 
+# the memory used does not grow with the number of clients.
+#
+# The workers use the non-interactive Agg backend, so no windows are opened.
+# A client whose timeline cannot be created does not stop the run: the error 
+# is collected and returned (a dictionary of ClientID: error message).
+#
+# Each worker records its clients in a report of its own, which is added to 
+# the report (if not None) when the batch is returned.
+#
+# When ARCHIVE_FOLDER is not None, the data and contacts in client_groups can 
+# be None: each worker then reads the client's data from the archive (see 
+# open_episode_archive) itself, rather than being sent a copy of it.
+
 # %%
-def format_date_variables(df, column_name):
+# The archives opened by this worker process
+_open_archives = {}
+
+def _initialise_render_worker():
     """
-    Convert the columns passed in column_name to datetime format.
-    Store new format in new column
+    Switch the worker process to the non-interactive Agg backend
+    """
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+
+def _render_client_batch(batch, TRACE_MEMORY):
+    """
+    Create the timeline for each client in the batch, in a worker process. 
+    Return a list of the ClientID, and the error message (None if the timeline 
+    was created), and the stages recorded (None if TRACE_MEMORY is None)
+    """
+    report = None if TRACE_MEMORY is None else create_report(TRACE_MEMORY)
+    results = []
+    for (ClientID, df, contacts, FOLDER, ORDER_ON_COST, RENDER_ENGINE, 
+         SVG_FORMAT, ARCHIVE_FOLDER) in batch:
+        try:
+            if df is None:
+                if ARCHIVE_FOLDER not in _open_archives:
+                    _open_archives[ARCHIVE_FOLDER] = open_episode_archive(
+                                                            ARCHIVE_FOLDER)
+                df, contacts = get_archived_client(
+                                    _open_archives[ARCHIVE_FOLDER], ClientID)
+            render_client_timeline(df, contacts, FOLDER, ORDER_ON_COST, 
+                                   RENDER_ENGINE, report, HEADLESS = True, 
+                                   SVG_FORMAT = SVG_FORMAT)
+        except Exception as error:
+            import matplotlib.pyplot as plt
+            plt.close('all')
+            results.append((ClientID, f"{type(error).__name__}: {error}"))
+        else:
+            results.append((ClientID, None))
+    return results, None if report is None else report['stages']
+
+
+def render_timelines_in_parallel(client_groups, FOLDER, ORDER_ON_COST, 
+                                 RENDER_ENGINE, N_WORKERS, CHUNK_SIZE, 
+                                 report = None, SVG_FORMAT = 'svg', 
+                                 ARCHIVE_FOLDER = None):
+    """
+    Create the timeline for each (ClientID, dataframe, contacts) in 
+    client_groups using N_WORKERS processes. Return a dictionary of the 
+    clients whose timeline could not be created, and the reason
     """
 ############################# Argument checking ###############################
     function_name = sys._getframe(  ).f_code.co_name
-    
-    if not isinstance(df, (pd.DataFrame)):
+
+    if not isinstance(FOLDER, str):
         raise TypeError (f"function {function_name}: "
-                         f"df must be a pandas dataframe")
+                         f"FOLDER must be a string")
 
-    if not isinstance(column_name, list):
+    if N_WORKERS is not None and (type(N_WORKERS) not in [int] 
+                                  or N_WORKERS < 1):
         raise TypeError (f"function {function_name}: "
-                         f"column_name must be a list")
+                         f"N_WORKERS must be a positive integer, or None")
+
+    if (type(CHUNK_SIZE) not in [int]) or CHUNK_SIZE < 1:
+        raise TypeError (f"function {function_name}: "
+                         f"CHUNK_SIZE must be a positive integer")
 
 ############################### Function ######################################
 
-    for i in range(len(column_name)):
-        df[f"{column_name[i]}_format"] = (
-                                    pd.to_datetime(df[f"{column_name[i]}"], 
-                                    format="%d/%m/%Y"))
-    return df
+    n_workers = N_WORKERS or os.cpu_count() or 1
+    trace_memory = None if report is None else report['trace_memory']
+    failures = {}
+    pending = set()
+
+    def collect_results(done):
+        for future in done:
+            results, stages = future.result()
+            for ClientID, error in results:
+                if error is not None:
+                    failures[ClientID] = error
+            if report is not None:
+                report['stages'].extend(stages)
+
+    with ProcessPoolExecutor(max_workers = n_workers, 
+                             initializer = _initialise_render_worker) as pool:
+        batch = []
+        for ClientID, df, contacts in client_groups:
+            batch.append((ClientID, df, contacts, FOLDER, ORDER_ON_COST, 
+                          RENDER_ENGINE, SVG_FORMAT, ARCHIVE_FOLDER))
+            if len(batch) < CHUNK_SIZE:
+                continue
+            pending.add(pool.submit(_render_client_batch, batch, 
+                                    trace_memory))
+            batch = []
+            # Wait for a batch to finish before reading more clients
+            if len(pending) >= 2 * n_workers:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                collect_results(done)
+        if len(batch) > 0:
+            pending.add(pool.submit(_render_client_batch, batch, 
+                                    trace_memory))
+        collect_results(wait(pending).done)
+    return failures
 
 # %% [markdown]
-# ## Define function: missing_values
+# ## Define function: render_timelines_to_pdf
 # 
-# Replace the missing values (np.nan) with appropriate values.
+# Rather than a svg file per client, write the timelines of all the clients in
+# client_groups (ClientID, data and contacts of each client, as for 
+# render_timelines_in_parallel) into a single pdf file, BUNDLE_NAME.pdf in 
+# FOLDER. OUTPUT_MODE selects the layout:
+#
+# - 'pdf': one timeline per page, as drawn by create_service_use_timeline
+# - 'overview': small multiples, OVERVIEW_ROWS x OVERVIEW_COLUMNS clients per
+#   (A4 landscape) page at reduced detail (create_client_overview)
+#
+# Each page is written to the file as soon as it is drawn, and its figure 
+# closed, so the memory used does not grow with the number of clients. The
+# file is written to a temporary name first, and renamed when complete.
 
 # %%
-def remove_nan_values(df, column_name):
+OVERVIEW_ROWS = 6
+OVERVIEW_COLUMNS = 3
+
+def render_timelines_to_pdf(client_groups, FOLDER, BUNDLE_NAME, ORDER_ON_COST,
+                            OUTPUT_MODE, report = None):
     """
-    Remove any episode with a NA value in the columns passed in column_name
+    Create the timeline for each (ClientID, dataframe, contacts) in 
+    client_groups as pages of the pdf file BUNDLE_NAME.pdf in FOLDER
     """
 ############################# Argument checking ###############################
     function_name = sys._getframe(  ).f_code.co_name
-    
-    if not isinstance(df, (pd.DataFrame)):
-        raise TypeError (f"function {function_name}: "
-                         f"df must be a pandas dataframe")
 
-    if not isinstance(column_name, list):
+    if not isinstance(FOLDER, str):
         raise TypeError (f"function {function_name}: "
-                         f"column_name must be a list")
+                         f"FOLDER must be a string")
+
+    if OUTPUT_MODE not in ['pdf', 'overview']:
+        raise ValueError (f"function {function_name}: "
+                          f"OUTPUT_MODE must be 'pdf' or 'overview'")
 
 ############################### Function ######################################
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    filename = os.path.join(FOLDER, f"{BUNDLE_NAME}.pdf")
+    per_page = OVERVIEW_ROWS * OVERVIEW_COLUMNS
+
+    def save_page(fig, axes, n_used):
+        for ax in axes[n_used:]:
+            ax.set_visible(False)
+        fig.tight_layout()
+        pdf.savefig(fig)
+        plt.close(fig)
+
+    # No creation date, so the same timelines always give the same file
+    with PdfPages(f"{filename}.tmp", 
+                  metadata = {'CreationDate': None}) as pdf:
+        if OUTPUT_MODE == 'pdf':
+            for ClientID, df, contacts in client_groups:
+                render_client_timeline(df, contacts, FOLDER, ORDER_ON_COST, 
+                                       'matplotlib', report, pdf)
+        else:
+            n_clients = 0
+            for ClientID, df, contacts in client_groups:
+                if n_clients % per_page == 0:
+                    if n_clients > 0:
+                        save_page(fig, axes, per_page)
+                    fig, axes = plt.subplots(OVERVIEW_ROWS, OVERVIEW_COLUMNS,
+                                             figsize = (11.69, 8.27))
+                    axes = axes.ravel()
+                with record_stage(report, 'render_client', 
+                                  ClientID = int(ClientID), 
+                                  episodes = len(df), 
+                                  contacts = len(contacts)):
+                    create_client_overview(axes[n_clients % per_page], 
+                                           sort_data(df, ORDER_ON_COST), 
+                                           contacts)
+                n_clients += 1
+            if n_clients > 0:
+                save_page(fig, axes, (n_clients - 1) % per_page + 1)
+    os.replace(f"{filename}.tmp", filename)
+    return
 
-    for i in range(len(column_name)):
-        df[column_name[i]].replace(np.nan, "None", inplace=True)
-        df = df[df[column_name[i]] != "None"]
-  
-    return df
 # %% [markdown]
 # ## Define function: missing_values
 # 
@@ -634,6 +3108,176 @@ def replace_nan_values(df, column_name, replacement_value):
   
     return df
 
+# %% [markdown]
+# ## Define function: round_svg_numbers
+# 
+# matplotlib writes the coordinates of a svg file with up to 6 decimals. Round
+# every number in the svg file (data, bytes) that has more than DECIMALS 
+# decimals to DECIMALS decimals (1/100 of a point is much less than a pixel).
+#
+# Only the numbers in the tags (SVG_TAG: the attribute values, such as the 
+# path data d= and points=, and the positions and transforms) are rounded. 
+# The content of the elements (the labels of <text>, such as costs and 
+# dates), the comments and the style sheet are not changed.
+
+# %%
+SVG_TAG = re.compile(rb'<[^!?>][^>]*>')
+SVG_NUMBER = re.compile(rb'-?\d+\.\d{3,}')
+DECIMALS = 2
+
+def round_svg_numbers(data):
+    """
+    Return the svg file (bytes) with the numbers of its tags rounded to 
+    DECIMALS decimals
+    """
+    def round_number(match):
+        number = f"{float(match.group()):.{DECIMALS}f}".rstrip('0').rstrip('.')
+        return (number if number != '-0' else '0').encode()
+
+    def round_tag(match):
+        return SVG_NUMBER.sub(round_number, match.group())
+
+    return SVG_TAG.sub(round_tag, data)
+
+# %% [markdown]
+# ## Define function: save_report
+# 
+# Save the report (see create_report) as json. Each stage is a dictionary of 
+# the stage name, its details (such as ClientID and the number of episodes 
+# and contacts), wall_seconds, cpu_seconds and, if memory was traced, peak_mb.
+
+# %%
+def save_report(report, REPORT_FILE):
+    """
+    Save the report to REPORT_FILE as json
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(REPORT_FILE, str):
+        raise TypeError (f"function {function_name}: "
+                         f"REPORT_FILE must be a string")
+
+############################### Function ######################################
+
+    with open(f"{REPORT_FILE}.tmp", 'w', encoding = 'utf-8') as file:
+        json.dump({key: value for key, value in report.items() 
+                   if not key.startswith('_')}, file, indent = 1)
+    os.replace(f"{REPORT_FILE}.tmp", REPORT_FILE)
+
+# %% [markdown]
+# ## Define function: save_prepared_data
+# 
+# Save the prepared data (episodes and contact table) to filename, a numpy 
+# .npz file with one array per column, for load_prepared_data. The numbers and
+# dates are stored as they are, and the text columns (and the mixed text and 
+# number cost column) as integer codes, with the values of the codes in a json
+# description stored in the same file, as in create_episode_archive. Unlike a
+# pickle file, it holds no code, and does not depend on the pandas version.
+
+# %%
+def save_prepared_data(df, contacts, filename):
+    """
+    Pass the episodes and contact table returned by prepare_data, and the name
+    of the .npz file to write them to
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(df, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"df must be a pandas dataframe")
+
+    if not isinstance(contacts, (pd.DataFrame)):
+        raise TypeError (f"function {function_name}: "
+                         f"contacts must be a pandas dataframe")
+
+############################### Function ######################################
+
+    arrays = {}
+    description = {'tables': {}}
+    for table, data in [('episodes', df), ('contacts', contacts)]:
+        columns = {}
+        for column in data.columns:
+            values = data[column]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                columns[column] = {'kind': 'category', 
+                                   'categories': 
+                                        values.cat.categories.tolist()}
+                values = values.cat.codes
+            elif values.dtype == object:
+                codes, categories = pd.factorize(values)
+                columns[column] = {'kind': 'text', 
+                                   'categories': 
+                                        pd.Index(categories).tolist()}
+                values = codes.astype(np.int32)
+            elif (pd.api.types.is_numeric_dtype(values) or 
+                      pd.api.types.is_datetime64_dtype(values)):
+                columns[column] = {'kind': 'array'}
+            else:
+                raise TypeError (f"function {function_name}: "
+                                 f"column {column} cannot be saved")
+            arrays[f"{table}/{column}"] = np.asarray(values)
+        arrays[f"{table}/index"] = data.index.to_numpy()
+        description['tables'][table] = columns
+    arrays['description'] = np.frombuffer(json.dumps(description).encode(), 
+                                          dtype = np.uint8)
+
+    with open(filename, 'wb') as file:
+        np.savez(file, **arrays)
+    return
+
+# %% [markdown]
+# ## Define function: select_changed_clients
+# 
+# Pass on (yield) only the clients whose timeline needs to be created: those 
+# whose data or variables have changed since the last run (the hash is 
+# different to the one in the manifest), and those whose svg (or svgz, see 
+# SVG_FORMAT) file is missing.
+#
+# The hash of every client is stored in new_manifest, to be saved by 
+# update_timeline_manifest once the timelines have been created.
+
+# %%
+def select_changed_clients(client_groups, FOLDER, manifest, new_manifest, 
+                           ORDER_ON_COST, RENDER_ENGINE, SVG_FORMAT = 'svg'):
+    """
+    Yield the (ClientID, dataframe, contacts) in client_groups whose timeline
+    is out of date or missing. Store the hash of each client in new_manifest
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(manifest, dict):
+        raise TypeError (f"function {function_name}: "
+                         f"manifest must be a dictionary")
+
+    if not isinstance(new_manifest, dict):
+        raise TypeError (f"function {function_name}: "
+                         f"new_manifest must be a dictionary")
+
+############################### Function ######################################
+
+    options = repr((TIMELINE_VERSION, ORDER_ON_COST, RENDER_ENGINE, 
+                    SVG_FORMAT)).encode()
+    extension = 'svgz' if SVG_FORMAT == 'svgz' else 'svg'
+    for ClientID, df, contacts in client_groups:
+        client_hash = hashlib.sha256(options)
+        client_hash.update(repr(list(df.columns)).encode())
+        client_hash.update(
+                pd.util.hash_pandas_object(df, index = False).to_numpy())
+        # The contacts are matched to their episode by position in df
+        contact_episode = contacts.assign(
+                            episode = df.index.get_indexer(contacts.episode))
+        client_hash.update(pd.util.hash_pandas_object(
+                                contact_episode, index = False).to_numpy())
+        client_hash = client_hash.hexdigest()
+        new_manifest[str(ClientID)] = client_hash
+        filename = f'{FOLDER}/timeline_{str(ClientID)}.{extension}'
+        if (manifest.get(str(ClientID)) != client_hash or not 
+                os.path.exists(filename)):
+            yield ClientID, df, contacts
+
 # %% [markdown]
 # ## Define function: sort_data
 # 
@@ -658,12 +3302,231 @@ def sort_data(df, ORDER_ON_COST):
                          f"ORDER_ON_COST must be a boolean")
 
 ############################### Function ######################################
+    # A stable sort keeps episodes that tie in their original (file) order
     if ORDER_ON_COST:
-        df = df.sort_values(['Episode_cost'], ascending = [False])
+        df = df.sort_values(['Episode_cost'], ascending = [False], 
+                            kind = 'mergesort')
     else:
-        df = df.sort_values(['ReferralDate_mdate'], ascending = [True])
+        df = df.sort_values(['ReferralDate_mdate'], ascending = [True], 
+                            kind = 'mergesort')
     return df   
 
+# %% [markdown]
+# ## Define function: stream_client_data
+# 
+# For input files too large to read into memory at once. The file is read 
+# STREAM_CHUNK_ROWS rows at a time, keeping only the columns that are used 
+# (COLUMNS_REQUIRED and Desc) and the rows for the clients in CLIENTS. Each 
+# chunk is checked and cleaned (prepare_data) as it is read.
+#
+# The episodes of a client do not need to be next to each other in the file. 
+# A first, quick, pass reads only the ClientID column to find the row of the 
+# last episode of each client. The cleaned episodes are then kept until the 
+# last episode of the client has been read, and the client's data is returned 
+# (yielded) as one DataFrame, with their contact table. Only the clients with 
+# episodes still to be read are held in memory.
+
+# %%
+def _input_column_types(filename, COLUMNS_REQUIRED, COLUMNS_DTYPE):
+    """
+    Return the types to read the columns of the input file with: the text 
+    columns as text even if all of the values in a chunk are missing, and the 
+    columns that can have missing numbers as float even if none are missing, 
+    so every chunk has the same types as when reading the whole file. All of 
+    the contact columns are included, however many there are
+    """
+    column_types = {'Desc': object}
+    for column, dtype in zip(COLUMNS_REQUIRED, COLUMNS_DTYPE):
+        if 'O' in dtype:
+            column_types[column] = object
+        elif float in dtype:
+            column_types[column] = float
+    for column in pd.read_csv(filename, nrows = 0).columns:
+        if re.fullmatch(r'contact_date_\d+', column):
+            column_types[column] = object
+        elif re.fullmatch(r'contact_type_\d+', column):
+            column_types[column] = float
+    return column_types
+
+
+def stream_client_data(FOLDER, FILENAME, CLIENTS, COLUMNS_REQUIRED, 
+                       COLUMNS_DTYPE, KEEP_MISSING_COST, ZERO_LOS_REPLACEMENT,
+                       REPLACE_NAN_COLUMNS, REPLACE_NAN_VALUES, 
+                       STREAM_CHUNK_ROWS, COMPACT_DATA, report = None):
+    """
+    Read the input file in chunks of STREAM_CHUNK_ROWS rows. Yield the 
+    ClientID, the prepared dataframe and the contact table for each client, 
+    once all of the client's episodes have been read
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(CLIENTS, list):
+        raise TypeError (f"function {function_name}: "
+                         f"CLIENTS must be a list")
+
+    if (type(STREAM_CHUNK_ROWS) not in [int]) or STREAM_CHUNK_ROWS < 1:
+        raise TypeError (f"function {function_name}: "
+                         f"STREAM_CHUNK_ROWS must be a positive integer")
+
+############################### Function ######################################
+
+    filename = f"{FOLDER}{FILENAME}.csv"
+    all_clients = CLIENTS[0] == -1
+
+    # First pass: the row number of the last episode of each client
+    last_row = {}
+    rows_read = 0
+    for chunk in pd.read_csv(filename, usecols = ['ClientID'], 
+                             chunksize = STREAM_CHUNK_ROWS):
+        client_ids = chunk.ClientID.to_numpy()
+        # np.unique on the reversed array finds the last row of each client
+        unique_ids, reverse_row = np.unique(client_ids[::-1], 
+                                            return_index = True)
+        last_row.update(zip(unique_ids.tolist(), 
+                            (rows_read + len(client_ids) - 1 - 
+                             reverse_row).tolist()))
+        rows_read += len(client_ids)
+
+    # Second pass: read, check and clean each chunk
+    column_types = _input_column_types(filename, COLUMNS_REQUIRED, 
+                                       COLUMNS_DTYPE)
+    buffer = {}
+    rows_read = 0
+    for chunk in pd.read_csv(filename, 
+                             usecols = (set(COLUMNS_REQUIRED) | 
+                                        set(column_types)),
+                             dtype = column_types, 
+                             chunksize = STREAM_CHUNK_ROWS):
+        rows_read += len(chunk)
+        check_columns_present_and_type(chunk, COLUMNS_REQUIRED, COLUMNS_DTYPE)
+        if not all_clients:
+            chunk = chunk.loc[chunk['ClientID'].isin(CLIENTS)]
+        if len(chunk) > 0:
+            chunk, contacts = prepare_data(chunk, KEEP_MISSING_COST, 
+                                           ZERO_LOS_REPLACEMENT, 
+                                           REPLACE_NAN_COLUMNS, 
+                                           REPLACE_NAN_VALUES, report)
+            if COMPACT_DATA:
+                chunk, contacts = compact_data(chunk, contacts)
+            client_contacts = dict(tuple(contacts.groupby('ClientID', 
+                                                          sort = False)))
+            for ClientID, client_data in chunk.groupby('ClientID', 
+                                                       sort = False):
+                buffer.setdefault(ClientID, []).append(
+                        (client_data, 
+                         client_contacts.get(ClientID, contacts.iloc[:0])))
+
+        # Yield the clients whose last episode has been read
+        complete = [ClientID for ClientID in buffer 
+                    if last_row[ClientID] < rows_read]
+        for ClientID in complete:
+            client_data = buffer.pop(ClientID)
+            if len(client_data) == 1:
+                yield ClientID, client_data[0][0], client_data[0][1]
+            else:
+                yield (ClientID, pd.concat([data for data, _ in client_data]),
+                       pd.concat([contacts for _, contacts in client_data]))
+
+# %% [markdown]
+# ## Define function: update_timeline_manifest
+# 
+# Save the manifest of the timelines created in this run (new_manifest). A 
+# client whose timeline could not be created (in failures) keeps its entry of
+# the old manifest (if any) and its last timeline, so it is tried again on 
+# the next run (its hash is still out of date, or its file is missing).
+#
+# If this run was for all clients (ALL_CLIENTS), the timelines of the clients 
+# in the old manifest that are no longer in the data (not in new_manifest, 
+# failed or not) are deleted. Otherwise the old manifest entries of the other
+# clients are kept.
+
+# %%
+def update_timeline_manifest(FOLDER, manifest, new_manifest, failures, 
+                             ALL_CLIENTS):
+    """
+    Save new_manifest in FOLDER, with the old entries of the clients in 
+    failures. Delete the timelines of the clients that are no longer in the 
+    data
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if not isinstance(FOLDER, str):
+        raise TypeError (f"function {function_name}: "
+                         f"FOLDER must be a string")
+
+    if (type(ALL_CLIENTS) not in [bool]):
+        raise TypeError (f"function {function_name}: "
+                         f"ALL_CLIENTS must be a boolean")
+
+############################### Function ######################################
+
+    # The clients no longer in the data, before the failed clients (which are
+    # still in the data) are taken out of new_manifest
+    removed = manifest.keys() - new_manifest.keys()
+    for ClientID in failures:
+        new_manifest.pop(str(ClientID), None)
+        if str(ClientID) in manifest:
+            new_manifest[str(ClientID)] = manifest[str(ClientID)]
+
+    if ALL_CLIENTS:
+        for ClientID in removed:
+            for filename in [f'{FOLDER}/timeline_{ClientID}.svg', 
+                             f'{FOLDER}/timeline_{ClientID}.svgz']:
+                if os.path.exists(filename):
+                    os.remove(filename)
+    else:
+        new_manifest = {**manifest, **new_manifest}
+
+    manifest_file = os.path.join(FOLDER, 'timelines_manifest.json')
+    with open(f"{manifest_file}.tmp", 'w', encoding = 'utf-8') as file:
+        json.dump({'version': TIMELINE_VERSION, 'clients': new_manifest}, 
+                  file, indent = 1)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
+    return
+
+# %% [markdown]
+# ## Define function: write_svg
+# 
+# Write the svg file of a timeline (data, the bytes of the file). The file is 
+# written to a temporary name and then renamed, so a file that is being 
+# written (or a run that stops part way through writing) never leaves an 
+# incomplete timeline.
+#
+# When writer (see create_svg_writer) is None the file is written now, 
+# otherwise it is queued to be written by the writer's threads. A .svgz file 
+# is gzip compressed (by the writer's threads, when there are any).
+
+# %%
+def write_svg(writer, filename, data):
+    """
+    Pass the svg writer (or None), the name of the file and its content 
+    (bytes)
+    """
+    def write_file(filename, data):
+        if filename.endswith('.svgz'):
+            # mtime 0, so the same timeline gives the same file
+            data = gzip.compress(data, mtime = 0)
+        with open(f"{filename}.tmp", 'wb') as svg_file:
+            svg_file.write(data)
+        os.replace(f"{filename}.tmp", filename)
+
+    if writer is None:
+        write_file(filename, data)
+        return
+
+    def file_written(future):
+        writer['queue'].release()
+        if future.exception() is not None:
+            writer['errors'].append(future.exception())
+
+    # Wait for a place in the queue
+    writer['queue'].acquire()
+    writer['pool'].submit(write_file, filename, data).add_done_callback(
+                                                                file_written)
+    return
+
 # %% [markdown]
 
 ## User defined variables
@@ -689,8 +3552,129 @@ def sort_data(df, ORDER_ON_COST):
 # *CLIENTS*: a list of the client ids for who to create a timeline for. If want 
 # all the clients in the dataset then provide a list with a single "-1" 
 # element: [-1]
+#
+# *CLIENTS_QUERY*: when set, CLIENTS is not used: the timelines are created 
+# for the clients with an episode open on a date, or during a range of dates, 
+# with the arguments of query_clients. For example {'start_date': 
+# '01/06/2016', 'WardTeam': 'Team 3'} for the clients open to a ward team on 
+# a date, or {'start_date': '01/04/2016', 'end_date': '30/06/2016', 
+# 'Setting': 'OOA'} for the clients with an OOA episode during a quarter. 
+# When set to None CLIENTS is used. Not available with STREAM_CHUNK_ROWS, 
+# DATABASE or ARCHIVE_FOLDER.
+#
+# *REPLACE_NAN_COLUMNS*, *REPLACE_NAN_VALUES*: the value used in place of a 
+# missing value, for each of the listed columns.
+#
+# *COMPACT_DATA*: when set to true, the cleaned data is stored in compact 
+# types (see compact_data), which uses several times less memory per episode.
+#
+# *POPULATION_GROUP*: when set to 'Service', 'Setting' or 'Locality', also 
+# create a stacked timeline of the number of clients in, and the daily spend 
+# on, each group of services on each day, for all of the clients in CLIENTS 
+# (see calculate_population_occupancy). When set to None it is not created. 
+# Not available with STREAM_CHUNK_ROWS, DATABASE or ARCHIVE_FOLDER.
+#
+# *CACHE_FOLDER*: the folder to store the cleaned data in, so that the next run
+# with the same input file and the same variables above does not need to clean
+# it again. When set to None the cleaned data is not stored.
+#
+# *INCREMENTAL*: when set to true, only the timelines of the clients whose data
+# (or the variables used to create the timelines) has changed since the last 
+# run are created again. A record of each client's data (a manifest) is kept 
+# in FOLDER. When creating the timelines for all clients ([-1]), the timelines
+# of clients no longer in the input file are deleted.
+#
+# *STREAM_CHUNK_ROWS*: when set to a number, the input file is read and 
+# cleaned that many rows at a time, and each client's timeline is created as 
+# soon as all of their episodes have been read. This keeps the memory used 
+# small for very large input files. When set to None the whole file is read at
+# once (and CACHE_FOLDER can be used).
+#
+# *DATABASE*: when set to the name of a SQLite database file, the episodes are
+# read from the database rather than the input file: only the episodes of the 
+# clients in CLIENTS, and only the columns used, are read (see 
+# read_episode_store). If the file does not exist it is first created from 
+# the input file (see create_episode_store). When set to None the input file 
+# is read.
+#
+# *ARCHIVE_FOLDER*: when set to the folder of an archive of the prepared data
+# (written by python export_data.py --archive ARCHIVE_FOLDER, see 
+# create_episode_archive), each client's episodes are read from the archive 
+# rather than the input file. With more than one process (N_WORKERS), each 
+# process reads its clients from the archive itself. Export the archive again
+# when the input file or the variables used to prepare it change. When set to
+# None the input file is read.
+#
+# *RENDER_ENGINE*: how to create the timelines. When set to 'matplotlib' the 
+# timelines are drawn with matplotlib. When set to 'svg' the svg files are 
+# written directly, which is much faster when creating many timelines.
+#
+# *OUTPUT_MODE*: where to save the timelines. When set to 'files' each 
+# timeline is saved as a svg file (timeline_{ClientID}.svg). When set to 'pdf'
+# the timelines are saved as the pages of a single pdf file, BUNDLE_NAME.pdf, 
+# one timeline per page. When set to 'overview' the pdf file has several 
+# timelines per page, at reduced detail, to compare a group of clients (see 
+# render_timelines_to_pdf). The pdf files are drawn with matplotlib, in a 
+# single process, and are always created in full (not INCREMENTAL).
+#
+# *BUNDLE_NAME*: the name of the pdf file (in FOLDER) for OUTPUT_MODE 'pdf' 
+# and 'overview'.
+#
+# *HEADLESS*: when set to true, the charts are drawn with matplotlib's 
+# non-interactive Agg backend and are not shown (no plt.show), only saved. Use
+# this when creating many timelines, or on a server without a display.
+#
+# *SVG_FORMAT*: how to write the svg files. When set to 'svg' the files are 
+# written as before. When set to 'compact' the files look the same but are 
+# smaller: the styles of the bars and the contact markers are defined once 
+# and reused, the text is written as text (rather than the outline of each 
+# letter) and the coordinates are rounded to the precision of the display. 
+# When set to 'svgz' the compact files are also gzip compressed 
+# (timeline_{ClientID}.svgz, which browsers and svg editors open directly).
+#
+# *N_WRITERS*: the number of threads writing the svg files in the background, 
+# while the next timelines are drawn (see create_svg_writer). This is faster 
+# when the files are saved to slow storage, such as a network share. When set 
+# to 0 each file is written before the next timeline is drawn. Not used with 
+# more than one process (N_WORKERS), where each process writes its own files.
+#
+# *WRITE_QUEUE_DEPTH*: the number of svg files that can wait to be written 
+# in the background. When the queue is full, drawing waits for a file to be 
+# written.
+#
+# *N_WORKERS*: the number of processes used to create the timelines. When set 
+# to 1 the timelines are created one at a time. When set to None one process 
+# per CPU core is used.
+#
+# *CHUNK_SIZE*: when using more than one process, the number of clients sent to
+# a process at a time.
+#
+# *REPORT_FILE*: the json file to save a report of the run to: the wall time 
+# and CPU time of each stage (reading, cleaning, ...) and of each client's 
+# timeline, with the client's number of episodes and contacts. When set to 
+# None no report is made, and nothing is timed.
+#
+# *REPORT_MEMORY*: when set to true, the report also has the peak memory 
+# allocated in each stage. Tracing the memory makes the run slower.
+#
+# The variables are returned as a named tuple (UserVariables), so the main 
+# code and the other scripts read each of them by its name (for example 
+# variables.FOLDER). A new variable is added to the fields of UserVariables 
+# and set in user_defined_variables.
 
 # %%
+UserVariables = namedtuple('UserVariables', [
+                    'FOLDER', 'FILENAME', 'KEEP_MISSING_COST', 'ORDER_ON_COST',
+                    'ZERO_LOS_REPLACEMENT', 'CLIENTS', 'COLUMNS_REQUIRED',
+                    'COLUMNS_DTYPE', 'RENDER_ENGINE', 'N_WORKERS',
+                    'CHUNK_SIZE', 'REPLACE_NAN_COLUMNS', 'REPLACE_NAN_VALUES',
+                    'CACHE_FOLDER', 'STREAM_CHUNK_ROWS', 'INCREMENTAL',
+                    'REPORT_FILE', 'REPORT_MEMORY', 'COMPACT_DATA',
+                    'POPULATION_GROUP', 'CLIENTS_QUERY', 'OUTPUT_MODE',
+                    'BUNDLE_NAME', 'HEADLESS', 'N_WRITERS',
+                    'WRITE_QUEUE_DEPTH', 'SVG_FORMAT', 'DATABASE',
+                    'ARCHIVE_FOLDER'])
+
 def user_defined_variables():
     # the input data filename
     FILENAME = 'mock_carenotes'
@@ -702,30 +3686,84 @@ def user_defined_variables():
     KEEP_MISSING_COST = True
     ORDER_ON_COST = False
     ZERO_LOS_REPLACEMENT = 0.5
+    REPLACE_NAN_COLUMNS = ["ReferralDischarge", "ReferralSource", "Cluster"]
+    REPLACE_NAN_VALUES = ["18/02/2018", "None recorded", "None recorded"]
+
+    # create a population timeline grouped by 'Service', 'Setting' or 
+    # 'Locality' (None for no population timeline)
+    POPULATION_GROUP = None
+
+    # store the cleaned data in compact types, to use less memory
+    COMPACT_DATA = False
+
+    # where to store the cleaned data (None to not store it)
+    CACHE_FOLDER = None # for example 'data/cache/'
+
+    # only create the charts whose data has changed since the last run
+    INCREMENTAL = False
+
+    # how many rows of the input file to read at a time (None for all rows)
+    STREAM_CHUNK_ROWS = None # for example 100000
+
+    # read the episodes from a SQLite database, created from the input file
+    # if it does not exist (None to read the input file)
+    DATABASE = None # for example 'data/carenotes.sqlite'
+
+    # read the prepared episodes from an archive written by export_data.py 
+    # (None to read the input file)
+    ARCHIVE_FOLDER = None # for example 'data/archive/'
     
     # who to create charts for
     CLIENTS = [471]#[14, 89]# use [-1] for all clients
 
+    # or who to create charts for, by the dates of their episodes (None to use
+    # CLIENTS)
+    CLIENTS_QUERY = None # for example {'start_date': '01/06/2016', 
+                         #              'WardTeam': 'Team 3'}
+
+    # how to create the charts ('matplotlib' or 'svg')
+    RENDER_ENGINE = 'matplotlib'
+
+    # where to save the charts ('files' for a svg file per client, 'pdf' for 
+    # a page per client or 'overview' for several clients per page of a pdf 
+    # file called BUNDLE_NAME)
+    OUTPUT_MODE = 'files'
+    BUNDLE_NAME = 'timelines'
+
+    # only save the charts, do not show them
+    HEADLESS = False
+
+    # how to write the svg files ('svg', 'compact' for smaller files that 
+    # look the same, or 'svgz' for compact and gzip compressed)
+    SVG_FORMAT = 'svg'
+
+    # how many threads to write the svg files with (0 to write each file 
+    # before drawing the next), and how many files can wait to be written
+    N_WRITERS = 0
+    WRITE_QUEUE_DEPTH = 16
+
+    # how many processes to create the charts with
+    N_WORKERS = 1 # use None for one process per CPU core
+    CHUNK_SIZE = 4
+
+    # where to save a report of the time taken by each stage (None for none)
+    REPORT_FILE = None # for example 'data/timelines_report.json'
+    REPORT_MEMORY = False
+
     COLUMNS_REQUIRED = ["ClientID", "ReferralDate", "ReferralDischarge", 
                         "ReferralSource", "WardTeam", "GenSpecialty", 
                         "ICD10", "Cluster", "Setting", "Locality", 
                         "date_of_birth", "ReferralRequest", "daily_cost",  
-                        "number_contacts", "contact_date_1", "contact_type_1",  
-                        "contact_date_2", "contact_type_2", "contact_date_3",  
-                        "contact_type_3", "contact_date_4", "contact_type_4", 
-                        "OOABedType"]
+                        "number_contacts", "OOABedType"]
     
     COLUMNS_DTYPE = [[int], ['O'], ['O'], 
                      ['O'], ['O'], ['O'],
                      ['O'], [int, np.int64, float], ['O'], ['O'],
                      ['O'],['O'], [int], 
-                     [int],['O'], [int, np.int64, float],  
-                     ['O'], [int, np.int64, float], ['O'], 
-                     [int, np.int64, float], ['O'], [int, np.int64, float], 
-                     ['O']]
+                     [int], ['O']]
 
-    return (FOLDER, FILENAME, KEEP_MISSING_COST, ORDER_ON_COST, 
-            ZERO_LOS_REPLACEMENT, CLIENTS, COLUMNS_REQUIRED, COLUMNS_DTYPE)
+    # Every variable set above, by name
+    return UserVariables(**locals())
 
 # %% [markdown]
 # ## Main code
@@ -737,73 +3775,168 @@ def user_defined_variables():
 if __name__ == '__main__':
     
     # User defined variables
-    (FOLDER, FILENAME, KEEP_MISSING_COST, ORDER_ON_COST, 
-     ZERO_LOS_REPLACEMENT, CLIENTS, COLUMNS_REQUIRED, 
-     COLUMNS_DTYPE) = user_defined_variables()
-
-# READ IN DATAFILE
-    DATA=pd.read_csv(f"{FOLDER}{FILENAME}.csv",
-                     low_memory=False)
-#Check the required columns are present and are of the expected type
-    check_columns_present_and_type(DATA, COLUMNS_REQUIRED, COLUMNS_DTYPE)
-
-# Extract the data for the client IDs want to produce a timeline chart for    
-    if CLIENTS[0] == -1 :    # Want all the unique ClientIDs in the dataset
-        CLIENTS=DATA.ClientID.unique()
+    VARIABLES = user_defined_variables()
+    CLIENTS = VARIABLES.CLIENTS
+    ALL_CLIENTS = CLIENTS[0] == -1 and VARIABLES.CLIENTS_QUERY is None
+
+    # A pdf file of the timelines is always created in full
+    INCREMENTAL = (VARIABLES.INCREMENTAL and 
+                   VARIABLES.OUTPUT_MODE == 'files')
+
+    # Draw with the non-interactive backend (read when matplotlib is imported,
+    # also by the worker processes)
+    if VARIABLES.HEADLESS:
+        os.environ['MPLBACKEND'] = 'Agg'
+
+    # The clients of CLIENTS_QUERY are chosen from the data of all clients
+    if (VARIABLES.CLIENTS_QUERY is not None and 
+            VARIABLES.STREAM_CHUNK_ROWS is None and 
+            VARIABLES.DATABASE is None and VARIABLES.ARCHIVE_FOLDER is None):
+        CLIENTS = [-1]
+
+    # Record the time taken by each stage (None to not record)
+    REPORT = (None if VARIABLES.REPORT_FILE is None else 
+              create_report(VARIABLES.REPORT_MEMORY))
+
+# READ IN DATAFILE, CLEAN DATA AND CALCULATE NEW VARIABLES
+    if VARIABLES.ARCHIVE_FOLDER is not None:
+        # Read each client's prepared data from the archive
+        ARCHIVE = open_episode_archive(VARIABLES.ARCHIVE_FOLDER)
+        if CLIENTS[0] == -1:
+            CLIENTS = ARCHIVE['client_ids'].tolist()
+        if (VARIABLES.N_WORKERS != 1 and VARIABLES.OUTPUT_MODE == 'files' and 
+                not INCREMENTAL):
+            # The worker processes read the clients from the archive
+            CLIENT_GROUPS = ((ThisClientID, None, None) 
+                             for ThisClientID in CLIENTS)
+        else:
+            CLIENT_GROUPS = ((ThisClientID, 
+                              *get_archived_client(ARCHIVE, ThisClientID))
+                             for ThisClientID in CLIENTS)
+    elif VARIABLES.DATABASE is not None:
+        # Read and clean only the episodes of CLIENTS from the database, a 
+        # client's data is provided once all of their episodes have been read
+        if not os.path.exists(VARIABLES.DATABASE):
+            with record_stage(REPORT, 'create_episode_store'):
+                create_episode_store(VARIABLES.FOLDER, VARIABLES.FILENAME, 
+                                     VARIABLES.DATABASE, 
+                                     VARIABLES.COLUMNS_REQUIRED, 
+                                     VARIABLES.COLUMNS_DTYPE)
+        CONNECTION = sqlite3.connect(VARIABLES.DATABASE)
+        CLIENT_GROUPS = read_episode_store(CONNECTION, CLIENTS, 
+                                           VARIABLES.COLUMNS_REQUIRED, 
+                                           VARIABLES.COLUMNS_DTYPE, 
+                                           VARIABLES.KEEP_MISSING_COST, 
+                                           VARIABLES.ZERO_LOS_REPLACEMENT, 
+                                           VARIABLES.REPLACE_NAN_COLUMNS, 
+                                           VARIABLES.REPLACE_NAN_VALUES, 
+                                           VARIABLES.COMPACT_DATA, REPORT)
+    elif VARIABLES.STREAM_CHUNK_ROWS is not None:
+        # Read and clean the file in chunks, a client's data is provided once
+        # all of their episodes have been read
+        CLIENT_GROUPS = stream_client_data(VARIABLES.FOLDER, 
+                                           VARIABLES.FILENAME, CLIENTS, 
+                                           VARIABLES.COLUMNS_REQUIRED, 
+                                           VARIABLES.COLUMNS_DTYPE, 
+                                           VARIABLES.KEEP_MISSING_COST, 
+                                           VARIABLES.ZERO_LOS_REPLACEMENT, 
+                                           VARIABLES.REPLACE_NAN_COLUMNS, 
+                                           VARIABLES.REPLACE_NAN_VALUES, 
+                                           VARIABLES.STREAM_CHUNK_ROWS, 
+                                           VARIABLES.COMPACT_DATA, REPORT)
     else:
-        DATA = DATA.loc[DATA['ClientID'].isin(CLIENTS)]
-    
-# CLEAN DATA
-    # Replace missing values (np.nan) with appropriate values
-    column_name = ["ReferralDischarge", "ReferralSource", "Cluster"]
-    replacement_value = ["18/02/2018", "None recorded", "None recorded"]
-    DATA = replace_nan_values(DATA, column_name, replacement_value)
-    
-    # Remove episodes with missing values (np.nan) for certain variables
-    column_name = ["ReferralDate"]
-    DATA = remove_nan_values(DATA, column_name)
-
-    # Format date variables
-    column_name = ["ReferralRequest", "ReferralDate", 
-               "ReferralDischarge", "date_of_birth"]
-    DATA = format_date_variables(DATA, column_name)
-
-# CALCULATE NEW VARIABLES
-    # Calculate length of stay
-    DATA['los_days']=DATA.ReferralDischarge_format-DATA.ReferralDate_format
-    DATA.los_days=(DATA.ReferralDischarge_format-
-                  DATA.ReferralDate_format).astype('timedelta64[D]')
-    # Remove episodes with negative LoS
-    DATA = DATA[DATA.los_days >= 0]
-
-    # Calculate service use cost
-    los_days = DATA.los_days.values
-    daily_cost = np.array(DATA.daily_cost.values,dtype=float)
-    mask = DATA.los_days == 0
-    los_days[mask] = ZERO_LOS_REPLACEMENT
-    DATA['Episode_cost'] = los_days * daily_cost
-    DATA.Episode_cost = DATA.Episode_cost.astype(int)
-    DATA["Episode_cost_str"] = DATA.Episode_cost.astype(str)
-    # Depending on user defined boolean, remove admissions with no cost
-    DATA = edit_cost_data(DATA, KEEP_MISSING_COST)
-
-    # Calculate mdate
-    column_name = ["ReferralRequest", "ReferralDate", 
-                   "ReferralDischarge"]
-    DATA = calculate_mdate(DATA, column_name)
+        # Read and prepare the data of CLIENTS (all clients for 
+        # CLIENTS_QUERY)
+        DATA, CONTACTS = load_data(VARIABLES, CLIENTS, REPORT)
+
+        # Population timeline: daily clients and spend for each group
+        if VARIABLES.POPULATION_GROUP is not None:
+            with record_stage(REPORT, 'population', episodes = len(DATA)):
+                OCCUPANCY, SPEND = calculate_population_occupancy(
+                                        DATA, VARIABLES.POPULATION_GROUP, 
+                                        '01/01/2015', '18/02/2018')
+                create_population_timeline(OCCUPANCY, SPEND, 
+                                           VARIABLES.POPULATION_GROUP,
+                                           VARIABLES.FOLDER, 
+                                           VARIABLES.HEADLESS)
+
+        if CLIENTS[0] == -1 :    # Want all the unique ClientIDs in the dataset
+            CLIENTS=DATA.ClientID.unique()
+
+        # Choose the clients with an episode open on the dates of CLIENTS_QUERY
+        if VARIABLES.CLIENTS_QUERY is not None:
+            with record_stage(REPORT, 'clients_query', episodes = len(DATA)):
+                INTERVAL_INDEX = create_interval_index(DATA)
+                CLIENTS = query_clients(DATA, INTERVAL_INDEX, 
+                                        **VARIABLES.CLIENTS_QUERY)
+
+        # Index the data and contacts on ClientID, so each client's data is a
+        # slice
+        with record_stage(REPORT, 'client_index', episodes = len(DATA),
+                          contacts = len(CONTACTS)):
+            DATA, CLIENT_INDEX = create_client_index(DATA)
+            CONTACTS, CONTACT_INDEX = create_client_index(CONTACTS)
+        CLIENT_GROUPS = ((ThisClientID, 
+                          get_client_data(DATA, CLIENT_INDEX, ThisClientID),
+                          get_client_data(CONTACTS, CONTACT_INDEX, 
+                                          ThisClientID))
+                         for ThisClientID in CLIENTS)
    
+# Only create the timelines whose data has changed since the last run
+    if INCREMENTAL:
+        MANIFEST = load_timeline_manifest(VARIABLES.FOLDER)
+        NEW_MANIFEST = {}
+        CLIENT_GROUPS = select_changed_clients(CLIENT_GROUPS, 
+                                               VARIABLES.FOLDER, MANIFEST, 
+                                               NEW_MANIFEST, 
+                                               VARIABLES.ORDER_ON_COST, 
+                                               VARIABLES.RENDER_ENGINE,
+                                               VARIABLES.SVG_FORMAT)
+
 # Loop through each of the clients for whom to produce the timeline.
-# Sort the filtered DataFrame containing the service use for this single
-# client, and pass the sorted DataFrame to the function to create the timeline.
-    for ThisClientID in CLIENTS:
-        client_data = DATA[DATA.ClientID == ThisClientID].copy(deep = True)
-        client_data = sort_data(client_data, ORDER_ON_COST)
-        client_data = add_string_counter_column(client_data)
-        # Construct the string for the y axis label
-        client_data['ylabel'] = (client_data.counter_str + ". " + 
-                                 client_data.WardTeam + 
-                                 ". (Referral Source: " + 
-                                 client_data.ReferralSource + 
-                                 ")" + ". Cost = £" + 
-                                 client_data.Episode_cost_str)
-        create_service_use_timeline(client_data, FOLDER)
\ No newline at end of file
+# Pass the DataFrame containing the service use for this single client to the 
+# function that sorts it and creates the timeline.
+# (When streaming, the render stage includes reading and cleaning the file.)
+    failures = {}
+    with record_stage(REPORT, 'render', engine = VARIABLES.RENDER_ENGINE):
+        if VARIABLES.OUTPUT_MODE != 'files':
+            render_timelines_to_pdf(CLIENT_GROUPS, VARIABLES.FOLDER, 
+                                    VARIABLES.BUNDLE_NAME, 
+                                    VARIABLES.ORDER_ON_COST, 
+                                    VARIABLES.OUTPUT_MODE, REPORT)
+        elif VARIABLES.N_WORKERS == 1:
+            # Write the svg files in the background (None: write each file 
+            # before drawing the next)
+            WRITER = (None if VARIABLES.N_WRITERS == 0 else 
+                      create_svg_writer(VARIABLES.N_WRITERS, 
+                                        VARIABLES.WRITE_QUEUE_DEPTH))
+            for ThisClientID, client_data, client_contacts in CLIENT_GROUPS:
+                render_client_timeline(client_data, client_contacts, 
+                                       VARIABLES.FOLDER, 
+                                       VARIABLES.ORDER_ON_COST, 
+                                       VARIABLES.RENDER_ENGINE, REPORT, 
+                                       HEADLESS = VARIABLES.HEADLESS, 
+                                       writer = WRITER,
+                                       SVG_FORMAT = VARIABLES.SVG_FORMAT)
+            close_svg_writer(WRITER)
+        else:
+            failures = render_timelines_in_parallel(
+                                            CLIENT_GROUPS, VARIABLES.FOLDER, 
+                                            VARIABLES.ORDER_ON_COST, 
+                                            VARIABLES.RENDER_ENGINE, 
+                                            VARIABLES.N_WORKERS, 
+                                            VARIABLES.CHUNK_SIZE, REPORT, 
+                                            VARIABLES.SVG_FORMAT, 
+                                            VARIABLES.ARCHIVE_FOLDER)
+            for ClientID, error in failures.items():
+                print(f"Timeline not created for client {ClientID}: {error}")
+
+    if INCREMENTAL:
+        update_timeline_manifest(VARIABLES.FOLDER, MANIFEST, NEW_MANIFEST, 
+                                 failures, ALL_CLIENTS)
+
+    if VARIABLES.DATABASE is not None:
+        CONNECTION.close()
+
+    if REPORT is not None:
+        save_report(REPORT, VARIABLES.REPORT_FILE)
@@ -0,0 +1,68 @@
+# Tests of service_use_timelines.py
+#
+# Run from the repository folder:
+#
+#     python -m pytest test_service_use_timelines.py
+
+import os
+
+import service_use_timelines as sut
+
+
+def write_timelines(folder, client_ids):
+    for ClientID in client_ids:
+        with open(os.path.join(folder, f"timeline_{ClientID}.svg"),
+                  'w') as file:
+            file.write(f"<svg>{ClientID}</svg>")
+
+
+def test_update_timeline_manifest_keeps_failed_client(tmp_path):
+    # Client 2 is still in the data but fails to render, client 3 has left
+    # the data
+    FOLDER = str(tmp_path)
+    write_timelines(FOLDER, [1, 2, 3])
+    manifest = {'1': 'old 1', '2': 'old 2', '3': 'old 3'}
+    new_manifest = {'1': 'new 1', '2': 'new 2'}
+
+    sut.update_timeline_manifest(FOLDER, manifest, new_manifest,
+                                 {2: 'ValueError: failed'}, True)
+
+    assert os.path.exists(os.path.join(FOLDER, 'timeline_1.svg'))
+    assert os.path.exists(os.path.join(FOLDER, 'timeline_2.svg'))
+    assert not os.path.exists(os.path.join(FOLDER, 'timeline_3.svg'))
+    # The old entry of client 2 is kept, so its timeline is out of date and
+    # is created again on the next run
+    assert sut.load_timeline_manifest(FOLDER) == {'1': 'new 1',
+                                                  '2': 'old 2'}
+
+
+def test_round_svg_numbers_keeps_text():
+    svg = (b'<svg><path d="M 10.123456 -0.001 L 5.5 2.345678"/>'
+           b'<text transform="translate(3.14159 2.71828)">'
+           b'Cost 1234.5678, 01.06.2016</text>'
+           b'<!-- Cost 1234.5678 --></svg>')
+
+    assert sut.round_svg_numbers(svg) == (
+               b'<svg><path d="M 10.12 0 L 5.5 2.35"/>'
+               b'<text transform="translate(3.14 2.72)">'
+               b'Cost 1234.5678, 01.06.2016</text>'
+               b'<!-- Cost 1234.5678 --></svg>')
+
+
+def test_round_svg_numbers_keeps_matplotlib_label():
+    import io
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.plot([0.123456, 1.654321], [0, 1])
+    ax.set_title('Cost 1234.5678')
+    svg = io.BytesIO()
+    with matplotlib.rc_context({'svg.fonttype': 'none'}):
+        fig.savefig(svg, format = 'svg')
+    plt.close(fig)
+
+    rounded = sut.round_svg_numbers(svg.getvalue())
+    assert b'>Cost 1234.5678</text>' in rounded
+    assert len(rounded) < len(svg.getvalue())
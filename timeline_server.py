@@ -0,0 +1,389 @@
+# %% [markdown]
+# Serve the Service Use Timelines of service_use_timelines.py on request
+#
+# A long running local web service. The input file is read and prepared once,
+# when the service starts, and indexed on ClientID, so a client's timeline is
+# created (in the time it takes to draw it) when it is asked for:
+#
+#     http://127.0.0.1:8000/timeline/471?order_on_cost=true
+#
+# order_on_cost is optional (the default is ORDER_ON_COST in
+# user_defined_variables). The timeline is returned as an svg file.
+#
+# Run from the repository folder:
+#
+#     python timeline_server.py --port 8000 --cache-folder data/timeline_cache/
+#
+# The timelines created are kept in a cache in memory and, with
+# --cache-folder, on disk (so they are still there when the service is
+# started again). Each cache has a maximum size; when it is full the least
+# recently used timelines are removed. When the input file changes, the data
+# is prepared again and the cached timelines are no longer used.
+#
+# benchmark_server.py measures the response time of a local instance.
+
+# %%
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import service_use_timelines as sut
+
+# %% [markdown]
+# ## Define function: create_timeline_cache
+#
+# The cache of created timelines: an in-memory cache of at most MEMORY_BYTES
+# of svg files, and (if CACHE_FOLDER is not None) an on-disk cache of at most
+# DISK_BYTES in CACHE_FOLDER. Each cache is an ordered dictionary of
+# key: svg (in memory) or key: file size (on disk), with the most recently
+# used timeline last.
+#
+# The timelines on disk are stored in a folder for each version of the data
+# (see load_timeline_data), so the timelines already in the folder of the
+# current version are added to the cache (oldest first).
+
+# %%
+def create_timeline_cache(MEMORY_BYTES, DISK_BYTES, CACHE_FOLDER):
+    """
+    Return a dictionary of the in-memory and on-disk caches and their sizes
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    for name, value in [('MEMORY_BYTES', MEMORY_BYTES),
+                        ('DISK_BYTES', DISK_BYTES)]:
+        if (type(value) not in [int]) or value < 0:
+            raise TypeError (f"function {function_name}: "
+                             f"{name} must be a positive integer")
+
+    if CACHE_FOLDER is not None and not isinstance(CACHE_FOLDER, str):
+        raise TypeError (f"function {function_name}: "
+                         f"CACHE_FOLDER must be a string or None")
+
+############################### Function ######################################
+
+    return {'memory': OrderedDict(), 'memory_bytes': 0,
+            'memory_limit': MEMORY_BYTES, 'disk': OrderedDict(),
+            'disk_bytes': 0, 'disk_limit': DISK_BYTES,
+            'folder': CACHE_FOLDER, 'version': None,
+            'lock': threading.Lock()}
+
+# %% [markdown]
+# ## Define function: set_cache_version
+#
+# Called when the data is (re)loaded. If the version of the data has changed,
+# the timelines of the old version are removed from memory and from disk, and
+# the timelines already on disk for the new version are added to the cache.
+#
+# Only the folders named like a version (VERSION_FOLDER, 16 hexadecimal
+# digits) are removed from the cache folder, so nothing else is deleted if it
+# is shared with other files (for example data/ or the CACHE_FOLDER of the
+# prepared data).
+
+# %%
+VERSION_FOLDER = re.compile(r'[0-9a-f]{16}')
+
+def set_cache_version(cache, version):
+    """
+    Pass the cache dictionary and the version of the data (a string)
+    """
+    with cache['lock']:
+        if cache['version'] == version:
+            return
+        cache['memory'].clear()
+        cache['memory_bytes'] = 0
+        cache['disk'].clear()
+        cache['disk_bytes'] = 0
+        cache['version'] = version
+        if cache['folder'] is None:
+            return
+
+        os.makedirs(cache['folder'], exist_ok = True)
+        for name in os.listdir(cache['folder']):
+            if (name != version and VERSION_FOLDER.fullmatch(name) and 
+                    os.path.isdir(os.path.join(cache['folder'], name))):
+                shutil.rmtree(os.path.join(cache['folder'], name),
+                              ignore_errors = True)
+        folder = os.path.join(cache['folder'], version)
+        os.makedirs(folder, exist_ok = True)
+        files = [entry for entry in os.scandir(folder)
+                 if entry.name.endswith('.svg')]
+        for entry in sorted(files, key = lambda entry: entry.stat().st_mtime):
+            cache['disk'][entry.name[:-len('.svg')]] = entry.stat().st_size
+            cache['disk_bytes'] += entry.stat().st_size
+    _evict_timelines(cache)
+
+# %% [markdown]
+# ## Define function: get_cached_timeline
+#
+# Return the svg of a timeline from the cache, and where it was found
+# ('memory' or 'disk'), or None (and 'miss') if it is not in the cache. A
+# timeline found on disk is also added to the memory cache.
+
+# %%
+def get_cached_timeline(cache, key):
+    """
+    Pass the cache dictionary and the key of the timeline. Return the svg
+    (bytes) or None, and where it was found
+    """
+    with cache['lock']:
+        if key in cache['memory']:
+            cache['memory'].move_to_end(key)
+            return cache['memory'][key], 'memory'
+        if key not in cache['disk']:
+            return None, 'miss'
+        cache['disk'].move_to_end(key)
+        version = cache['version']
+        filename = os.path.join(cache['folder'], version, f"{key}.svg")
+    try:
+        with open(filename, 'rb') as file:
+            svg = file.read()
+        os.utime(filename)
+    except OSError:
+        # Removed from the folder outside of the service
+        with cache['lock']:
+            cache['disk_bytes'] -= cache['disk'].pop(key, 0)
+        return None, 'miss'
+    store_cached_timeline(cache, version, key, svg, False)
+    return svg, 'disk'
+
+# %% [markdown]
+# ## Define function: store_cached_timeline
+#
+# Add a timeline to the memory cache and (if TO_DISK and there is a cache
+# folder) to the disk cache, then remove the least recently used timelines
+# until each cache is within its maximum size. A timeline larger than a
+# cache is not kept in it. A timeline created from an older version of the
+# data (the input file changed while it was being created) is not stored.
+#
+# The file is written to a temporary name first, so a timeline that is being
+# written is never read.
+
+# %%
+def store_cached_timeline(cache, version, key, svg, TO_DISK = True):
+    """
+    Pass the cache dictionary, the version of the data the timeline was
+    created from, the key of the timeline and its svg (bytes)
+    """
+    if version != cache['version']:
+        return
+    if TO_DISK and cache['folder'] is not None:
+        filename = os.path.join(cache['folder'], cache['version'],
+                                f"{key}.svg")
+        with open(f"{filename}.tmp", 'wb') as file:
+            file.write(svg)
+        os.replace(f"{filename}.tmp", filename)
+    with cache['lock']:
+        cache['memory_bytes'] += len(svg) - len(cache['memory'].get(key, b''))
+        cache['memory'][key] = svg
+        cache['memory'].move_to_end(key)
+        if TO_DISK and cache['folder'] is not None:
+            cache['disk_bytes'] += len(svg) - cache['disk'].get(key, 0)
+            cache['disk'][key] = len(svg)
+            cache['disk'].move_to_end(key)
+    _evict_timelines(cache)
+
+def _evict_timelines(cache):
+    with cache['lock']:
+        while cache['memory_bytes'] > cache['memory_limit']:
+            key, svg = cache['memory'].popitem(last = False)
+            cache['memory_bytes'] -= len(svg)
+        while cache['disk_bytes'] > cache['disk_limit']:
+            key, size = cache['disk'].popitem(last = False)
+            cache['disk_bytes'] -= size
+            filename = os.path.join(cache['folder'], cache['version'],
+                                    f"{key}.svg")
+            if os.path.exists(filename):
+                os.remove(filename)
+
+# %% [markdown]
+# ## Define function: load_timeline_data
+#
+# Read and prepare the input file (with load_data of service_use_timelines.py,
+# from the prepared data cache if CACHE_FOLDER is set in
+# user_defined_variables), and index it on ClientID.
+# Return a dictionary of the data, indexes and a version of the data: a hash
+# of the size and time of change of the input file, of the variables used to
+# prepare it and of the rendering engine. The version changes when the input
+# file changes.
+
+# %%
+def load_timeline_data(variables, RENDER_ENGINE):
+    """
+    Pass the variables returned by user_defined_variables and the rendering
+    engine. Return a dictionary of the prepared data indexed on ClientID
+    """
+    filename = f"{variables.FOLDER}{variables.FILENAME}.csv"
+    status = os.stat(filename)
+    version = hashlib.sha256(repr((
+                    status.st_size, status.st_mtime_ns,
+                    sut.PREPARED_DATA_VERSION, sut.TIMELINE_VERSION,
+                    variables.KEEP_MISSING_COST,
+                    variables.ZERO_LOS_REPLACEMENT,
+                    variables.REPLACE_NAN_COLUMNS,
+                    variables.REPLACE_NAN_VALUES,
+                    RENDER_ENGINE)).encode()).hexdigest()[:16]
+
+    df, contacts = sut.load_data(variables)
+    df, client_index = sut.create_client_index(df)
+    contacts, contact_index = sut.create_client_index(contacts)
+    return {'filename': filename,
+            'status': (status.st_size, status.st_mtime_ns),
+            'version': version, 'df': df, 'client_index': client_index,
+            'contacts': contacts, 'contact_index': contact_index}
+
+# %% [markdown]
+# ## Define function: create_timeline_server
+#
+# Return the web service (call serve_forever to start it). Each request is
+# answered in its own thread. The service checks the input file on each
+# request, and prepares the data again if it has changed. Timelines that are
+# not in the cache are created one at a time (matplotlib can only draw one
+# figure at a time), in a temporary folder, and added to the cache.
+#
+# The response has an X-Cache header of where the timeline was found:
+# 'memory', 'disk' or 'miss' (created for this request).
+
+# %%
+def create_timeline_server(HOST, PORT, variables, RENDER_ENGINE, cache):
+    """
+    Pass the address to serve on, the variables returned by
+    user_defined_variables, the rendering engine and the cache dictionary.
+    Return the web service
+    """
+############################# Argument checking ###############################
+    function_name = sys._getframe(  ).f_code.co_name
+
+    if RENDER_ENGINE not in ['matplotlib', 'svg']:
+        raise ValueError (f"function {function_name}: "
+                          f"RENDER_ENGINE must be 'matplotlib' or 'svg'")
+
+############################### Function ######################################
+
+    ORDER_ON_COST = variables.ORDER_ON_COST
+    state = {'data': load_timeline_data(variables, RENDER_ENGINE)}
+    set_cache_version(cache, state['data']['version'])
+    data_lock = threading.Lock()
+    render_lock = threading.Lock()
+
+    def get_data():
+        # Prepare the data again if the input file has changed
+        with data_lock:
+            data = state['data']
+            status = os.stat(data['filename'])
+            if (status.st_size, status.st_mtime_ns) != data['status']:
+                data = load_timeline_data(variables, RENDER_ENGINE)
+                set_cache_version(cache, data['version'])
+                state['data'] = data
+            return data
+
+    def render(data, ClientID, order_on_cost):
+        df = sut.get_client_data(data['df'], data['client_index'], ClientID)
+        contacts = sut.get_client_data(data['contacts'],
+                                       data['contact_index'], ClientID)
+        with render_lock, tempfile.TemporaryDirectory() as folder:
+            sut.render_client_timeline(df, contacts, folder, order_on_cost,
+                                       RENDER_ENGINE, HEADLESS = True)
+            with open(os.path.join(folder, f"timeline_{ClientID}.svg"),
+                      'rb') as file:
+                return file.read()
+
+    class TimelineRequestHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'timeline':
+                return self.send_error(404, "Use /timeline/<ClientID>")
+            try:
+                ClientID = int(parts[1])
+            except ValueError:
+                return self.send_error(400, "ClientID must be a number")
+            order_on_cost = parse_qs(url.query).get('order_on_cost',
+                                                    [str(ORDER_ON_COST)])[-1]
+            if order_on_cost.lower() not in ['true', 'false']:
+                return self.send_error(400, "order_on_cost must be true or "
+                                            "false")
+            order_on_cost = order_on_cost.lower() == 'true'
+
+            data = get_data()
+            if ClientID not in data['client_index']:
+                return self.send_error(404, f"No episodes for client "
+                                            f"{ClientID}")
+            key = f"timeline_{ClientID}_{'cost' if order_on_cost else 'date'}"
+            svg, found = get_cached_timeline(cache, key)
+            if svg is None:
+                try:
+                    svg = render(data, ClientID, order_on_cost)
+                except Exception as error:
+                    self.log_error("timeline of client %s failed: %r", 
+                                   ClientID, error)
+                    return self.send_error(500, f"The timeline of client "
+                                                f"{ClientID} could not be "
+                                                f"created")
+                store_cached_timeline(cache, data['version'], key, svg)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/svg+xml')
+            self.send_header('Content-Length', str(len(svg)))
+            self.send_header('X-Cache', found)
+            self.end_headers()
+            self.wfile.write(svg)
+
+    server = ThreadingHTTPServer((HOST, PORT), TimelineRequestHandler)
+    server.daemon_threads = True
+    return server
+
+# %% [markdown]
+# ## Main code
+
+# %%
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description = "Serve the Service Use "
+                                     "Timelines on request")
+    parser.add_argument('--host', default = '127.0.0.1',
+                        help = "address to serve on (default 127.0.0.1)")
+    parser.add_argument('--port', type = int, default = 8000,
+                        help = "port to serve on (default 8000)")
+    parser.add_argument('--engine', choices = ['matplotlib', 'svg'],
+                        help = "rendering engine (default RENDER_ENGINE)")
+    parser.add_argument('--cache-folder',
+                        help = "folder to cache the timelines in (default "
+                               "none, only cached in memory)")
+    parser.add_argument('--memory-mb', type = float, default = 64,
+                        help = "maximum size of the in-memory cache "
+                               "(default 64 MB)")
+    parser.add_argument('--disk-mb', type = float, default = 1024,
+                        help = "maximum size of the on-disk cache "
+                               "(default 1024 MB)")
+    args = parser.parse_args()
+
+    # Draw with the non-interactive backend (read when matplotlib is first
+    # imported, by the matplotlib engine only)
+    os.environ['MPLBACKEND'] = 'Agg'
+    VARIABLES = sut.user_defined_variables()
+    RENDER_ENGINE = args.engine or VARIABLES.RENDER_ENGINE
+
+    start = time.perf_counter()
+    CACHE = create_timeline_cache(int(args.memory_mb * 1e6),
+                                  int(args.disk_mb * 1e6), args.cache_folder)
+    SERVER = create_timeline_server(args.host, args.port, VARIABLES,
+                                    RENDER_ENGINE, CACHE)
+    print(f"Data prepared in {time.perf_counter() - start:.1f} seconds. "
+          f"Serving timelines on http://{args.host}:"
+          f"{SERVER.server_address[1]}/timeline/<ClientID>", flush = True)
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    SERVER.server_close()